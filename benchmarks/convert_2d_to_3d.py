@@ -0,0 +1,53 @@
+"""
+Compares the sphere stamping engines of `utils.convert_2d_to_3d` on the sample segmentations.
+
+Usage (from the repository root):
+    python -m benchmarks.convert_2d_to_3d [--image_files "data/src/*.png"] [--z_dim 64]
+"""
+import argparse
+import glob
+import time
+
+import numpy as np
+from natsort import natsorted
+from PIL import Image
+
+from utils.convert_2d_to_3d import convert_2d_to_3d
+
+
+def benchmark_convert_2d_to_3d(image_files: str, z_dim: int = 64, repeats: int = 3) -> list[dict]:
+    results = []
+    for path in natsorted(glob.glob(image_files, recursive=True)):
+        ves_seg = np.array(Image.open(path), np.uint8)
+        timings = dict()
+        volumes = dict()
+        for engine in ["loop", "kernel"]:
+            best = np.inf
+            for _ in range(repeats):
+                start = time.perf_counter()
+                volumes[engine] = convert_2d_to_3d(ves_seg, z_dim=z_dim, engine=engine)
+                best = min(best, time.perf_counter() - start)
+            timings[engine] = best
+        identical = np.array_equal(volumes["loop"], volumes["kernel"])
+        assert identical, f"Engines disagree for {path}!"
+        results.append({
+            "image": path,
+            "z_dim": z_dim,
+            "loop [s]": timings["loop"],
+            "kernel [s]": timings["kernel"],
+            "speedup": timings["loop"] / timings["kernel"],
+            "identical": identical
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the 2D to 3D conversion engines.")
+    parser.add_argument('--image_files', type=str, default="data/src/*.png", help="Glob pattern of the 2D segmentation maps")
+    parser.add_argument('--z_dim', type=int, default=64, help="Z dimension of the generated volume")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of repetitions. The fastest run is reported.")
+    args = parser.parse_args()
+
+    for r in benchmark_convert_2d_to_3d(args.image_files, z_dim=args.z_dim, repeats=args.repeats):
+        print(f"{r['image']}: loop {r['loop [s]']:.2f}s, kernel {r['kernel [s]']:.2f}s, "
+              f"speedup {r['speedup']:.1f}x, identical: {r['identical']}")
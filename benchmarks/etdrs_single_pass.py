@@ -0,0 +1,79 @@
+"""
+Validates the single-pass ETDRS extraction (`--etdrs_mode split`) against the five-run method (`--etdrs_mode masked`).
+
+Both modes are run on the same images and the per-sector densities of the resulting analysis summaries are compared.
+The report lists the densities of both modes and their difference for every image and is written as CSV.
+
+Usage (from the repository root):
+    python -m benchmarks.etdrs_single_pass --image_files "data/src/*.png" --faz_dir /path/to/faz --output_dir /path/to/report [--backend native]
+"""
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from generate_analysis_summary import generate_anylsis_file
+from graph_feature_extractor import perform_graph_feature_extraction, resolve_radius_correction_factor
+
+
+def validate_etdrs_single_pass(image_files: str, faz_dir: str, output_dir: str, tmp_dir: str, backend: str = "native",
+                               radius_thresholds: str = "0,inf", mm: float = 3.0, threads: int = 1, **kwargs) -> pd.DataFrame:
+    summaries = dict()
+    timings = dict()
+    kwargs["radius_correction_factor"] = resolve_radius_correction_factor(backend, kwargs.get("radius_correction_factor"))
+    for mode in ["masked", "split"]:
+        graph_dir = os.path.join(output_dir, mode)
+        start = time.perf_counter()
+        perform_graph_feature_extraction(
+            tmp_dir=tmp_dir,
+            output_dir=graph_dir,
+            image_files=image_files,
+            faz_dir=faz_dir,
+            etdrs=True,
+            etdrs_mode=mode,
+            backend=backend,
+            graph_image=False,
+            mm=mm,
+            threads=threads,
+            **kwargs
+        )
+        timings[mode] = time.perf_counter() - start
+        generate_anylsis_file(
+            source_dir=graph_dir,
+            segmentation_dir=os.path.dirname(image_files.split("*")[0]),
+            output_dir=graph_dir,
+            faz_files=os.path.join(faz_dir, "**", "*.png"),
+            radius_thresholds=radius_thresholds,
+            mm=mm,
+            etdrs=True,
+            radius_correction_factor=kwargs["radius_correction_factor"],
+            threads=threads
+        )
+        summaries[mode] = pd.read_csv(os.path.join(graph_dir, "density_measurements_etdrs.csv")).set_index("Image_ID")
+
+    density_columns = [c for c in summaries["masked"].columns if "Density" in c]
+    report = pd.concat({mode: summaries[mode][density_columns] for mode in summaries}, axis=1)
+    for c in density_columns:
+        report[("difference", c)] = report[("split", c)] - report[("masked", c)]
+    report.to_csv(os.path.join(output_dir, "etdrs_single_pass_report.csv"))
+
+    print(f"Extraction time: masked {timings['masked']:.1f}s, split {timings['split']:.1f}s")
+    print("Mean absolute density difference [%-points]:")
+    print(report["difference"].abs().mean().to_string())
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the single-pass ETDRS extraction with the five-run method.")
+    parser.add_argument('--image_files', type=str, required=True, help="Glob pattern of the segmentation maps")
+    parser.add_argument('--faz_dir', type=str, required=True, help="Folder containing the FAZ segmentations")
+    parser.add_argument('--output_dir', type=str, required=True, help="Folder for the graphs of both modes and the report")
+    parser.add_argument('--tmp_dir', type=str, default="/var/tmp", help="Temporary directory for Voreen")
+    parser.add_argument('--backend', type=str, choices=["voreen", "native"], default="native", help="Graph extraction backend")
+    parser.add_argument('--radius_thresholds', type=str, default="0,inf", help="Comma separated list of thresholds for vessel stratification [um].")
+    parser.add_argument('--mm', type=float, default=3.0, help="Size of the image in mm")
+    parser.add_argument('--threads', type=int, default=1, help="Number of parallel threads")
+    args = parser.parse_args()
+
+    validate_etdrs_single_pass(**vars(args))
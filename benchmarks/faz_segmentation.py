@@ -0,0 +1,51 @@
+"""
+Compares the FAZ segmentation engines of `faz_segmentation.get_faz_mask_robust` on the sample segmentations.
+Reports the speedup of the "shared" engine and the IoU of its FAZ mask with the "reference" engine.
+
+Usage (from the repository root):
+    python -m benchmarks.faz_segmentation [--image_files "data/src/*.png"] [--repeats 3]
+"""
+import argparse
+import glob
+import time
+
+import numpy as np
+from natsort import natsorted
+from PIL import Image
+
+from faz_segmentation import get_faz_mask_robust
+
+
+def benchmark_faz_segmentation(image_files: str, repeats: int = 3) -> list[dict]:
+    results = []
+    for path in natsorted(glob.glob(image_files, recursive=True)):
+        img_orig = np.array(Image.open(path))
+        timings = dict()
+        masks = dict()
+        for engine in ["reference", "shared"]:
+            best = np.inf
+            for _ in range(repeats):
+                start = time.perf_counter()
+                masks[engine] = get_faz_mask_robust(img_orig, engine=engine).astype(bool)
+                best = min(best, time.perf_counter() - start)
+            timings[engine] = best
+        union = (masks["reference"] | masks["shared"]).sum()
+        results.append({
+            "image": path,
+            "reference [s]": timings["reference"],
+            "shared [s]": timings["shared"],
+            "speedup": timings["reference"] / timings["shared"],
+            "IoU": (masks["reference"] & masks["shared"]).sum() / union if union else 1.0
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the FAZ segmentation engines.")
+    parser.add_argument('--image_files', type=str, default="data/src/*.png", help="Glob pattern of the 2D segmentation maps")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of repetitions. The fastest run is reported.")
+    args = parser.parse_args()
+
+    for r in benchmark_faz_segmentation(args.image_files, repeats=args.repeats):
+        print(f"{r['image']}: reference {r['reference [s]']:.2f}s, shared {r['shared [s]']:.2f}s, "
+              f"speedup {r['speedup']:.1f}x, IoU {r['IoU']:.4f}")
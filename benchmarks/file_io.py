@@ -0,0 +1,70 @@
+"""
+Measures the latency of writing the output files of one image while many workers write concurrently.
+Compares the former global `os.sync()` after each image with the "durable" and "fast" modes of `utils.file_io`.
+
+Usage (from the repository root):
+    python -m benchmarks.file_io --output_dir /path/on/target/filesystem [--workers 30] [--images 20] [--file_size_mb 2]
+"""
+import argparse
+import os
+import shutil
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from utils.file_io import atomic_write, remove_tree, set_io_mode
+
+
+def _write_images(worker: int, output_dir: str, mode: str, images: int, file_size: int) -> list[float]:
+    """Writes the nodes, edges and graph file of each image and returns the latency per image."""
+    if mode != "os.sync":
+        set_io_mode(mode)
+    payload = os.urandom(file_size)
+    worker_dir = os.path.join(output_dir, str(worker))
+    os.makedirs(worker_dir, exist_ok=True)
+    latencies = []
+    for i in range(images):
+        start = time.perf_counter()
+        for suffix in ["nodes.csv", "edges.csv", "graph.json"]:
+            path = os.path.join(worker_dir, f"{i}_{suffix}")
+            if mode == "os.sync":
+                with open(path, "wb") as file:
+                    file.write(payload)
+            else:
+                with atomic_write(path, "wb") as file:
+                    file.write(payload)
+        if mode == "os.sync":
+            os.sync()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def benchmark_file_io(output_dir: str, workers: int = 30, images: int = 20, file_size_mb: float = 2.0) -> list[dict]:
+    results = []
+    for mode in ["os.sync", "durable", "fast"]:
+        mode_dir = os.path.join(output_dir, "file_io_benchmark")
+        remove_tree(mode_dir)
+        task = partial(_write_images, output_dir=mode_dir, mode=mode, images=images, file_size=int(file_size_mb * 2**20))
+        with Pool(workers) as pool:
+            latencies = np.concatenate(pool.map(task, range(workers)))
+        shutil.rmtree(mode_dir)
+        results.append({
+            "mode": mode,
+            "p50 [s]": np.percentile(latencies, 50),
+            "p99 [s]": np.percentile(latencies, 99),
+            "max [s]": latencies.max()
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the output write latency under concurrent writers.")
+    parser.add_argument('--output_dir', type=str, required=True, help="Folder on the file system to benchmark")
+    parser.add_argument('--workers', type=int, default=30, help="Number of concurrent worker processes")
+    parser.add_argument('--images', type=int, default=20, help="Number of images written per worker")
+    parser.add_argument('--file_size_mb', type=float, default=2.0, help="Size of each of the three files per image in MB")
+    args = parser.parse_args()
+
+    for r in benchmark_file_io(args.output_dir, workers=args.workers, images=args.images, file_size_mb=args.file_size_mb):
+        print(f"{r['mode']:>8}: p50 {r['p50 [s]']*1000:.1f}ms, p99 {r['p99 [s]']*1000:.1f}ms, max {r['max [s]']*1000:.1f}ms per image")
@@ -0,0 +1,111 @@
+"""
+Compares the disc rasterization backends of `utils.visualizer.generate_image_from_graph_json` on extracted graphs.
+Reports the runtime of both backends, the fraction of identical pixels and the difference of the resulting vessel density.
+Without `--graph_dir`, the native graphs of the sample segmentations in `data/src` are compared.
+See `benchmarks.rasterizer_agreement` for the check of the agreement.
+
+Usage (from the repository root):
+    python -m benchmarks.rasterizer --graph_dir /path/to/graphs [--colorize white] [--dim 1216]
+    python -m benchmarks.rasterizer
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from natsort import natsorted
+from PIL import Image
+
+from utils.native_vesselgraphextraction import build_skeleton_graph
+from utils.vessel_graph import graph_to_tables
+from utils.visualizer import generate_image_from_graph_json
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "src")
+
+
+def compare_rasterizers(
+        graph_json: dict,
+        edges_df: pd.DataFrame,
+        dim: int = 1216,
+        colorize: str = "white",
+        image_size_mm: float = 3.0,
+        radius_correction_factor: float = 0.0,
+        repeats: int = 1
+    ) -> dict:
+    """
+    Renders a graph with both backends.
+
+    Returns:
+        dict: The fastest runtime of each backend, the speedup, the fraction of identical pixels and the density difference
+            of the numpy backend to the matplotlib backend in percentage points.
+    """
+    timings = dict()
+    images = dict()
+    for backend in ["matplotlib", "numpy"]:
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            images[backend] = generate_image_from_graph_json(
+                graph_json, edges_df, dim=dim, image_size_mm=image_size_mm, colorize=colorize,
+                radius_correction_factor=radius_correction_factor, backend=backend
+            )
+            best = min(best, time.perf_counter() - start)
+        timings[backend] = best
+    reference, fast = images["matplotlib"], images["numpy"]
+    if reference.ndim == 3:
+        # Colors at disc borders are blended by matplotlib only, so compare the covered pixels
+        reference, fast = reference.max(axis=-1), fast.max(axis=-1)
+    reference, fast = reference > 0, fast > 0
+    return {
+        "matplotlib [s]": timings["matplotlib"],
+        "numpy [s]": timings["numpy"],
+        "speedup": timings["matplotlib"] / timings["numpy"],
+        "pixel agreement": (reference == fast).mean(),
+        "density difference [%]": (fast.mean() - reference.mean()) * 100
+    }
+
+def benchmark_rasterizer(graph_dir: str, **kwargs) -> list[dict]:
+    """Compares the backends on the graphs in a folder, see `compare_rasterizers` for the keyword arguments."""
+    results = []
+    for graph_file in natsorted(glob.glob(os.path.join(graph_dir, "**/*_graph.json"), recursive=True)):
+        with open(graph_file) as f:
+            graph_json = json.load(f)
+        edges_df = pd.read_csv(graph_file.removesuffix("_graph.json") + "_edges.csv", sep=';', index_col=0)
+        results.append({"graph": graph_file, **compare_rasterizers(graph_json, edges_df, **kwargs)})
+    return results
+
+def benchmark_samples(sample_dir: str = SAMPLE_DIR, **kwargs) -> list[dict]:
+    """Compares the backends on the native graphs of the segmentations in a folder, see `compare_rasterizers` for the keyword arguments."""
+    results = []
+    for seg_file in natsorted(glob.glob(os.path.join(sample_dir, "*.png"))):
+        ves_seg = np.array(Image.open(seg_file))
+        if ves_seg.ndim == 3:
+            ves_seg = ves_seg[..., 0]
+        graph_json = build_skeleton_graph(ves_seg)
+        _, edges_df = graph_to_tables(graph_json)
+        results.append({"graph": seg_file, **compare_rasterizers(graph_json, edges_df, **{"dim": ves_seg.shape[0], **kwargs})})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the graph rasterization backends.")
+    parser.add_argument('--graph_dir', type=str, default=None, help="Folder containing '_graph.json' and '_edges.csv' files. "
+                        +"Defaults to the native graphs of the sample segmentations in data/src.")
+    parser.add_argument('--dim', type=int, default=1216, help="Image dimension")
+    parser.add_argument('--colorize', type=str, choices=["continuous", "thresholds", "random", "white"], default="white", help="Color mode")
+    parser.add_argument('--mm', type=float, default=3.0, help="Size of the image in mm")
+    parser.add_argument('--radius_correction_factor', type=float, default=0.0, help="Additive correction factor for the radius estimation. Use -1.0 for graphs of the voreen backend.")
+    parser.add_argument('--repeats', type=int, default=1, help="Number of repetitions. The fastest run is reported.")
+    args = parser.parse_args()
+
+    kwargs = dict(colorize=args.colorize, image_size_mm=args.mm, radius_correction_factor=args.radius_correction_factor, repeats=args.repeats)
+    if args.graph_dir is not None:
+        results = benchmark_rasterizer(args.graph_dir, dim=args.dim, **kwargs)
+    else:
+        results = benchmark_samples(**kwargs)
+    for r in results:
+        print(f"{r['graph']}: matplotlib {r['matplotlib [s]']:.2f}s, numpy {r['numpy [s]']:.2f}s, speedup {r['speedup']:.1f}x, "
+              f"pixel agreement {r['pixel agreement']:.4f}, density difference {r['density difference [%]']:+.3f}%")
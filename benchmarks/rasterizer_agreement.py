@@ -0,0 +1,116 @@
+"""
+Checks that the numpy rasterizer stays within a fixed tolerance of the matplotlib rasterizer, which is the reference of the summary.
+
+The native graphs of the sample segmentations in `data/src` and of synthetic segmentations (see `benchmarks.synthetic`) are rendered
+with both backends, with the default radius correction of the native backend (0) and of the voreen backend (-1). The check compares
+- the fraction of identical pixels of the white graph images with `MIN_PIXEL_AGREEMENT`, and
+- the densities per radius interval of the summary, `--rasterizer numpy --density_mode single_pass` against `--rasterizer matplotlib`,
+  with `MAX_DENSITY_DIFFERENCE`.
+It exits with an error if any graph is out of tolerance.
+
+Usage (from the repository root):
+    python -m benchmarks.rasterizer_agreement [--radius_thresholds 10,20] [--num_synthetic 2] [--radius_correction_factors 0,-1]
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+
+import numpy as np
+from natsort import natsorted
+from PIL import Image
+
+from benchmarks.synthetic import generate_dataset
+from generate_analysis_summary import process_image_files
+from streaming_pipeline import _density_args
+from utils.native_vesselgraphextraction import build_skeleton_graph
+from utils.vessel_graph import write_graph_files
+from utils.visualizer import generate_image_from_graph_json
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "src")
+# The numpy stamp covers slightly more pixels at disc borders than matplotlib's antialiased circles. On the samples and two synthetic
+# segmentations with the thresholds 10,20 um, at least 99.54% of the pixels agree and the densities of the smallest radius interval
+# are up to 0.18 percentage points higher with a radius correction of -1. Without correction, the differences are below 0.02 percentage
+# points. The tolerances leave a margin above these values.
+MIN_PIXEL_AGREEMENT = 0.99
+MAX_DENSITY_DIFFERENCE = 0.3
+
+
+def compare_densities(seg_file: str, graph_dir: str, thresholds: list[float], mm: float = 3.0, radius_correction_factor: float = 0.0) -> dict:
+    """
+    Extracts the native graph of a segmentation and compares the rasterizers on it.
+
+    Returns:
+        dict: The pixel agreement and, per radius interval, the density of both rasterizers and their difference in percentage points.
+    """
+    ves_seg = np.array(Image.open(seg_file))
+    if ves_seg.ndim == 3:
+        ves_seg = ves_seg[..., 0]
+    name = os.path.basename(seg_file).removesuffix(".png")
+    prefix = os.path.join(graph_dir, name, name)
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    graph_json = build_skeleton_graph(ves_seg)
+    _, edges_df = write_graph_files(graph_json, os.path.dirname(prefix), name)
+
+    images = [
+        generate_image_from_graph_json(graph_json, edges_df, dim=ves_seg.shape[0], image_size_mm=mm, colorize="white",
+                                       radius_correction_factor=radius_correction_factor, backend=backend) > 0
+        for backend in ["matplotlib", "numpy"]
+    ]
+    densities = dict()
+    for rasterizer, density_mode in [("matplotlib", "per_interval"), ("numpy", "single_pass")]:
+        args = _density_args([prefix], seg_file, False, thresholds, mm, radius_correction_factor, 3/6, 3/2.4, rasterizer, density_mode)
+        (dd, _, _), = process_image_files(args)
+        densities[rasterizer] = {title: value for title, value in dd.items() if "Density" in title}
+    return {
+        "segmentation": seg_file,
+        "radius correction factor": radius_correction_factor,
+        "pixel agreement": (images[0] == images[1]).mean(),
+        "densities": {
+            title: (reference, densities["numpy"][title], densities["numpy"][title] - reference)
+            for title, reference in densities["matplotlib"].items()
+        }
+    }
+
+def check_rasterizer_agreement(results: list[dict]) -> list[str]:
+    """
+    Returns:
+        list[str]: A message for each pixel agreement and density of `compare_densities` that is out of tolerance.
+    """
+    failures = []
+    for r in results:
+        if r["pixel agreement"] < MIN_PIXEL_AGREEMENT:
+            failures.append(f"{r['segmentation']} (correction {r['radius correction factor']}): pixel agreement {r['pixel agreement']:.4f} < {MIN_PIXEL_AGREEMENT}")
+        for title, (_, _, difference) in r["densities"].items():
+            if abs(difference) > MAX_DENSITY_DIFFERENCE:
+                failures.append(f"{r['segmentation']} (correction {r['radius correction factor']}): {title} differs by {difference:+.3f} percentage points, more than {MAX_DENSITY_DIFFERENCE}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the agreement of the numpy rasterizer with the matplotlib rasterizer.")
+    parser.add_argument('--image_files', type=str, default=os.path.join(SAMPLE_DIR, "*.png"), help="Glob pattern of the segmentation maps")
+    parser.add_argument('--num_synthetic', type=int, default=2, help="Number of additional synthetic segmentations")
+    parser.add_argument('--radius_thresholds', type=str, default="10,20", help="Comma separated list of radius thresholds [um]")
+    parser.add_argument('--mm', type=float, default=3.0, help="Size of the image in mm")
+    parser.add_argument('--radius_correction_factors', type=str, default="0,-1", help="Comma separated list of additive correction factors for the radius estimation")
+    args = parser.parse_args()
+
+    thresholds = [float(t) for t in args.radius_thresholds.split(",")]
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        seg_files = natsorted(glob.glob(args.image_files))
+        if args.num_synthetic > 0:
+            seg_files += generate_dataset(os.path.join(work_dir, "synthetic"), num_images=args.num_synthetic)
+        for seg_file in seg_files:
+            for radius_correction_factor in [float(c) for c in args.radius_correction_factors.split(",")]:
+                r = compare_densities(seg_file, os.path.join(work_dir, "graphs"), thresholds, args.mm, radius_correction_factor)
+                results.append(r)
+                print(f"{seg_file} (correction {radius_correction_factor}): pixel agreement {r['pixel agreement']:.4f}")
+                for title, (reference, fast, difference) in r["densities"].items():
+                    print(f"  {title}: matplotlib {reference:.3f}%, numpy {fast:.3f}%, difference {difference:+.3f}")
+    failures = check_rasterizer_agreement(results)
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
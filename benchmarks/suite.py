@@ -0,0 +1,175 @@
+"""
+Benchmark suite that measures the duration of each processing stage on synthetic segmentations (see `benchmarks.synthetic`)
+and the end-to-end duration of `pipeline.py`. The Voreen backend is benchmarked with the local stand-in of
+`benchmarks.voreen_standin`, so neither Docker nor Voreen are required. The results are written as JSON, together with the
+commit, the Python version and the parameters, to track performance regressions across releases.
+
+Stages:
+    - convert_2d_to_3d, get_faz_mask_robust and get_ETDRS_grid_indices: once per segmentation.
+    - pipeline[<backend>]: one run of `pipeline.py` with ETDRS analysis per backend, as a subprocess.
+    - generate_image_from_graph_json and process_file_pair: once per graph extracted by the first backend.
+    - process_image_files: once per segmentation, for all its graphs.
+
+Usage (from the repository root):
+    python -m benchmarks.suite --output benchmark.json [--num_images 4] [--size 1216] [--density 0.4] [--backends native voreen]
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from scipy import ndimage
+
+from benchmarks.synthetic import generate_dataset
+from benchmarks.voreen_standin import install_voreen_standin
+from faz_segmentation import get_faz_mask_robust
+from generate_analysis_summary import process_file_pair, process_image_files
+from streaming_pipeline import _density_args
+from utils.convert_2d_to_3d import convert_2d_to_3d
+from utils.ETDRS_grid import get_ETDRS_grid_indices
+from utils.vessel_graph import load_graph_arrays
+from utils.visualizer import generate_image_from_graph_json
+
+PROJECT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _timed(timings: dict[str, list[float]], stage: str, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+def _statistics(durations: list[float]) -> dict[str, float]:
+    return {
+        "n": len(durations),
+        "total [s]": float(np.sum(durations)),
+        "mean [s]": float(np.mean(durations)),
+        "median [s]": float(np.median(durations)),
+        "max [s]": float(np.max(durations))
+    }
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_FOLDER, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_pipeline(source_dir: str, output_dir: str, tmp_dir: str, backend: str, threads: int, voreen_dir: str) -> float:
+    """Runs `pipeline.py` with ETDRS analysis and returns its duration in seconds."""
+    env = dict(os.environ)
+    if backend == "voreen":
+        env["VOREEN_TOOL_PATH"] = voreen_dir
+    command = [
+        sys.executable, os.path.join(PROJECT_FOLDER, "pipeline.py"), "--source_dir", source_dir, "--output_dir", output_dir,
+        "--tmp_dir", tmp_dir, "--backend", backend, "--etdrs", "--etdrs_mode", "split", "--threads", str(threads)
+    ]
+    start = time.perf_counter()
+    subprocess.run(command, cwd=PROJECT_FOLDER, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    duration = time.perf_counter() - start
+    assert os.path.isfile(os.path.join(output_dir, "density_measurements_etdrs.csv")), f"The {backend} pipeline did not write a summary!"
+    return duration
+
+def run_suite(
+        num_images: int = 4,
+        size: int = 1216,
+        density: float = 0.4,
+        z_dim: int = 64,
+        backends: list[str] = ("native", "voreen"),
+        threads: int = cpu_count() - 1,
+        seed: int = 0,
+        work_dir: str = None
+    ) -> dict:
+    """
+    Runs all benchmarks.
+
+    Args:
+        num_images (int): Number of synthetic segmentations.
+        size (int): Height and width of the segmentations in pixels. The FAZ segmentation expects the size of the sample data (1216).
+        density (float): Fraction of vessel pixels.
+        z_dim (int): Z dimension of the volumes generated by `convert_2d_to_3d`.
+        backends (list[str]): Graph extraction backends of the end-to-end runs. The graphs of the first backend are used for the rendering and density stages.
+        threads (int): Number of processes of the end-to-end runs.
+        seed (int): Seed of the synthetic segmentations.
+        work_dir (str): Folder for the dataset and all outputs. A temporary folder is used by default.
+
+    Returns:
+        dict: Environment, parameters and statistics of each stage.
+    """
+    params = dict(num_images=num_images, size=size, density=density, z_dim=z_dim, backends=list(backends), threads=threads, seed=seed)
+    timings = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = work_dir or tmp
+        source_dir = os.path.join(work_dir, "src")
+        image_files = generate_dataset(source_dir, num_images=num_images, size=size, density=density, seed=seed)
+
+        for path in image_files:
+            seg = np.array(Image.open(path))
+            _timed(timings, "convert_2d_to_3d", convert_2d_to_3d, seg, z_dim=z_dim)
+            faz = _timed(timings, "get_faz_mask_robust", get_faz_mask_robust, seg)
+            center = [int(i) for i in ndimage.center_of_mass(faz)]
+            _timed(timings, "get_ETDRS_grid_indices", get_ETDRS_grid_indices, center, size/6, size/2.4)
+
+        voreen_dir = install_voreen_standin(os.path.join(work_dir, "voreen"))
+        for backend in backends:
+            output_dir = os.path.join(work_dir, backend)
+            timings[f"pipeline[{backend}]"] = [run_pipeline(source_dir, output_dir, os.path.join(work_dir, "tmp"), backend, threads, voreen_dir)]
+
+        # The graphs of each segmentation are stored in a folder named after it
+        segmentations = {os.path.basename(p).removesuffix(".png"): p for p in image_files}
+        prefixes = dict()
+        for edges_file in sorted(glob.glob(os.path.join(work_dir, backends[0], "graphs", "**", "*_edges.csv"), recursive=True)):
+            prefix = edges_file.removesuffix("_edges.csv")
+            graph_arrays = load_graph_arrays(f"{prefix}_graph.json")
+            _timed(timings, "generate_image_from_graph_json", generate_image_from_graph_json,
+                   graph_arrays, pd.read_csv(edges_file, sep=";", index_col=0), dim=size)
+            seg_file = segmentations[os.path.basename(os.path.dirname(edges_file))]
+            prefixes.setdefault(seg_file, []).append(prefix)
+            file_pairs, _, *shared_args = _density_args([prefix], seg_file, True, [], 3.0, -1.0, 3/6, 3/2.4, "numpy", "single_pass")
+            _timed(timings, "process_file_pair", process_file_pair, (*file_pairs[0], seg_file, *shared_args))
+        for seg_file, image_prefixes in prefixes.items():
+            _timed(timings, "process_image_files", process_image_files,
+                   _density_args(image_prefixes, seg_file, True, [], 3.0, -1.0, 3/6, 3/2.4, "numpy", "single_pass"))
+
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": cpu_count(),
+        "params": params,
+        "stages": {stage: _statistics(durations) for stage, durations in timings.items()}
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each processing stage on synthetic segmentations.")
+    parser.add_argument('--output', type=str, required=True, help="Path of the JSON result file")
+    parser.add_argument('--num_images', type=int, default=4, help="Number of synthetic segmentations")
+    parser.add_argument('--size', type=int, default=1216, help="Height and width of the segmentations in pixels")
+    parser.add_argument('--density', type=float, default=0.4, help="Fraction of vessel pixels")
+    parser.add_argument('--z_dim', type=int, default=64, help="Z dimension of the generated volumes")
+    parser.add_argument('--backends', type=str, nargs="+", choices=["native", "voreen"], default=["native", "voreen"],
+                        help="Graph extraction backends of the end-to-end runs. The Voreen backend uses the local stand-in.")
+    parser.add_argument('--threads', type=int, default=cpu_count() - 1, help="Number of processes of the end-to-end runs")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic segmentations")
+    parser.add_argument('--work_dir', type=str, default=None, help="Folder for the dataset and outputs. Uses a temporary folder by default.")
+    args = parser.parse_args()
+
+    results = run_suite(
+        num_images=args.num_images, size=args.size, density=args.density, z_dim=args.z_dim, backends=args.backends,
+        threads=args.threads, seed=args.seed, work_dir=args.work_dir
+    )
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    for stage, stats in results["stages"].items():
+        print(f"{stage}: {stats['n']}x, mean {stats['mean [s]']:.3f}s, max {stats['max [s]']:.3f}s")
@@ -0,0 +1,78 @@
+"""
+Synthetic vessel segmentations for benchmarks.
+
+Each segmentation is a network of random smooth vessels of random width, drawn until the requested fraction of vessel
+pixels is reached. An avascular disc around a randomly shifted center models the FAZ.
+
+Usage (from the repository root):
+    python -m benchmarks.synthetic --output_dir /tmp/synthetic [--num_images 8] [--size 1216] [--density 0.4]
+"""
+import argparse
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def synthetic_segmentation(size: int = 1216, density: float = 0.4, faz_radius: float = 0.08, seed: int = 0) -> np.ndarray:
+    """
+    Generates a synthetic 2D vessel segmentation.
+
+    Args:
+        size (int): Height and width of the segmentation in pixels.
+        density (float): Target fraction of vessel pixels in (0, 1).
+        faz_radius (float): Radius of the avascular zone relative to the image size.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        np.ndarray: uint8 segmentation with values 0 and 255.
+    """
+    assert 0 < density < 1, "The density must be in (0, 1)."
+    rng = np.random.default_rng(seed)
+    seg = np.zeros((size, size), dtype=np.uint8)
+    center = (size / 2 + rng.normal(0, size / 30, size=2)).astype(int)
+    radius = int(faz_radius * size)
+    faz = np.zeros_like(seg)
+    cv2.circle(faz, (int(center[1]), int(center[0])), radius, 1, thickness=-1)
+
+    max_width = max(2, size // 150)
+    while (seg > 0).mean() < density * (1 - faz.mean()):
+        # Each vessel is a random walk with a smoothly changing direction
+        width = int(rng.integers(1, max_width + 1))
+        steps = int(rng.integers(size // 20, size // 4))
+        direction = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.08, size=steps))
+        step_size = max(1.0, size / 600)
+        start = rng.uniform(0, size, size=2)
+        points = start + np.cumsum(step_size * np.stack([np.sin(direction), np.cos(direction)], axis=1), axis=0)
+        cv2.polylines(seg, [points[:, ::-1].round().astype(np.int32).reshape(-1, 1, 2)], isClosed=False, color=255, thickness=width)
+        seg[faz == 1] = 0
+    return seg
+
+def generate_dataset(output_dir: str, num_images: int = 8, size: int = 1216, density: float = 0.4, seed: int = 0) -> list[str]:
+    """
+    Writes synthetic DVC segmentations named like the sample data, e.g. `synthetic_0000_OD_dvc.png`.
+
+    Returns:
+        list[str]: Paths of the segmentations.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(num_images):
+        path = os.path.join(output_dir, f"synthetic_{i:04d}_{'OD' if i % 2 == 0 else 'OS'}_dvc.png")
+        Image.fromarray(synthetic_segmentation(size=size, density=density, seed=seed + i)).save(path)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic vessel segmentations.")
+    parser.add_argument('--output_dir', type=str, required=True, help="Folder for the segmentations")
+    parser.add_argument('--num_images', type=int, default=8, help="Number of segmentations")
+    parser.add_argument('--size', type=int, default=1216, help="Height and width of the segmentations in pixels")
+    parser.add_argument('--density', type=float, default=0.4, help="Fraction of vessel pixels")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the first segmentation")
+    args = parser.parse_args()
+
+    for path in generate_dataset(args.output_dir, num_images=args.num_images, size=args.size, density=args.density, seed=args.seed):
+        print(path)
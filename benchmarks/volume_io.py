@@ -0,0 +1,123 @@
+"""
+Measures the peak resident set size of a worker that writes the masked ETDRS sector volumes of one segmentation for Voreen.
+Compares the former approach, which copies and masks the full volume per sector and saves it with nibabel,
+with the slab-wise writer of `utils.volume_io`, and checks that both write identical files.
+With `--nifti`, also compares the 2D projection of the NIFTI volumes via `get_fdata` with `utils.volume_io.load_2d_segmentation`.
+Each measurement runs in a fresh process. The peak RSS is measured relative to the RSS after the imports and requires Linux.
+
+Usage (from the repository root):
+    python -m benchmarks.volume_io [--image_files "data/src/*.png"] [--z_dim 64] [--nifti]
+"""
+import argparse
+import filecmp
+import glob
+import multiprocessing
+import os
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+from natsort import natsorted
+from PIL import Image
+
+from utils.convert_2d_to_3d import convert_2d_to_3d
+from utils.ETDRS_grid import get_ETDRS_grid_masks
+from utils.volume_io import SlabVolume, default_nifti_header, load_2d_segmentation, write_nifti
+
+
+def _reset_peak_rss():
+    """Resets the peak RSS (VmHWM) of this process to its current RSS. Requires Linux."""
+    with open("/proc/self/clear_refs", "w") as file:
+        file.write("5")
+
+def _rss_mb(field: str) -> float:
+    with open("/proc/self/status") as file:
+        return next(int(line.split()[1]) for line in file if line.startswith(field + ":")) / 2**10
+
+def _sector_masks(shape: tuple[int, int]) -> dict[str, np.ndarray]:
+    masks = get_ETDRS_grid_masks(np.ones(shape, dtype=np.uint8), center_radius=shape[0]/6, inner_radius=shape[0]/2.4)
+    return dict(zip(["C0", "S1", "N1", "I1", "T1"], masks))
+
+def _write_sectors(path: str, output_dir: str, method: str, z_dim: int) -> tuple[float, float]:
+    """Writes the sector volumes of a segmentation and returns the RSS increase in MB and the duration."""
+    _reset_peak_rss()
+    baseline = _rss_mb("VmRSS")
+    start = time.perf_counter()
+    if method == "copy":
+        if path.endswith(".nii"):
+            nifti = nib.load(path)
+            ves_seg_3d, header = np.asarray(nifti.dataobj), nifti.header
+        else:
+            ves_seg_3d = convert_2d_to_3d(np.array(Image.open(path), np.uint8), z_dim=z_dim)
+            header = default_nifti_header(ves_seg_3d.shape)
+        for suffix, mask in _sector_masks(ves_seg_3d.shape[:2]).items():
+            ves_seg_masked = np.copy(ves_seg_3d)
+            ves_seg_masked[~mask,:] = 0
+            nib.save(nib.Nifti1Image(ves_seg_masked, header.get_best_affine(), header=header), os.path.join(output_dir, f"{suffix}.nii"))
+    else:
+        volume, header = SlabVolume.from_file(path, z_dim=z_dim)
+        for suffix, mask in _sector_masks(volume.shape[:2]).items():
+            write_nifti(volume.masked(mask), os.path.join(output_dir, f"{suffix}.nii"), header)
+    return _rss_mb("VmHWM") - baseline, time.perf_counter() - start
+
+def _project(path: str, method: str) -> tuple[float, float, np.ndarray]:
+    """Computes the 2D projection of a NIFTI volume and returns the RSS increase in MB, the duration and the projection."""
+    _reset_peak_rss()
+    baseline = _rss_mb("VmRSS")
+    start = time.perf_counter()
+    if method == "get_fdata":
+        projection = np.max(nib.load(path).get_fdata(), axis=-1)
+    else:
+        projection = load_2d_segmentation(path)
+    return _rss_mb("VmHWM") - baseline, time.perf_counter() - start, projection
+
+def benchmark_volume_io(image_files: str, z_dim: int = 64, nifti: bool = False) -> list[dict]:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path in natsorted(glob.glob(image_files, recursive=True)):
+            if nifti:
+                # Benchmark the NIFTI input path with the inflated 2D segmentation
+                nifti_path = os.path.join(tmp_dir, os.path.basename(path).split(".")[0] + ".nii")
+                nib.save(nib.Nifti1Image(convert_2d_to_3d(np.array(Image.open(path), np.uint8), z_dim=z_dim), np.eye(4)), nifti_path)
+                path = nifti_path
+            result = {"image": path}
+            if nifti:
+                projections = []
+                for method in ["get_fdata", "slab"]:
+                    with context.Pool(1) as pool:
+                        rss, duration, projection = pool.apply(_project, (path, method))
+                    projections.append(projection)
+                    result[f"{method} projection peak RSS [MB]"] = rss
+                    result[f"{method} projection [s]"] = duration
+                assert np.array_equal(*projections), f"The projections of {path} differ!"
+            for method in ["copy", "slab"]:
+                output_dir = os.path.join(tmp_dir, method)
+                os.makedirs(output_dir, exist_ok=True)
+                with context.Pool(1) as pool:
+                    rss, duration = pool.apply(_write_sectors, (path, output_dir, method, z_dim))
+                result[f"{method} peak RSS [MB]"] = rss
+                result[f"{method} [s]"] = duration
+            _, mismatch, errors = filecmp.cmpfiles(
+                os.path.join(tmp_dir, "copy"), os.path.join(tmp_dir, "slab"), os.listdir(os.path.join(tmp_dir, "copy")), shallow=False
+            )
+            result["identical"] = not mismatch and not errors
+            assert result["identical"], f"The sector volumes of {path} differ!"
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the peak memory of writing masked ETDRS sector volumes.")
+    parser.add_argument('--image_files', type=str, default="data/src/*.png", help="Glob pattern of the 2D segmentation maps")
+    parser.add_argument('--z_dim', type=int, default=64, help="Z dimension of the generated volume")
+    parser.add_argument('--nifti', action="store_true", help="Convert the segmentations to 3D NIFTI files first and benchmark the NIFTI input path")
+    args = parser.parse_args()
+
+    for r in benchmark_volume_io(args.image_files, z_dim=args.z_dim, nifti=args.nifti):
+        print(f"{r['image']}: copy {r['copy peak RSS [MB]']:.0f}MB in {r['copy [s]']:.2f}s, "
+              f"slab {r['slab peak RSS [MB]']:.0f}MB in {r['slab [s]']:.2f}s, identical: {r['identical']}")
+        if args.nifti:
+            print(f"    projection: get_fdata {r['get_fdata projection peak RSS [MB]']:.0f}MB in {r['get_fdata projection [s]']:.2f}s, "
+                  f"slab {r['slab projection peak RSS [MB]']:.0f}MB in {r['slab projection [s]']:.2f}s")
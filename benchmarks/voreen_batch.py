@@ -0,0 +1,72 @@
+"""
+Measures the per-image cost of the Voreen graph extraction for different numbers of volumes per voreentool run.
+The difference between the batch sizes is the startup and workspace deserialization overhead that batching amortizes.
+Requires docker and the Voreen image (see README), or a local voreentool in `VOREEN_TOOL_PATH`, e.g. the stand-in of `benchmarks.voreen_standin`.
+
+Usage (from the repository root):
+    python -m benchmarks.voreen_batch --image_files '/path/to/segmentations/*.png' --output_dir /tmp/voreen_batch [--batch_sizes 1,8,64]
+"""
+import argparse
+import glob
+import os
+import shutil
+import time
+
+from natsort import natsorted
+
+import graph_feature_extractor
+from graph_feature_extractor import _start_voreen_container, _stop_voreen_container, voreen_batch_graphs
+
+
+def benchmark_voreen_batch(
+        image_files: list[str],
+        output_dir: str,
+        tmp_dir: str,
+        batch_sizes: list[int] = [1, 8, 64],
+        voreen_image_name: str = "voreen",
+        verbose: bool = False
+    ) -> list[dict]:
+    source_dir = os.path.dirname(os.path.commonprefix(image_files))
+    os.makedirs(tmp_dir, exist_ok=True)
+    container_name, graph_feature_extractor.DOCKER_WORK_DIR = _start_voreen_container(tmp_dir, source_dir, output_dir, voreen_image_name, verbose=verbose)
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir)
+            start = time.perf_counter()
+            graphs = voreen_batch_graphs(
+                image_files, source_dir=source_dir, tmp_dir=tmp_dir, output_dir=output_dir,
+                container_name=container_name, graph_image=False, verbose=verbose, voreen_batch_size=batch_size
+            )
+            duration = time.perf_counter() - start
+            results.append({
+                "batch size": batch_size,
+                "images": len(image_files),
+                "failed": len(image_files) - len(graphs),
+                "total [s]": duration,
+                "per image [s]": duration / len(image_files)
+            })
+    finally:
+        # No container is started if a local voreentool is used
+        if container_name is not None:
+            _stop_voreen_container(container_name, tmp_dir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched voreentool runs.")
+    parser.add_argument('--image_files', type=str, required=True, help="Glob pattern of the segmentation maps. Use at least as many images as the largest batch size.")
+    parser.add_argument('--output_dir', type=str, required=True, help="Folder for the extracted graphs. It is cleared before each run.")
+    parser.add_argument('--tmp_dir', type=str, default="/var/tmp", help="Temporary directory shared with the Voreen container")
+    parser.add_argument('--batch_sizes', type=str, default="1,8,64", help="Comma separated list of batch sizes")
+    parser.add_argument('--voreen_image_name', type=str, default="voreen", help="Name of the Voreen docker image")
+    parser.add_argument('--verbose', action="store_true", help="Print log information from voreen")
+    args = parser.parse_args()
+
+    image_files = natsorted(glob.glob(args.image_files, recursive=True))
+    assert image_files, f"Found no files matching {args.image_files}!"
+    for r in benchmark_voreen_batch(image_files, args.output_dir, args.tmp_dir, [int(b) for b in args.batch_sizes.split(",")],
+                                    voreen_image_name=args.voreen_image_name, verbose=args.verbose):
+        print(f"batch size {r['batch size']:>3}: {r['total [s]']:.1f}s for {r['images']} images ({r['failed']} failed), "
+              f"{r['per image [s]']:.2f}s per image")
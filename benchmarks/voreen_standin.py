@@ -0,0 +1,90 @@
+"""
+Local stand-in for `voreentool`, so that the Voreen backend can be benchmarked without Docker or a Voreen installation.
+
+The stand-in reads the workspace written by `utils.voreen_vesselgraphextraction.write_voreen_workspace` and processes every
+processing chain in it: it extracts the graph of the input volume with the native backend and writes the nodes and edges CSV
+files, the graph (`.vvg`, Voreen's graph JSON schema) and the `sample.h5` volume to the paths configured in the workspace.
+The environment variable `VOREEN_STANDIN_STARTUP` adds a fixed startup latency in seconds to each run, e.g. to model the cost
+of starting Voreen when benchmarking batch sizes.
+
+Usage:
+    voreen_dir = install_voreen_standin("/tmp/voreen")
+    os.environ["VOREEN_TOOL_PATH"] = voreen_dir  # graph_feature_extractor then runs the stand-in instead of Docker
+"""
+import argparse
+import json
+import os
+import stat
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import h5py
+import numpy as np
+
+from utils.native_vesselgraphextraction import build_skeleton_graph
+from utils.vessel_graph import graph_to_tables
+from utils.volume_io import SlabVolume
+
+
+def _chains(workspace_file: str) -> list[dict]:
+    """Input and output paths of each processing chain of a workspace."""
+    root = ET.parse(workspace_file).getroot()
+    processors = [p for p in root.iter("Processor") if p.get("id")]
+
+    def items(processor_type: str) -> list[list[str]]:
+        return [[i.get("value") for i in p.iter("item") if i.get("value")] for p in processors if p.get("type") == processor_type]
+
+    return [
+        {"volume": volume[0], "graph": graph[0], "nodes": stats[0], "edges": stats[1], "h5": h5[0]}
+        for volume, graph, stats, h5 in zip(items("VolumeSource"), items("VesselGraphSave"), items("VesselGraphGlobalStats"), items("VolumeSave"))
+    ]
+
+def run_chain(chain: dict):
+    volume = SlabVolume.from_file(chain["volume"])[0]
+    projection = volume.max_projection()
+    graph = build_skeleton_graph(np.asarray(projection > 0, np.uint8) * 255, z_dim=volume.shape[2])
+    df_nodes, df_edges = graph_to_tables(graph)
+    df_nodes.to_csv(chain["nodes"], sep=";")
+    df_edges.to_csv(chain["edges"], sep=";")
+    with open(chain["graph"], "w") as file:
+        json.dump(graph, file)
+    # Voreen saves the filtered volume with a channel axis. The stand-in saves the projection instead of the full volume.
+    with h5py.File(chain["h5"], "w") as file:
+        file["volume"] = np.stack([projection, projection])[..., np.newaxis]
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Stand-in for voreentool.")
+    parser.add_argument('--workspace', type=str, required=True)
+    parser.add_argument('--workdir', type=str)
+    parser.add_argument('--tempdir', type=str)
+    parser.add_argument('--cachedir', type=str)
+    parser.add_argument('--logLevel', type=str)
+    args, _ = parser.parse_known_args(argv)
+
+    time.sleep(float(os.getenv("VOREEN_STANDIN_STARTUP", "0")))
+    for chain in _chains(args.workspace):
+        run_chain(chain)
+
+def install_voreen_standin(directory: str) -> str:
+    """
+    Writes an executable `voreentool` that runs the stand-in with the current interpreter.
+
+    Returns:
+        str: The directory, to be used as `VOREEN_TOOL_PATH`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "voreentool")
+    project_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(path, "w") as file:
+        file.write(f"#!{sys.executable}\n"
+                   f"import sys\n"
+                   f"sys.path.insert(0, {project_folder!r})\n"
+                   f"from benchmarks.voreen_standin import main\n"
+                   f"main()\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
+
+
+if __name__ == "__main__":
+    main()
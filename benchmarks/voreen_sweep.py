@@ -0,0 +1,108 @@
+"""
+Checks and times the bulge size sweep of `graph_feature_extractor.perform_graph_feature_extraction` with the Voreen stand-in
+(see `benchmarks.voreen_standin`), so no docker is needed.
+
+The sample segmentations are extracted with masked ETDRS sectors, once with a single bulge size and once as a sweep. The check fails if
+- the edge table of any sector of the single run is empty,
+- the graph files of any bulge size of the sweep differ from the single run (the stand-in ignores the bulge size), or
+- with `--reference_dir`, the graph files of the single run differ from the ones in that folder, e.g. the `graphs` folder
+  of a pipeline run of an earlier version.
+
+Usage (from the repository root):
+    python -m benchmarks.voreen_sweep [--image_files "data/src/*.png"] [--bulge_sizes 2,3,4] [--reference_dir /path/to/graphs]
+"""
+import argparse
+import filecmp
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks.voreen_standin import install_voreen_standin
+from faz_segmentation import perform_faz_segmentation
+from graph_feature_extractor import perform_graph_feature_extraction, sweep_output_dir
+
+GRAPH_FILES = ["_edges.csv", "_nodes.csv", "_graph.json"]
+
+
+def _graph_files(graph_dir: str) -> list[str]:
+    """Graph files in a folder, relative to it."""
+    return sorted(
+        os.path.relpath(path, graph_dir) for path in glob.glob(os.path.join(graph_dir, "**", "*"), recursive=True)
+        if any(path.endswith(suffix) for suffix in GRAPH_FILES)
+    )
+
+def _compare(graph_dir: str, reference_dir: str) -> list[str]:
+    """Messages for each graph file that is missing or differs in `graph_dir` compared to `reference_dir`."""
+    failures = []
+    for file in _graph_files(reference_dir):
+        path = os.path.join(graph_dir, file)
+        if not os.path.isfile(path):
+            failures.append(f"{path} is missing")
+        elif not filecmp.cmp(path, os.path.join(reference_dir, file), shallow=False):
+            failures.append(f"{path} differs from {os.path.join(reference_dir, file)}")
+    return failures
+
+def check_voreen_sweep(image_files: str, work_dir: str, bulge_sizes: list[float], reference_dir: str = None, threads: int = 1) -> tuple[dict, list[str]]:
+    """
+    Returns:
+        tuple[dict, list[str]]: The runtime of the single run and of the sweep, and a message per failed check.
+    """
+    os.environ["VOREEN_TOOL_PATH"] = install_voreen_standin(os.path.join(work_dir, "voreen"))
+    tmp_dir = os.path.join(work_dir, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    perform_faz_segmentation(source_files=image_files, output_dir=os.path.join(work_dir, "faz"), threads=threads)
+    kwargs = dict(
+        tmp_dir=tmp_dir, image_files=image_files, faz_dir=os.path.join(work_dir, "faz"), etdrs=True, etdrs_mode="masked",
+        backend="voreen", graph_image=False, threads=threads
+    )
+
+    timings = dict()
+    start = time.perf_counter()
+    single_dir = os.path.join(work_dir, "single")
+    perform_graph_feature_extraction(output_dir=single_dir, bulge_size=bulge_sizes[0], **kwargs)
+    timings["single [s]"] = time.perf_counter() - start
+    start = time.perf_counter()
+    sweep_dir = os.path.join(work_dir, "sweep")
+    perform_graph_feature_extraction(output_dir=sweep_dir, bulge_sizes=",".join(str(b) for b in bulge_sizes), **kwargs)
+    timings["sweep [s]"] = time.perf_counter() - start
+
+    failures = []
+    edge_files = glob.glob(os.path.join(single_dir, "**", "*_edges.csv"), recursive=True)
+    if not edge_files:
+        failures.append(f"No graphs were extracted to {single_dir}")
+    for edge_file in edge_files:
+        if pd.read_csv(edge_file, sep=";", index_col=0).empty:
+            failures.append(f"{edge_file} has no edges")
+    for bulge_size in bulge_sizes:
+        failures.extend(_compare(sweep_output_dir(sweep_dir, bulge_size), single_dir))
+    if reference_dir is not None:
+        failures.extend(_compare(single_dir, reference_dir))
+    return timings, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the bulge size sweep with the Voreen stand-in.")
+    parser.add_argument('--image_files', type=str, default="data/src/*.png", help="Glob pattern of the segmentation maps")
+    parser.add_argument('--bulge_sizes', type=str, default="2,3,4", help="Comma separated list of bulge sizes")
+    parser.add_argument('--reference_dir', type=str, default=None, help="Folder with graphs of masked ETDRS sectors to compare the single run with")
+    parser.add_argument('--work_dir', type=str, default=None, help="Folder for the outputs. A temporary folder is used and removed by default.")
+    parser.add_argument('--threads', type=int, default=1, help="Number of parallel threads")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="voreen_sweep_")
+    try:
+        timings, failures = check_voreen_sweep(
+            args.image_files, work_dir, [float(b) for b in args.bulge_sizes.split(",")], args.reference_dir, threads=args.threads
+        )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"single run {timings['single [s]']:.1f}s, sweep over {args.bulge_sizes} {timings['sweep [s]']:.1f}s")
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
@@ -4,15 +4,19 @@ import os
 from functools import partial
 from math import inf
 from multiprocessing import cpu_count
+from typing import Literal
 
 import cv2
-import nibabel as nib
 import numpy as np
 from natsort import natsorted
 from PIL import Image
 from scipy import ndimage
 from skimage.morphology import skeletonize
 from tqdm import tqdm
+from utils.file_io import atomic_path, copy_file
+from utils.manifest import Manifest, image_id
+from utils.profiling import span
+from utils.volume_io import load_2d_segmentation
 
 
 def keep_largest_connected_component(image: np.ndarray) -> np.ndarray:
@@ -35,14 +39,65 @@ def keep_largest_connected_component(image: np.ndarray) -> np.ndarray:
     output = (labeled == largest_label).astype(image.dtype)
     return output
 
-def get_faz_mask_robust(img_orig: np.ndarray) -> np.ndarray:
-    for border in [600,500,400,300,200, 100]:
-        faz = get_faz_mask(img_orig, border)
+FAZ_BORDERS = [600, 500, 400, 300, 200, 100]
+
+def get_faz_mask_robust(img_orig: np.ndarray, engine: Literal["shared", "reference"] = "shared") -> np.ndarray:
+    """
+    Segments the FAZ with the largest border (see `get_faz_mask`) for which the FAZ does not touch the border.
+
+    Parameters:
+        img_orig (np.ndarray): 2D vessel segmentation.
+        engine (Literal["shared", "reference"]): Implementation used to evaluate the borders.
+            - "shared": Computes the border-independent skeleton of the blurred segmentation once and evaluates each border on the
+              interior of the border only. Thinning the border region dominated the runtime of the reference implementation.
+              The skeleton of vessels close to the border may differ, see `python -m benchmarks.faz_segmentation` for the agreement.
+            - "reference": Calls `get_faz_mask` for each border.
+    Returns:
+        faz (np.ndarray): Binary float32 FAZ mask.
+    """
+    if engine == "reference":
+        faz_mask = partial(get_faz_mask, img_orig)
+    elif engine == "shared":
+        faz_mask = partial(_get_faz_mask_shared, _shared_faz_features(img_orig))
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+    for border in FAZ_BORDERS:
+        faz = faz_mask(border)
         if (faz[border+1,:]).any() or (faz[-border-1,:]).any() or (faz[:,border+1]).any() or (faz[:, -border-1]).any():
             continue
         return faz
     return faz
 
+def _blur(img: np.ndarray, out_shape: list[int]) -> np.ndarray:
+    """Down- and upsampling round trip of `get_faz_mask`."""
+    img_down = cv2.resize(img, dsize=out_shape, interpolation=cv2.INTER_AREA)
+    return cv2.resize(img_down, dsize=img.shape, interpolation=cv2.INTER_LINEAR)
+
+def _shared_faz_features(img_orig: np.ndarray) -> dict:
+    """
+    Computes the parts of `get_faz_mask` that do not depend on the border: the normalized segmentation and the skeleton of its blurred version.
+    """
+    img = img_orig/255
+    out_shape = [int(.16 * d) for d in img.shape[-2:]]
+    return {"img": img, "out_shape": out_shape, "skeleton": skeletonize(_blur(img, out_shape) > 0, method='zhang')}
+
+def _get_faz_mask_shared(features: dict, BORDER: int) -> np.ndarray:
+    """
+    Equivalent of `get_faz_mask` based on the precomputed `_shared_faz_features`.
+    The border pixels are vessel pixels, so the FAZ candidates are the connected components of the interior.
+    """
+    img, out_shape, img_skel = features["img"], features["out_shape"], features["skeleton"]
+    interior = (slice(BORDER, img.shape[0]-BORDER), slice(BORDER, img.shape[1]-BORDER))
+    faz = np.zeros(img.shape, dtype=np.float32)
+    faz[interior] = keep_largest_connected_component((1-img[interior]).astype(np.float32))
+
+    faz_larger = _blur(faz, out_shape) > 0
+    img_merged = np.ones_like(img)
+    img_merged[faz_larger] = np.maximum(img[faz_larger], img_skel[faz_larger])
+    img_merged[:BORDER] = img_merged[-BORDER:] = img_merged[:,:BORDER] = img_merged[:,-BORDER:] = 1
+
+    return keep_largest_connected_component((1-img_merged).astype(np.float32))
+
 def get_faz_mask(img_orig: np.ndarray, BORDER=200) -> np.ndarray:
     img = np.copy(img_orig)
     img[:BORDER] = img[-BORDER:] = img[:,:BORDER]= img[:,-BORDER:] = 255
@@ -72,41 +127,88 @@ def get_faz_mask(img_orig: np.ndarray, BORDER=200) -> np.ndarray:
     faz_final = keep_largest_connected_component(img_inverted)
     return faz_final
 
-def task(path: str, source_folder: str, output_dir: str):
+def faz_output_path(path: str, source_folder: str, output_dir: str) -> str:
+    path = path.replace(".nii.gz", ".png")
     name = path.split("/")[-1]
-    if path.endswith(".nii.gz"):
-        nifti: nib.Nifti1Image = nib.load(path)
-        image_3d = nifti.get_fdata()
-        img_orig = np.max(image_3d, axis=-1)
-        path = path.replace(".nii.gz", ".png")
-    else:
-        img_orig = np.array(Image.open(path))
-    faz_final = get_faz_mask_robust(img_orig)
+    return path.replace(source_folder, output_dir).replace(name, "faz_"+name)
+
+def task(path: str, source_folder: str, output_dir: str, engine: Literal["shared", "reference"] = "shared"):
+    # 3D volumes are reduced by a maximum projection in their native data type
+    img_orig = load_2d_segmentation(path)
+    with span("faz_mask", image=image_id(path)):
+        faz_final = get_faz_mask_robust(img_orig, engine=engine)
 
     img_and_faz = np.zeros_like(img_orig)
     img_and_faz[(faz_final==1) & (img_and_faz==0)]=255
-    out_path = path.replace(source_folder, output_dir).replace(name, "faz_"+name)
+    out_path = faz_output_path(path, source_folder, output_dir)
     out_dir = "/".join(out_path.split("/")[:-1])
     
     os.makedirs(out_dir, exist_ok=True)
-    Image.fromarray(img_and_faz.astype(np.uint8)).save(out_path)
-
-def perform_faz_segmentation(source_files: str, output_dir: str, threads: int = -1, num_samples: int = inf):
-    data_files: list[str] = natsorted(glob.glob(source_files, recursive=True))
+    with atomic_path(out_path) as tmp_path:
+        Image.fromarray(img_and_faz.astype(np.uint8)).save(tmp_path)
+    return out_path
+
+def perform_faz_segmentation(
+        source_files: str,
+        output_dir: str,
+        threads: int = -1,
+        num_samples: int = inf,
+        manifest: str = None,
+        incremental: bool = False,
+        engine: Literal["shared", "reference"] = "shared"):
+    """
+    Segments the FAZ of all given vessel segmentations and stores the FAZ masks as `faz_<name>.png` in the output directory.
+
+    Args:
+        source_files (str): Glob pattern of the vessel segmentations. Ignored if a manifest is given.
+        output_dir (str): Output directory. The folder structure of the source files is preserved.
+        threads (int): Number of parallel processes.
+        num_samples (int): Maximum number of samples to process.
+        manifest (str): Path of a dataset manifest (see `utils.manifest.Manifest`). If given, the vessel segmentations are taken from
+            the manifest and the FAZ masks are registered in it.
+        incremental (bool): Skip segmentations whose content did not change since their last FAZ segmentation
+            and segment byte-identical segmentations only once. Requires a manifest.
+        engine (Literal["shared", "reference"]): FAZ segmentation engine, see `get_faz_mask_robust`.
+    """
+    assert manifest is not None or not incremental, "Incremental processing requires a manifest!"
+    dataset = Manifest(manifest) if manifest is not None else None
+    data_files: list[str] = dataset.segmentations() if dataset is not None else natsorted(glob.glob(source_files, recursive=True))
     source_folder = os.path.dirname(os.path.commonprefix(data_files))
+    faz_files = dict()
+    duplicates = dict()
+    if incremental:
+        fingerprints, faz_files, data_files, duplicates = dataset.plan_incremental(
+            "faz", {path: [path] for path in data_files}, params={"engine": engine}, is_complete=os.path.isfile
+        )
+        if faz_files:
+            print(f"Skipping {len(faz_files)} unchanged images.")
 
     if threads>1:
         # Multi processing
         with tqdm(total=min(num_samples, len(data_files)), desc="Segmenting FAZ...") as pbar:
             with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
-                future_dict = {executor.submit(partial(task, source_folder=source_folder, output_dir=output_dir), data_files[i]): i for i in range(len(data_files))}
-                for _ in concurrent.futures.as_completed(future_dict):
+                future_dict = {executor.submit(partial(task, source_folder=source_folder, output_dir=output_dir, engine=engine), data_files[i]): i for i in range(len(data_files))}
+                for future in concurrent.futures.as_completed(future_dict):
+                    faz_files[data_files[future_dict[future]]] = future.result()
                     pbar.update(1)
-    else:
+    elif data_files:
         if data_files[0].endswith(".nii.gz"):
             print("Warning: 3D volumes are not recommended for FAZ segmentation! For optimal results use 2D segmentations instead!")
         for path in tqdm(data_files, desc="Segmenting FAZ..."):
-            task(path, source_folder=source_folder, output_dir=output_dir)
+            faz_files[path] = task(path, source_folder=source_folder, output_dir=output_dir, engine=engine)
+
+    # Byte-identical segmentations share the FAZ of the first one
+    for path, source in duplicates.items():
+        faz_files[path] = faz_output_path(path, source_folder, output_dir)
+        os.makedirs(os.path.dirname(faz_files[path]), exist_ok=True)
+        copy_file(faz_files[source], faz_files[path])
+
+    if dataset is not None:
+        if incremental:
+            for path in [*data_files, *duplicates.keys()]:
+                dataset.record("faz", path, fingerprints[path], faz_files[path])
+        dataset.add_faz(natsorted(faz_files.values()))
+        dataset.close()
 
 if __name__ == "__main__":
     import argparse
@@ -115,6 +217,9 @@ if __name__ == "__main__":
     parser.add_argument('--output_dir', help="Absolute path to the folder where the faz segmentation files wil be stored.", type=str, default=None)
     parser.add_argument('--threads', help="Number of parallel threads. By default all available threads but one are used.", type=int, default=max(1,cpu_count()-1))
     parser.add_argument('--num_samples', help="Maximum number of samples to process.", type=int, default=inf)
+    parser.add_argument('--manifest', help="Path to a dataset manifest. If given, the segmentation maps are taken from the manifest instead of --source_files.", type=str, default=None)
+    parser.add_argument('--incremental', help="Skip images whose FAZ segmentation is up to date. Requires --manifest.", action="store_true")
+    parser.add_argument('--engine', help="'shared' computes the skeleton once for all border candidates. 'reference' recomputes the full segmentation per candidate.", choices=["shared", "reference"], default="shared")
     args = parser.parse_args()
 
-    perform_faz_segmentation(args.source_files, args.output_dir, threads=args.threads, num_samples=args.num_samples)
+    perform_faz_segmentation(args.source_files, args.output_dir, threads=args.threads, num_samples=args.num_samples, manifest=args.manifest, incremental=args.incremental, engine=args.engine)
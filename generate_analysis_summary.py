@@ -1,6 +1,9 @@
+import functools
 import glob
+import importlib.util
 import os
 from multiprocessing import Pool, cpu_count
+from typing import Literal
 
 import numpy as np
 import pandas as pd
@@ -9,34 +12,12 @@ from numpy import nan
 from PIL import Image
 from tqdm import tqdm
 from utils.ETDRS_grid import get_ETDRS_grid_masks
-from utils.visualizer import generate_image_from_graph_json
-
-
-def remove_plexus_code(name: str):
-    """Remove plexus layer codes from filename."""
-    for code in ["_DCP", "_dcp", "_DVC", "_dvc", "_SCP", "_scp", "_SVC", "_svc"]:
-        name = name.replace(code, "")
-    return name
-
-def remove_eye_code(name: str):
-    """Remove eye codes (OS/OD) from filename."""
-    return name.replace("_OS", "").replace("_OD", "")
-
-
-def remove_extensions(basename: str):
-    """Remove file extensions and suffixes from basename."""
-    return basename.replace(" .", ".").removesuffix(".png").removesuffix("_edges.csv").removesuffix("_full")
-
-
-def code_name(path: str):
-    """Extract standardized code name from file path."""
-    return (remove_prefixes(remove_plexus_code(remove_extensions(os.path.basename(path))).removeprefix("faz_"))
-            .replace(" OCTA", "")
-            .replace(" ", "_")
-            .replace("__", "_"))
-
-def remove_prefixes(name: str):
-    return name.removeprefix("model_").removeprefix("pred_")
+from utils.file_io import atomic_path, atomic_write
+from utils.manifest import Manifest, code_name, image_id, remove_eye_code, remove_extensions, remove_plexus_code, remove_prefixes
+from utils.profiling import SPANS, image_timings, profile_dir, span
+from utils.vessel_graph import load_graph_arrays
+from utils.visualizer import generate_edge_coverage_from_graph_json, generate_image_from_graph_json, generate_interval_map_from_graph_json
+from utils.volume_io import load_2d_segmentation
 
 
 def generate_density_title(area: str, lower: int, upper: int) -> str:
@@ -51,21 +32,142 @@ def generate_density_title(area: str, lower: int, upper: int) -> str:
     return title
 
 
-def process_file_pair(args_tuple):
-    """Process a single file pair for parallel execution."""
-    (data_file, graph_file, segmentation_files, faz_map, AREA_FACTOR_MAP, 
-     THRESHOLDS, thresholds, args_etdrs, args_mm, args_radius_correction_factor, faz_shape) = args_tuple
-    
+def interval_pixel_sums(interval_map: np.ndarray, seg_img: np.ndarray, num_intervals: int) -> list[float]:
+    """
+    Computes the number of segmented pixels of each radius interval from a bitmask map as generated by `generate_interval_map_from_graph_json`.
+    Pixels that belong to multiple intervals contribute equally to each of them.
+
+    Args:
+        interval_map (np.ndarray): Bitmask map. Bit k is set if the pixel belongs to the k-th interval.
+        seg_img (np.ndarray): Segmentation map. Only pixels with non-zero values are counted.
+        num_intervals (int): Number of radius intervals.
+
+    Returns:
+        list[float]: The (fractional) pixel count of each interval.
+    """
+    interval_counts = np.bitwise_count(interval_map)
+    weights = np.divide(1, interval_counts, out=np.zeros(interval_map.shape), where=(interval_counts > 0) & (seg_img > 0))
+    # Sum the weights of all pixels with the same combination of intervals, then distribute the sums to the intervals
+    bitmasks, inverse = np.unique(interval_map, return_inverse=True)
+    bitmask_sums = np.bincount(inverse.ravel(), weights=weights.ravel(), minlength=len(bitmasks))
+    return [float(bitmask_sums[(bitmasks >> k) & 1 == 1].sum()) for k in range(num_intervals)]
+
+def coverage_pixel_sums(coverage: dict[str, np.ndarray], radius_intervals: list[tuple[float, float]], image_size_mm: float) -> list[float]:
+    """
+    Computes the number of segmented pixels of each radius interval from the edge coverage of a graph without rendering it.
+    Equal to `interval_pixel_sums` of the interval map of the graph, see `generate_edge_coverage_from_graph_json`.
+
+    Args:
+        coverage (dict[str, np.ndarray]): The edge coverage of the graph.
+        radius_intervals (list[tuple[float, float]]): Radius intervals in mm. At most 64 intervals are supported.
+        image_size_mm (float): The size of the image in millimeters.
+
+    Returns:
+        list[float]: The (fractional) pixel count of each interval.
+    """
+    assert len(radius_intervals) <= 64, "At most 64 radius intervals are supported!"
+    dtype = next(t for t in [np.uint8, np.uint16, np.uint32, np.uint64] if np.iinfo(t).bits >= len(radius_intervals))
+    medians = coverage["edge_medians"] * image_size_mm
+    edge_bits = np.zeros(len(medians), dtype=dtype)
+    for k, (lower, upper) in enumerate(radius_intervals):
+        edge_bits[(lower <= medians) & (medians <= upper)] |= dtype(1 << k)
+    shared_edges = coverage["shared_edges"]
+    shared_bits = np.bitwise_or.reduce(np.where(shared_edges >= 0, edge_bits[shared_edges], dtype(0)), axis=1, dtype=dtype) \
+        if shared_edges.size else np.zeros(len(shared_edges), dtype=dtype)
+    # A pixel contributes equally to each interval of its edges, so the pixels are summed per combination of intervals first
+    bitmasks, inverse = np.unique(np.concatenate([edge_bits, shared_bits]), return_inverse=True)
+    bitmask_pixels = np.bincount(inverse, weights=np.concatenate([coverage["edge_pixels"], coverage["shared_pixels"]]), minlength=len(bitmasks))
+    bitmask_sums = np.divide(bitmask_pixels, np.bitwise_count(bitmasks), out=np.zeros(len(bitmasks)), where=bitmasks > 0)
+    return [float(bitmask_sums[(bitmasks >> k) & 1 == 1].sum()) for k in range(len(radius_intervals))]
+
+def coverage_cache_path(data_file: str) -> str:
+    return data_file.removesuffix("_edges.csv") + "_coverage.npz"
+
+def load_edge_coverage(data_file: str, graph_file: str, seg_file: str, segmentation, dim: int, radius_correction_factor: float) -> dict[str, np.ndarray]:
+    """
+    Loads the edge coverage of a graph from its `_coverage.npz` cache next to the edges file. The cache is used if it is at least as
+    new as the edges, graph and segmentation files and was computed for the same image size and radius correction. Otherwise,
+    the coverage is computed with `generate_edge_coverage_from_graph_json` and the cache is (re)written.
+
+    Args:
+        segmentation (Callable[[], np.ndarray]): Loads the segmentation map. Only called if the cache is not valid.
+
+    Returns:
+        dict[str, np.ndarray]: The coverage arrays and the number of rows of the edges file as "num_edges".
+    """
+    cache_path = coverage_cache_path(data_file)
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= max(os.path.getmtime(f) for f in [data_file, graph_file, seg_file]):
+        with np.load(cache_path) as data:
+            coverage = {k: data[k] for k in data.files}
+        if coverage["dim"] == dim and coverage["radius_correction_factor"] == radius_correction_factor:
+            return coverage
     edge_df = pd.read_csv(data_file, sep=';', index_col=0)
-    graph_json = pd.read_json(graph_file, orient='records')
+    coverage = generate_edge_coverage_from_graph_json(
+        load_graph_arrays(graph_file), edge_df, segmentation(), dim=dim, radius_correction_factor=radius_correction_factor
+    )
+    coverage.update(num_edges=np.int64(edge_df.shape[0]), dim=np.int64(dim), radius_correction_factor=np.float64(radius_correction_factor))
+    # An interrupted write must never leave a cache that is newer than the graph files
+    with atomic_path(cache_path) as tmp_path:
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **coverage)
+    return coverage
 
-    # Parse file path to extract metadata
-    if args_etdrs:
+def parse_graph_file(data_file: str, etdrs: bool) -> tuple[str, str, str]:
+    """Parse the group, image ID and file name from the path of an edges file."""
+    if etdrs:
         group, image_ID, name = data_file.split("/")[-3:]
     else:
         group, name = data_file.split("/")[-2:]
         image_ID = remove_extensions(name)
-    image_ID = remove_prefixes(image_ID)
+    return group, remove_prefixes(image_ID), name
+
+def summary_key(data_file: str, etdrs: bool) -> dict[str, str]:
+    """Identifies the summary row of an edges file. All sectors of an image share the same key."""
+    group, image_ID, _ = parse_graph_file(data_file, etdrs)
+    return {
+        "Image_ID": remove_eye_code(remove_plexus_code(image_ID)),
+        "Group": remove_eye_code(remove_plexus_code(group)),
+        "Eye": "OD" if "OD" in image_ID else "OS",
+        "Layer": "SVC" if "svc" in data_file.lower() else "DVC"
+    }
+
+def process_file_pair(args_tuple):
+    """Process a single file pair for parallel execution."""
+    data_file, graph_file, seg_file, *shared_args = args_tuple
+    return process_image_files(([(data_file, graph_file)], seg_file, *shared_args))[0]
+
+def process_image_files(args_tuple) -> list[tuple[dict, bool, str]]:
+    """
+    Processes all graphs of one segmentation for parallel execution, e.g. the graphs of its ETDRS sectors.
+    The segmentation is loaded once and shared by all graphs.
+
+    Args:
+        args_tuple: The list of (edges file, graph file) pairs, the segmentation file and the remaining arguments of `process_file_pair`.
+
+    Returns:
+        list[tuple[dict, bool, str]]: The result of `process_file_pair` for each pair of files.
+    """
+    file_pairs, seg_file, *shared_args = args_tuple
+    args_density_mode = shared_args[-1]
+
+    @functools.cache
+    def segmentation() -> np.ndarray:
+        # The single pass and coverage modes only count the vessel pixels, so the segmentation is kept in its native data type
+        seg_img = load_2d_segmentation(seg_file)
+        if args_density_mode == "per_interval":
+            seg_img = seg_img.astype(np.float32)/255
+        return seg_img
+
+    # The coverage mode only loads the segmentation if a coverage cache is outdated
+    if args_density_mode != "coverage":
+        with span("density", image=image_id(seg_file)):
+            segmentation()
+    return [_file_pair_densities(data_file, graph_file, seg_file, segmentation, *shared_args) for data_file, graph_file in file_pairs]
+
+def _file_pair_densities(
+        data_file, graph_file, seg_file, segmentation, faz_map, AREA_FACTOR_MAP,
+        THRESHOLDS, thresholds, args_etdrs, args_mm, args_radius_correction_factor, faz_shape, args_rasterizer, args_density_mode):
+    group, image_ID, name = parse_graph_file(data_file, args_etdrs)
     
     # Determine area sector
     sector_codes = [k for k in AREA_FACTOR_MAP.keys() if k in name]
@@ -75,15 +177,10 @@ def process_file_pair(args_tuple):
 
     # Initialize data dictionary for primary areas
     if area in ("C0", ""):
-        dd = {
-            "Image_ID": remove_eye_code(remove_plexus_code(image_ID)),
-            "Group": remove_eye_code(remove_plexus_code(group)),
-            "Eye": "OD" if "OD" in image_ID else "OS",
-            "Layer": "SVC" if "svc" in data_file.lower() else "DVC"
-        }
+        dd = summary_key(data_file, args_etdrs)
         
         if faz_map:
-            dd["FAZ area [mm2]"] = faz_map.get(code_name(data_file).removesuffix(f"_{area}"), nan)
+            dd["FAZ area [mm2]"] = faz_area_of(data_file, area, faz_map)
         
         # Initialize all density columns with NaN
         for a in AREA_FACTOR_MAP.keys():
@@ -98,35 +195,163 @@ def process_file_pair(args_tuple):
     radius_intervals = list(zip([0] + [t/1000 for t in thresholds], 
                                     [t/1000 for t in thresholds] + [np.inf]))
     
-    # Find the corresponding segmentation file
-    seg_file = next((f for f in segmentation_files if remove_prefixes(remove_extensions(os.path.basename(f))) == image_ID), None)
-    if seg_file is None:
-        raise FileNotFoundError(f"No segmentation file found for {data_file} with code {image_ID}!")
-    seg_img = np.array(Image.open(seg_file), np.float32)/255
-
-    graph_images = []
-    for t in radius_intervals:
-        graph_img_filtered_t = generate_image_from_graph_json(
-            graph_json=graph_json, edges_df=edge_df, radius_interval=t,
-            dim=faz_shape[0], image_size_mm=args_mm, colorize="white", radius_correction_factor=args_radius_correction_factor
-        ).astype(np.float32)/255 * seg_img
-        graph_images.append(graph_img_filtered_t)
-    
-    # Normalize overlapping pixels and calculate densities
-    graph_img = np.stack(graph_images, axis=-1).sum(-1)
-    densities = []
-    for img in graph_images:
-        mask = (graph_img > 0) & (img > 0)
-        img[mask] /= graph_img[mask]
-        densities.append(img.sum() / area_factor * 100)
+    with span("density", image=image_ID):
+        if args_density_mode == "coverage":
+            coverage = load_edge_coverage(data_file, graph_file, seg_file, segmentation, dim=faz_shape[0], radius_correction_factor=args_radius_correction_factor)
+            num_edges = int(coverage["num_edges"])
+            densities = [s / area_factor * 100 for s in coverage_pixel_sums(coverage, radius_intervals, args_mm)]
+        else:
+            edge_df = pd.read_csv(data_file, sep=';', index_col=0)
+            graph_json = load_graph_arrays(graph_file)
+            num_edges = edge_df.shape[0]
+        if args_density_mode == "single_pass":
+            interval_map = generate_interval_map_from_graph_json(
+                graph_json=graph_json, edges_df=edge_df, radius_intervals=radius_intervals,
+                dim=faz_shape[0], image_size_mm=args_mm, radius_correction_factor=args_radius_correction_factor
+            )
+            densities = [s / area_factor * 100 for s in interval_pixel_sums(interval_map, segmentation(), len(radius_intervals))]
+        elif args_density_mode == "per_interval":
+            graph_images = []
+            for t in radius_intervals:
+                graph_img_filtered_t = generate_image_from_graph_json(
+                    graph_json=graph_json, edges_df=edge_df, radius_interval=t,
+                    dim=faz_shape[0], image_size_mm=args_mm, colorize="white", radius_correction_factor=args_radius_correction_factor,
+                    backend=args_rasterizer
+                ).astype(np.float32)/255 * segmentation()
+                graph_images.append(graph_img_filtered_t)
+
+            # Normalize overlapping pixels and calculate densities
+            graph_img = np.stack(graph_images, axis=-1).sum(-1)
+            densities = []
+            for img in graph_images:
+                mask = (graph_img > 0) & (img > 0)
+                img[mask] /= graph_img[mask]
+                densities.append(img.sum() / area_factor * 100)
 
     # Store densities in the data dictionary
     for i in range(len(THRESHOLDS)-1):
         title = generate_density_title(area, THRESHOLDS[i], THRESHOLDS[i+1])
-        dd[title] = densities[i] if edge_df.shape[0] > 0 else 0
+        dd[title] = densities[i] if num_edges > 0 else 0
     
     return dd, new_entry, area
 
+def resolve_density_mode(rasterizer: Literal["matplotlib", "numpy"], density_mode: Literal["single_pass", "per_interval", "coverage"]) -> str:
+    """
+    The single pass and coverage modes assign the pixels of the numpy rasterizer to the radius intervals.
+    With the matplotlib rasterizer, each radius interval is rendered separately instead, so that the densities match the matplotlib renderer.
+    """
+    return density_mode if rasterizer == "numpy" else "per_interval"
+
+def faz_area_of(data_file: str, area: str, faz_map: dict[str, float]) -> float:
+    """Looks up the FAZ area of the image of an edges file."""
+    return faz_map.get(code_name(data_file).removesuffix(f"_{area}"), nan)
+
+def compute_faz_areas(faz_files: list[str], mm: float) -> tuple[dict[str, float], tuple[int, int]]:
+    """
+    Computes the FAZ area in mm² of each FAZ segmentation.
+
+    Returns:
+        tuple[dict[str, float], tuple[int, int]]: Map from code name to FAZ area, and the image shape of the last FAZ segmentation.
+    """
+    faz_map = {}
+    shape = None
+    for faz_file in tqdm(faz_files, desc="Processing FAZ files"):
+        faz = np.array(Image.open(faz_file))
+        image_area = faz.shape[0] * faz.shape[1]
+        faz_area = (faz/255).sum() / image_area * mm**2
+        faz_map[code_name(faz_file)] = faz_area
+        shape = faz.shape
+    return faz_map, shape
+
+def area_factor_map(shape: tuple[int, int], etdrs: bool, mm: float, center_radius: float, inner_radius: float) -> dict[str, int]:
+    """Returns the number of pixels of each analysed area, i.e. of each ETDRS sector or of the full image ("")."""
+    if etdrs:
+        center_mask, q1_mask, q2_mask, q3_mask, q4_mask = get_ETDRS_grid_masks(
+            np.ones(shape, dtype=np.uint8), 
+            center_radius=center_radius/mm*shape[0], 
+            inner_radius=inner_radius/mm*shape[0]
+        )
+        return {"C0": center_mask.sum(), "S1": q1_mask.sum(), "N1": q2_mask.sum(), "I1": q3_mask.sum(), "T1": q4_mask.sum()}
+    return {"": np.ones(shape, dtype=np.uint8).sum()}
+
+def with_faz_area(dd: dict, data_file: str, area: str, faz_map: dict[str, float]) -> dict:
+    """Sets the FAZ area of an entry created by `process_file_pair` without FAZ map, keeping the column order of `process_file_pair`."""
+    columns = list(dd.items())
+    return dict(columns[:4] + [("FAZ area [mm2]", faz_area_of(data_file, area, faz_map))] + [c for c in columns[4:] if c[0] != "FAZ area [mm2]"])
+
+def with_timings(dd: dict, data_file: str, etdrs: bool, timings: dict[str, dict[str, float]]) -> dict:
+    """Appends the profiled duration of each span of the image of an edges file as columns, see `utils.profiling.image_timings`."""
+    durations = timings.get(parse_graph_file(data_file, etdrs)[1], {})
+    return dd | {f"{name} [s]": durations.get(name, nan) for name in SPANS}
+
+def write_summary(results: dict[str, tuple[dict, bool, str]], output_dir: str, etdrs: bool, parquet: bool = False) -> str:
+    """
+    Merges the results of `process_file_pair` into one row per image and saves them as CSV.
+    The results of an image are merged by their key (see `summary_key`), so they can be computed in any order.
+
+    Args:
+        results (dict[str, tuple[dict, bool, str]]): Map from edges file to its result.
+        output_dir (str): Output folder.
+        etdrs (bool): Whether the results are ETDRS sectors.
+        parquet (bool): Also save the summary as Parquet file with typed columns. Requires pyarrow.
+
+    Returns:
+        str: Path of the CSV file.
+
+    Raises:
+        ValueError: If the primary areas of two edges files have the same key.
+    """
+    rows = dict()
+    row_files = dict()
+    sectors = dict()
+    for data_file in natsorted(results.keys()):
+        dd, new_entry, area = results[data_file]
+        summary = summary_key(data_file, etdrs)
+        key = tuple(summary.values())
+        if new_entry:  # Primary area (C0 or "")
+            if key in rows:
+                # E.g. 'x_DCP.png' and 'x_DVC.png', or 'x.png' and 'x.nii.gz' in the same folder
+                raise ValueError(f"{row_files[key]} and {data_file} belong to the same summary row {summary}. "
+                                 +"Rename the files or summarize them separately.")
+            rows[key] = dd.copy()
+            row_files[key] = data_file
+        else:
+            sectors.setdefault(key, []).append(dd)
+    # Secondary areas only add their own density columns to the row of the primary area
+    for key, row in rows.items():
+        for dd in sectors.get(key, []):
+            row.update(dd)
+
+    # Save results
+    df = pd.DataFrame(list(rows.values()))
+    df = df.sort_values(by="Image_ID", key=natsort_keygen())
+    output_name = "density_measurements_etdrs.csv" if etdrs else "density_measurements_full.csv"
+    with atomic_write(os.path.join(output_dir, output_name)) as file:
+        df.to_csv(file, index=False, sep=",")
+    if parquet:
+        with atomic_path(os.path.join(output_dir, output_name.replace(".csv", ".parquet"))) as tmp_path:
+            typed_summary(df).to_parquet(tmp_path, index=False)
+    return os.path.join(output_dir, output_name)
+
+def typed_summary(df: pd.DataFrame) -> pd.DataFrame:
+    """Converts the identifier columns of a summary to strings and categories, and all measurements to float64."""
+    types = {"Image_ID": "string", "Group": "category", "Eye": "category", "Layer": "category"}
+    return df.astype({c: types.get(c, "float64") for c in df.columns})
+
+_shared_args: tuple = None
+
+def _init_worker(shared_args: tuple):
+    global _shared_args
+    _shared_args = shared_args
+
+def _process_image(task: tuple[str, list[tuple[str, str]]]) -> list[tuple[str, tuple[dict, bool, str]]]:
+    """
+    Runs `process_image_files` for a segmentation and the (edges file, graph file) pairs of its graphs.
+    The arguments shared by all images are passed to each worker once, see `_init_worker`.
+    """
+    seg_file, file_pairs = task
+    return list(zip([data_file for data_file, _ in file_pairs], process_image_files((file_pairs, seg_file, *_shared_args))))
+
 def generate_anylsis_file(
         source_dir: str,
         segmentation_dir: str,
@@ -139,82 +364,99 @@ def generate_anylsis_file(
         inner_radius: float = 3/2.4,
         radius_correction_factor: float = -1.0,
         threads: int = cpu_count() - 1,
+        rasterizer: Literal["matplotlib", "numpy"] = "matplotlib",
+        density_mode: Literal["single_pass", "per_interval", "coverage"] = "single_pass",
+        manifest: str = None,
+        incremental: bool = False,
+        chunksize: int = None,
+        parquet: bool = False,
         **kwargs
 ):
-        # Find and validate input files
-    edge_files = natsorted(glob.glob(os.path.join(source_dir, "**/*_edges.csv"), recursive=True))
-    graph_files = natsorted(glob.glob(os.path.join(source_dir, "**/*_graph.json"), recursive=True))
-    segmentation_files = natsorted(glob.glob(os.path.join(segmentation_dir, "**/*.png"), recursive=True))
+    assert not incremental or manifest is not None, "Incremental processing requires a manifest."
+    assert not parquet or importlib.util.find_spec("pyarrow") is not None, "Parquet output requires pyarrow. Install it with 'pip install pyarrow'."
+    # Find and validate input files. Without a manifest, the given folders are indexed in memory.
+    if manifest is not None:
+        dataset = Manifest(manifest)
+        edge_files = [f"{prefix}_edges.csv" for prefix in dataset.graphs()]
+    else:
+        dataset = Manifest.build(":memory:", natsorted(
+            glob.glob(os.path.join(segmentation_dir, "**/*.png"), recursive=True) + glob.glob(os.path.join(segmentation_dir, "**/*.nii.gz"), recursive=True)
+        ))
+        edge_files = natsorted(glob.glob(os.path.join(source_dir, "**/*_edges.csv"), recursive=True))
     assert edge_files, f"No '_edges.csv' files found in folder {source_dir}!"
-    assert graph_files, f"No '_graph.json' files found in folder {source_dir}!"
+    graph_files = [f"{data_file.removesuffix('_edges.csv')}_graph.json" for data_file in edge_files]
+    segmentation_map = dataset.segmentations_by_image_id()
 
     # Process FAZ files if provided
-    faz_map = {}
-    if faz_files:
-        faz_files = natsorted(glob.glob(faz_files, recursive=True))
-        if not faz_files:
+    if faz_files and not dataset.faz_files():
+        dataset.add_faz(natsorted(glob.glob(faz_files, recursive=True)))
+        if not dataset.faz_files():
             print(f"No files found in faz folder {faz_files}!")
-        
-        for faz_file in tqdm(faz_files, desc="Processing FAZ files"):
-            faz = np.array(Image.open(faz_file))
-            image_area = faz.shape[0] * faz.shape[1]
-            faz_area = (faz/255).sum() / image_area * mm**2
-            faz_map[code_name(faz_file)] = faz_area
+    faz_map, faz_shape = compute_faz_areas(dataset.faz_files(), mm)
 
     # Setup area masks and factors
     if etdrs:
         assert faz_map, "FAZ files are required for ETDRS analysis!"
-        center_mask, q1_mask, q2_mask, q3_mask, q4_mask = get_ETDRS_grid_masks(
-            np.ones_like(faz), 
-            center_radius=center_radius/mm*faz.shape[0], 
-            inner_radius=inner_radius/mm*faz.shape[0]
-        )
-        AREA_FACTOR_MAP = {"C0": center_mask.sum(), "S1": q1_mask.sum(), "N1": q2_mask.sum(), "I1": q3_mask.sum(), "T1": q4_mask.sum()}
-    else:
-        AREA_FACTOR_MAP = {"": np.ones_like(faz).sum()}
+    AREA_FACTOR_MAP = area_factor_map(faz_shape, etdrs, mm, center_radius, inner_radius)
 
     
     thresholds = [float(t) for t in radius_thresholds.split(",")] if radius_thresholds else []
+    density_mode = resolve_density_mode(rasterizer, density_mode)
     THRESHOLDS = [None, *thresholds, None]
 
-    # Prepare arguments for parallel processing
-    process_args = []
+    # Only the files differ between the graphs. All other arguments are passed to each worker once.
+    shared_args = (faz_map, AREA_FACTOR_MAP, THRESHOLDS, thresholds, etdrs, mm, radius_correction_factor, faz_shape, rasterizer, density_mode)
+    graph_files_by_edges = dict()
     for data_file, graph_file in zip(edge_files, graph_files):
-        args_tuple = (
-            data_file, graph_file, segmentation_files, faz_map, AREA_FACTOR_MAP,
-            THRESHOLDS, thresholds, etdrs, mm, radius_correction_factor, faz.shape
-        )
-        process_args.append(args_tuple)
+        # Find the corresponding segmentation file
+        _, image_ID, _ = parse_graph_file(data_file, etdrs)
+        seg_file = segmentation_map.get(image_ID)
+        if seg_file is None:
+            raise FileNotFoundError(f"No segmentation file found for {data_file} with code {image_ID}!")
+        graph_files_by_edges[data_file] = (data_file, graph_file, seg_file)
 
-    # Process files in parallel
-    d = []
-    
+    # Reuse the results of unchanged graphs. The FAZ areas are cheap to compute and are always updated.
+    reused = dict()
+    if incremental:
+        params = {
+            "thresholds": thresholds, "mm": mm, "etdrs": etdrs, "center_radius": center_radius, "inner_radius": inner_radius,
+            "radius_correction_factor": radius_correction_factor, "shape": faz_shape, "rasterizer": rasterizer, "density_mode": density_mode
+        }
+        fingerprints, reused, _, _ = dataset.plan_incremental("summary", {f[0]: list(f) for f in graph_files_by_edges.values()}, params)
+        print(f"Skipping {len(reused)} unchanged graphs.")
+    # Each task processes all pending graphs of one segmentation, e.g. its ETDRS sectors
+    pending = dict()
+    for data_file, (_, graph_file, seg_file) in graph_files_by_edges.items():
+        if data_file not in reused:
+            pending.setdefault(seg_file, []).append((data_file, graph_file))
+
+    # Process images in parallel. The results are merged by image, so they are collected in order of completion.
     print(f"Using {threads} threads for processing graph features.")
-    with Pool(threads) as pool:
-        results = list(tqdm(pool.imap(process_file_pair, process_args), total=len(process_args), desc="Processing files"))
-    
-    # Reconstruct the data structure maintaining original order and logic
-    current_entry = None
-    for i, (dd, new_entry, area) in enumerate(results):
-        if new_entry:  # Primary area (C0 or "")
-            if current_entry is not None:
-                d.append(current_entry)
-            current_entry = dd.copy()
-        else:  # Secondary area - merge with current entry
-            if current_entry is not None:
-                current_entry.update(dd)
-    
-    # Add the last entry
-    if current_entry is not None:
-        d.append(current_entry)
+    chunksize = chunksize or max(1, len(pending) // (4 * threads))
+    computed = dict()
+    with Pool(threads, initializer=_init_worker, initargs=(shared_args,)) as pool:
+        for image_results in tqdm(pool.imap_unordered(_process_image, pending.items(), chunksize=chunksize), total=len(pending), desc="Processing images"):
+            computed.update(image_results)
+    if incremental:
+        for data_file, result in computed.items():
+            dataset.record("summary", data_file, fingerprints[data_file], result)
+    dataset.close()
 
-    # Save results
-    df = pd.DataFrame(d)
-    df = df.sort_values(by="Image_ID", key=natsort_keygen())
+    results = dict(computed)
+    for data_file, (dd, new_entry, area) in reused.items():
+        if new_entry and faz_map:
+            dd = with_faz_area(dd, data_file, area, faz_map)
+        results[data_file] = (dd, new_entry, area)
+    if profile_dir() is not None:
+        timings = image_timings()
+        results = {
+            data_file: (with_timings(dd, data_file, etdrs, timings) if new_entry else dd, new_entry, area)
+            for data_file, (dd, new_entry, area) in results.items()
+        }
+    
     output_dir = output_dir or source_dir
-    output_name = "density_measurements_etdrs.csv" if etdrs else "density_measurements_full.csv"
-    df.to_csv(os.path.join(output_dir, output_name), index=False, sep=",")
-    print(f"Analysis summary saved to {os.path.join(output_dir, output_name)}")
+    output_path = write_summary(results, output_dir, etdrs, parquet=parquet)
+    print(f"Analysis summary saved to {output_path}")
 
 
 if __name__ == "__main__":
@@ -231,10 +473,25 @@ if __name__ == "__main__":
     parser.add_argument('--mm', type=float, default=3.0, help="Height of the segmentation volume in mm. Default is 3 mm")
     parser.add_argument('--etdrs', action="store_true", help="If set, use ETDRS grid stratification")
     parser.add_argument('--radius_correction_factor', type=float, default=-1.0, 
-                        help="Additive correction factor for the radius estimation. Default is -1.0 to correct for Voreen's overestimation by 1 pixel measured on synthetic data.")
+                        help="Additive correction factor for the radius estimation. Default is -1.0 to correct for Voreen's overestimation by 1 pixel measured on synthetic data. "
+                        +"Use 0 for graphs of the native backend.")
     parser.add_argument('--center_radius', type=float, default=3/6, help="Radius of ETDRS center radius in mm")
     parser.add_argument('--inner_radius', type=float, default=3/2.4, help="Radius of ETDRS center radius in mm")
     parser.add_argument('--threads', type=int, default=max(1, cpu_count()-1), help="Number of threads to use for parallel processing. Default is all available cores minus one.")
+    parser.add_argument('--rasterizer', type=str, choices=["matplotlib", "numpy"], default="matplotlib",
+                        help="Backend used to render the graph for the density measurements. 'matplotlib' is the reference renderer. 'numpy' is much faster, but stamps slightly more pixels at disc borders, which raises the densities, most in the smallest radius interval: by up to 0.35 percentage points in the ETDRS sectors of synthetic benchmark data (see python -m benchmarks.rasterizer_agreement). With 'matplotlib', every --density_mode renders each radius interval separately.")
+    parser.add_argument('--density_mode', type=str, choices=["single_pass", "per_interval", "coverage"], default="single_pass",
+                        help="'single_pass' renders the graph once and assigns the pixels to all radius intervals at once. 'per_interval' renders the graph separately for each radius interval."
+                        +" 'coverage' stores the pixels covered by each edge in a _coverage.npz file next to the graph and aggregates them per radius interval, so later runs with other --radius_thresholds or --mm skip the rendering."
+                        +" 'single_pass' and 'coverage' require --rasterizer numpy; with 'matplotlib', each radius interval is rendered separately.")
+    parser.add_argument('--manifest', type=str, default=None,
+                        help="Path to a dataset manifest. If given, the graph, segmentation and FAZ files are taken from the manifest instead of the given folders.")
+    parser.add_argument('--incremental', action="store_true",
+                        help="Reuse the densities of graphs whose files and parameters did not change since the last run. Requires --manifest.")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="Number of images sent to a worker at once. By default, each worker receives about four chunks.")
+    parser.add_argument('--parquet', action="store_true",
+                        help="Also save the summary as Parquet file with typed columns. Requires pyarrow.")
     args = parser.parse_args()
     kwargs = vars(args)
 
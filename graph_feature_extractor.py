@@ -1,13 +1,15 @@
 import argparse
 import concurrent.futures
 import glob
+import json
 import os
 import pathlib
 from functools import partial
 from multiprocessing import cpu_count
+from typing import Callable, Literal
 
-import nibabel as nib
 import numpy as np
+import pandas as pd
 from dotenv import load_dotenv
 from natsort import natsorted
 from PIL import Image
@@ -15,19 +17,60 @@ from scipy import ndimage
 from tqdm import tqdm
 
 import docker
-from utils.convert_2d_to_3d import convert_2d_to_3d
+from utils.convert_2d_to_3d import compute_height_map
 from utils.ETDRS_grid import get_ETDRS_grid_indices
-from utils.voreen_vesselgraphextraction import extract_vessel_graph
+from utils.file_io import clear_dir, copy_file
+from utils.graph_tiling import stitch_tile_graphs, tile_boxes
+from utils.manifest import Manifest, get_code_name, image_id
+from utils.memory_budget import MemoryProfile, job_type, measure_peak_rss, submit_within_budget
+from utils.native_vesselgraphextraction import build_skeleton_graph, extract_vessel_graph_native
+from utils.profiling import image_context, span
+from utils.vessel_graph import clip_graph, graph_cache_path, graph_to_tables, sanity_filter, shift_graph, write_graph_files
+from utils.visualizer import save_graph_image
+from utils.volume_io import SlabVolume, is_nifti, load_2d_segmentation, segmentation_shape
+from utils.voreen_container_pool import VoreenContainerPool, start_voreen_container
+from utils.voreen_scheduler import schedule_voreen_extraction
+from utils.voreen_vesselgraphextraction import collect_voreen_job, extract_vessel_graphs, prepare_voreen_job, run_voreen_batch
 
 load_dotenv()
 project_folder = str(pathlib.Path(__file__).parent.resolve())
 
-DOCKER_VOREEN_BIN = "/home/software/voreen-voreen-5.3.0/voreen/bin/"
 DOCKER_WORK_DIR = '/var/results'
+GRAPH_FILE_SUFFIXES = ["_nodes.csv", "_edges.csv", "_graph.json", "_graph.npz", "_graph.png"]
 
-def get_code_name(path: str) -> str:
-    extension = ".nii.gz" if path.endswith(".nii.gz") else "."+path.split(".")[-1]
-    return os.path.basename(path).removesuffix(extension).removeprefix("faz_").removeprefix("model_").removeprefix("model_")
+def _load_2d_segmentation(ves_seg_path: str) -> np.ndarray:
+    """
+    Loads a vessel segmentation as 2D uint8 mask. 3D volumes are reduced by a maximum projection along z.
+    """
+    return np.asarray(load_2d_segmentation(ves_seg_path), np.uint8)
+
+def _graph_prefix(ves_seg_path: str, source_dir: str, output_dir: str, sector: str = "") -> str:
+    """
+    Path prefix of the graph files of a vessel segmentation as written by `full_graph` (sector "") or `etdrs_graph`.
+    """
+    extension = ".nii.gz" if ves_seg_path.endswith(".nii.gz") else "."+ves_seg_path.split(".")[-1]
+    image_name = os.path.basename(ves_seg_path).removesuffix(extension)
+    if output_dir is None:
+        output_dir = os.path.dirname(ves_seg_path)
+    image_dir = os.path.dirname(ves_seg_path).replace(source_dir, output_dir)
+    if sector:
+        return os.path.join(image_dir, image_name, f"{image_name}_{sector}")
+    return os.path.join(image_dir, image_name)
+
+def resolve_radius_correction_factor(backend: Literal["voreen", "native"], radius_correction_factor: float = None) -> float:
+    """
+    Voreen overestimates the radii by 1 pixel on synthetic data, so its radii are corrected by -1.0 by default.
+    The native radii are the distance of each skeleton pixel to the vessel surface and are not corrected by default.
+    """
+    if radius_correction_factor is not None:
+        return radius_correction_factor
+    return -1.0 if backend == "voreen" else 0.0
+
+def _faz_code_name(ves_seg_path: str) -> str:
+    """
+    Code name of the FAZ segmentation that belongs to a vessel segmentation. The FAZ is segmented in the deep vascular complex.
+    """
+    return get_code_name(ves_seg_path).replace("SVC", "DVC").replace("svc", "dvc")
 
 def full_graph(
         ves_seg_path: str,
@@ -43,8 +86,20 @@ def full_graph(
         colorize: str = "continuous",
         verbose: bool = False,
         mm: float = 3.0,
-        radius_correction_factor: float = -1.0,
+        radius_correction_factor: float = None,
+        backend: Literal["voreen", "native"] = "voreen",
         **kwargs):
+    radius_correction_factor = resolve_radius_correction_factor(backend, radius_correction_factor)
+    if backend == "voreen":
+        graphs = voreen_batch_graphs(
+            [ves_seg_path], source_dir=source_dir, tmp_dir=tmp_dir, output_dir=output_dir, container_name=container_name,
+            color_thresholds=color_thresholds, z_dim=z_dim, bulge_size=bulge_size, voreen_workspace=voreen_workspace,
+            graph_image=graph_image, colorize=colorize, verbose=verbose, mm=mm, radius_correction_factor=radius_correction_factor, **kwargs
+        )
+        if ves_seg_path not in graphs:
+            raise Exception(f"Graph extraction failed for {ves_seg_path}.")
+        return graphs[ves_seg_path]
+
     extension = ".nii.gz" if ves_seg_path.endswith(".nii.gz") else "."+ves_seg_path.split(".")[-1]
     image_name = os.path.basename(ves_seg_path).removesuffix(extension)
     if output_dir is None:
@@ -53,33 +108,63 @@ def full_graph(
         output_dir = output_dir
     output_dir = os.path.dirname(ves_seg_path).replace(source_dir, output_dir)
     os.makedirs(output_dir, exist_ok=True)
-    
-    if extension == ".nii.gz":
-        img_nii = nib.load(ves_seg_path)
-    else:
-        ves_seg = np.array(Image.open(ves_seg_path), np.uint8)
-        ves_seg_3d = convert_2d_to_3d(ves_seg, z_dim=z_dim)
-        header = nib.Nifti1Header()
-        header.set_xyzt_units(xyz="mm", t="sec")
-        header.set_data_shape(ves_seg_3d.shape)
-        img_nii = nib.Nifti1Image(ves_seg_3d, np.eye(4), header=header)
-
-    extract_vessel_graph(
-        img_nii=img_nii,
+
+    extract_vessel_graph_native(
+        ves_seg=_load_2d_segmentation(ves_seg_path),
         image_name=image_name,
         outdir=output_dir,
-        DOCKER_WORK_DIR=DOCKER_WORK_DIR,
-        tmp_dir=tmp_dir,
-        bulge_size=bulge_size,
-        workspace_file=voreen_workspace,
-        container_name=container_name,
+        z_dim=z_dim,
         graph_image=graph_image,
         colorize=colorize,
         color_thresholds=color_thresholds,
-        verbose=bool(verbose),
         radius_correction_factor=radius_correction_factor,
         image_size_mm=mm
     )
+    return {"": os.path.join(output_dir, image_name)}
+
+def split_graph_by_sectors(
+        outdir: str,
+        full_name: str,
+        image_name: str,
+        sector_masks: dict[str, np.ndarray],
+        ves_seg: np.ndarray,
+        graph_image: bool = True,
+        **kwargs):
+    """
+    Splits the graph files `<full_name>_*` into one set of graph files `<image_name>_<sector>_*` per sector and removes the full graph files.
+    Edges that cross a sector boundary are clipped to the sector.
+
+    Args:
+        outdir (str): Directory containing the full graph files. The sector files are written to the same directory.
+        full_name (str): File prefix of the full graph.
+        image_name (str): Name of the image used as prefix for the sector files.
+        sector_masks (dict[str, np.ndarray]): Map from sector code to 2D boolean sector mask.
+        ves_seg (np.ndarray): 2D vessel segmentation used to mask the graph images.
+        graph_image (bool): Whether to generate a graph image for each sector.
+        **kwargs: Additional arguments passed to `save_graph_image`.
+    """
+    full_paths = [os.path.join(outdir, f"{full_name}_{suffix}") for suffix in ["nodes.csv", "edges.csv", "graph.json"]]
+    df_nodes = pd.read_csv(full_paths[0], sep=";", index_col=0)
+    df_edges = pd.read_csv(full_paths[1], sep=";", index_col=0)
+    with open(full_paths[2], "r") as file:
+        graph_json = json.load(file)
+
+    for suffix, mask in sector_masks.items():
+        sector_name = f"{image_name}_{suffix}"
+        sector_graph, sector_nodes, sector_edges = clip_graph(graph_json, df_nodes, df_edges, mask)
+        write_graph_files(sector_graph, outdir, sector_name, df_nodes=sector_nodes, df_edges=sector_edges)
+        if graph_image:
+            with span("graph_rendering"):
+                save_graph_image(
+                    sector_graph,
+                    sector_edges,
+                    segmentation_2d_mask=np.where(mask, ves_seg, 0),
+                    path=os.path.join(outdir, f"{sector_name}_graph.png"),
+                    **kwargs
+                )
+    for path in [*full_paths, graph_cache_path(full_paths[2])]:
+        if os.path.isfile(path):
+            os.remove(path)
 
 def etdrs_graph(
         ves_seg_path: str,
@@ -96,8 +181,22 @@ def etdrs_graph(
         colorize: str = "continuous",
         verbose: bool = False,
         mm: float = 3.0,
-        radius_correction_factor: float = -1.0,
+        radius_correction_factor: float = None,
+        backend: Literal["voreen", "native"] = "voreen",
+        etdrs_mode: Literal["masked", "split"] = "masked",
         **kwargs):
+    radius_correction_factor = resolve_radius_correction_factor(backend, radius_correction_factor)
+    if backend == "voreen":
+        graphs = voreen_batch_graphs(
+            [ves_seg_path], source_dir=source_dir, tmp_dir=tmp_dir, output_dir=output_dir, container_name=container_name,
+            faz_code_name_map=faz_code_name_map, color_thresholds=color_thresholds, z_dim=z_dim, bulge_size=bulge_size,
+            voreen_workspace=voreen_workspace, graph_image=graph_image, colorize=colorize, verbose=verbose, mm=mm,
+            radius_correction_factor=radius_correction_factor, etdrs=True, etdrs_mode=etdrs_mode, **kwargs
+        )
+        if ves_seg_path not in graphs:
+            raise Exception(f"Graph extraction failed for {ves_seg_path}.")
+        return graphs[ves_seg_path]
+
     extension = ".nii.gz" if ves_seg_path.endswith(".nii.gz") else "."+ves_seg_path.split(".")[-1]
     image_name = os.path.basename(ves_seg_path).removesuffix(extension)
     if output_dir is None:
@@ -107,17 +206,57 @@ def etdrs_graph(
     output_dir= os.path.join(os.path.dirname(ves_seg_path).replace(source_dir, output_dir),image_name.removesuffix(extension))
     os.makedirs(output_dir, exist_ok=True)
     
-    if extension == ".nii.gz":
-        img_nii: nib.Nifti1Image = nib.load(ves_seg_path)
-        ves_seg_3d = img_nii.get_fdata(dtype=np.uint8)
-    else:
-        ves_seg = np.array(Image.open(ves_seg_path), np.uint8)
-        ves_seg_3d = convert_2d_to_3d(ves_seg, z_dim=z_dim)
-    
-    faz_code_name = get_code_name(ves_seg_path).replace("SVC", "DVC").replace("svc", "dvc")
+    ves_seg = _load_2d_segmentation(ves_seg_path)
+    sector_masks = _etdrs_sector_masks(ves_seg_path, faz_code_name_map)
+    if sector_masks is None:
+        return {}
+    graphs = {suffix: os.path.join(output_dir, f"{image_name}_{suffix}") for suffix in sector_masks}
+
+    if etdrs_mode == "split":
+        # Extract the graph once from the unmasked segmentation and clip it to each sector
+        full_name = f"{image_name}_full"
+        extract_vessel_graph_native(ves_seg=ves_seg, image_name=full_name, outdir=output_dir, z_dim=z_dim, graph_image=False)
+        split_graph_by_sectors(
+            outdir=output_dir,
+            full_name=full_name,
+            image_name=image_name,
+            sector_masks=sector_masks,
+            ves_seg=ves_seg,
+            graph_image=graph_image,
+            colorize=colorize,
+            color_thresholds=color_thresholds,
+            radius_correction_factor=radius_correction_factor,
+            image_size_mm=mm
+        )
+        return graphs
+
+    for suffix, mask in sector_masks.items():
+        ves_seg_masked = np.copy(ves_seg)
+        ves_seg_masked[~mask] = 0
+        extract_vessel_graph_native(
+            ves_seg=ves_seg_masked,
+            image_name=f"{image_name}_{suffix}",
+            outdir=output_dir,
+            z_dim=z_dim,
+            graph_image=graph_image,
+            colorize=colorize,
+            color_thresholds=color_thresholds,
+            radius_correction_factor=radius_correction_factor,
+            image_size_mm=mm
+        )
+    return graphs
+
+def _etdrs_sector_masks(ves_seg_path: str, faz_code_name_map: dict[str, str]) -> dict[str, np.ndarray]:
+    """
+    Computes the ETDRS sector masks of a vessel segmentation, centered at the center of mass of its FAZ.
+
+    Returns:
+        dict[str, np.ndarray]: Map from sector code to 2D boolean sector mask, or None if no FAZ segmentation was found.
+    """
+    faz_code_name = _faz_code_name(ves_seg_path)
     if faz_code_name not in faz_code_name_map:
         print(f"Skipping analysis for image {ves_seg_path}. No FAZ found.")
-        return
+        return None
 
     faz_seg = np.array(Image.open(faz_code_name_map[faz_code_name]))
     center = ndimage.center_of_mass(faz_seg)
@@ -127,74 +266,507 @@ def etdrs_graph(
     else:
         suffixes = ["C0", "S1", "T1", "I1", "N1"]
 
-
+    sector_masks: dict[str, np.ndarray] = dict()
     for indices, suffix in zip(ETDRS_grid_indices, suffixes):
         mask = np.zeros_like(faz_seg, dtype=np.bool_)
         try:
             mask[indices] = True
         except IndexError:
             continue
+        sector_masks[suffix] = mask
+    return sector_masks
 
-        ves_seg_masked = np.copy(ves_seg_3d)
-        ves_seg_masked[~mask,:] = 0
-
-        header = nib.Nifti1Header()
-        header.set_xyzt_units(xyz="mm", t="sec")
-        header.set_data_shape(ves_seg_3d.shape)
-        ves_seg_masked_nii = nib.Nifti1Image(ves_seg_masked, np.eye(4), header=header)
-        
-        # Compute graph
-        extract_vessel_graph(
-            img_nii=ves_seg_masked_nii,
-            image_name=f"{image_name}_{suffix}",
-            outdir=f"{output_dir}",
-            DOCKER_WORK_DIR=f"{DOCKER_WORK_DIR}/{image_name}",
-            tmp_dir=tmp_dir,
-            bulge_size=bulge_size,
-            workspace_file=voreen_workspace,
-            container_name=container_name,
-            graph_image=graph_image,
-            colorize=colorize,
-            color_thresholds=color_thresholds,
-            verbose=bool(verbose),
-            image_size_mm=mm
+def sweep_output_dir(output_dir: str, bulge_size: float) -> str:
+    """Output folder of the graphs extracted with the given bulge size in a bulge size sweep, see `voreen_sweep_graphs`."""
+    return os.path.join(output_dir, f"bulge_size_{bulge_size:g}")
+
+def _voreen_volumes(
+        ves_seg_path: str,
+        source_dir: str,
+        output_dir: str,
+        z_dim: int = 64,
+        sector_masks: dict[str, np.ndarray] = None,
+        etdrs_mode: Literal["masked", "split"] = "masked",
+        bulge_sizes: list[float] = None):
+    """
+    Generates the volumes that Voreen extracts the graphs of a vessel segmentation from, in the format of `extract_vessel_graphs`.
+    Without sector masks, the full segmentation is extracted. With sector masks, either one masked volume per sector or,
+    in "split" mode, the full segmentation as `<image_name>_full` is extracted into the ETDRS folder of the image.
+    With `bulge_sizes`, each volume has one variant per bulge size that is extracted into the folder of that bulge size, see `sweep_output_dir`.
+    """
+    extension = ".nii.gz" if ves_seg_path.endswith(".nii.gz") else "."+ves_seg_path.split(".")[-1]
+    image_name = os.path.basename(ves_seg_path).removesuffix(extension)
+    sector = "C0" if sector_masks is not None else ""
+    work_subdir = f"/{image_name}" if sector_masks is not None else ""
+    outdir = os.path.dirname(_graph_prefix(ves_seg_path, source_dir, output_dir, sector))
+    variants = None
+    if bulge_sizes is None:
+        os.makedirs(outdir, exist_ok=True)
+    else:
+        variants = [
+            dict(
+                bulge_size=bulge_size,
+                outdir=os.path.dirname(_graph_prefix(ves_seg_path, source_dir, sweep_output_dir(output_dir, bulge_size), sector)),
+                DOCKER_WORK_DIR=sweep_output_dir(DOCKER_WORK_DIR, bulge_size) + work_subdir
+            )
+            for bulge_size in bulge_sizes
+        ]
+        for variant in variants:
+            os.makedirs(variant["outdir"], exist_ok=True)
+
+    # The volume is written to the temporary directory slab by slab. Sectors share the voxels of the full volume.
+    image = image_id(ves_seg_path)
+    with span("convert_2d_to_3d", image=image):
+        volume, header = SlabVolume.from_file(ves_seg_path, z_dim=z_dim)
+    if sector_masks is None:
+        volumes = [(volume, image_name)]
+    elif etdrs_mode == "split":
+        volumes = [(volume, f"{image_name}_full")]
+    else:
+        volumes = ((volume.masked(mask), f"{image_name}_{suffix}") for suffix, mask in sector_masks.items())
+    # The masked volumes are created one at a time from the full volume, so the loop must not rebind `volume`
+    for job_volume, volume_name in volumes:
+        kwargs = dict(volume=job_volume, header=header, image_name=volume_name, outdir=outdir, DOCKER_WORK_DIR=DOCKER_WORK_DIR + work_subdir, image=image)
+        if variants is not None:
+            kwargs["variants"] = variants
+        yield kwargs
+
+def voreen_batch_graphs(
+        ves_seg_paths: list[str],
+        source_dir: str,
+        tmp_dir: str,
+        output_dir: str,
+        container_name: str,
+        faz_code_name_map: dict[str, str] = None,
+        color_thresholds: list[float] = None,
+        z_dim: int = 64,
+        bulge_size: float = 3.0,
+        voreen_workspace: str = project_folder + "/voreen/feature-vesselgraphextraction_customized_command_line.vws",
+        graph_image: bool = True,
+        colorize: str = "continuous",
+        verbose: bool = False,
+        mm: float = 3.0,
+        radius_correction_factor: float = -1.0,
+        etdrs: bool = False,
+        etdrs_mode: Literal["masked", "split"] = "masked",
+        voreen_batch_size: int = 1,
+        crop_volumes: bool = False,
+        **kwargs) -> dict[str, dict[str, str]]:
+    """
+    Extracts the graphs of multiple vessel segmentations with Voreen, running one voreentool process per batch of `voreen_batch_size` volumes.
+    The outputs are identical to calling `full_graph` or `etdrs_graph` for each segmentation.
+    With `crop_volumes`, each volume is cropped to its non-zero voxels before it is sent to Voreen, see `prepare_voreen_job`.
+
+    Returns:
+        dict[str, dict[str, str]]: Map from vessel segmentation to its graphs as returned by `full_graph` or `etdrs_graph`.
+            Segmentations whose extraction failed are missing.
+    """
+    sector_masks = {p: _etdrs_sector_masks(p, faz_code_name_map) if etdrs else None for p in ves_seg_paths}
+    graphs = {p: {} for p in ves_seg_paths if etdrs and sector_masks[p] is None}
+    paths = [p for p in ves_seg_paths if p not in graphs]
+    split = etdrs and etdrs_mode == "split"
+
+    volumes = (volume for p in paths for volume in _voreen_volumes(p, source_dir, output_dir, z_dim, sector_masks[p], etdrs_mode))
+    results = extract_vessel_graphs(
+        volumes,
+        tmp_dir=tmp_dir,
+        bulge_size=bulge_size,
+        workspace_file=voreen_workspace,
+        container_name=container_name,
+        batch_size=voreen_batch_size,
+        graph_image=graph_image and not split,
+        colorize=colorize,
+        color_thresholds=color_thresholds,
+        verbose=bool(verbose),
+        radius_correction_factor=radius_correction_factor,
+        image_size_mm=mm,
+        crop=crop_volumes
+    )
+
+    # Demultiplex the results into the graphs of each image
+    i = 0
+    for p in paths:
+        num_volumes = len(sector_masks[p]) if etdrs and not split else 1
+        image_results, i = results[i:i+num_volumes], i+num_volumes
+        if any(r is None for r in image_results):
+            continue
+        graphs[p] = _finish_voreen_image(
+            p, sector_masks[p], source_dir=source_dir, output_dir=output_dir, graph_image=graph_image, colorize=colorize,
+            color_thresholds=color_thresholds, mm=mm, radius_correction_factor=radius_correction_factor, etdrs_mode=etdrs_mode
         )
+    return graphs
 
-def perform_graph_feature_extraction(
+def voreen_sweep_graphs(
+        ves_seg_paths: list[str],
+        source_dir: str,
         tmp_dir: str,
         output_dir: str,
-        image_files: str,
-        faz_dir: str = None,
-        thresholds: str = None,
-        voreen_image_name: str="voreen",
+        container_name: str,
+        bulge_sizes: list[float],
+        faz_code_name_map: dict[str, str] = None,
+        color_thresholds: list[float] = None,
+        z_dim: int = 64,
+        voreen_workspace: str = project_folder + "/voreen/feature-vesselgraphextraction_customized_command_line.vws",
+        graph_image: bool = True,
+        colorize: str = "continuous",
+        verbose: bool = False,
+        mm: float = 3.0,
+        radius_correction_factor: float = -1.0,
         etdrs: bool = False,
+        etdrs_mode: Literal["masked", "split"] = "masked",
+        voreen_batch_size: int = 1,
+        crop_volumes: bool = False,
+        **kwargs) -> dict[str, dict[float, dict[str, str]]]:
+    """
+    Extracts the graphs of multiple vessel segmentations with Voreen once per bulge size.
+    Each volume is saved once, and its processing chains for all bulge sizes are sent to the same voreentool run (see `job_variants`),
+    so the conversion to 3D, the NIFTI export and the startup of Voreen are not repeated per bulge size.
+    The graphs of each bulge size are identical to calling `voreen_batch_graphs` with that bulge size and its `sweep_output_dir`.
+
+    Returns:
+        dict[str, dict[float, dict[str, str]]]: Map from vessel segmentation to bulge size to its graphs as returned by `full_graph` or `etdrs_graph`.
+            Failed extractions are missing.
+    """
+    sector_masks = {p: _etdrs_sector_masks(p, faz_code_name_map) if etdrs else None for p in ves_seg_paths}
+    graphs = {p: {} for p in ves_seg_paths if etdrs and sector_masks[p] is None}
+    paths = [p for p in ves_seg_paths if p not in graphs]
+    split = etdrs and etdrs_mode == "split"
+
+    volumes = (volume for p in paths for volume in _voreen_volumes(p, source_dir, output_dir, z_dim, sector_masks[p], etdrs_mode, bulge_sizes))
+    results = extract_vessel_graphs(
+        volumes,
+        tmp_dir=tmp_dir,
+        bulge_size=None,
+        workspace_file=voreen_workspace,
+        container_name=container_name,
+        batch_size=voreen_batch_size,
+        graph_image=graph_image and not split,
+        colorize=colorize,
+        color_thresholds=color_thresholds,
+        verbose=bool(verbose),
+        radius_correction_factor=radius_correction_factor,
+        image_size_mm=mm,
+        crop=crop_volumes
+    )
+
+    # The results of an image are ordered by volume, then by bulge size
+    i = 0
+    for p in paths:
+        num_results = (len(sector_masks[p]) if etdrs and not split else 1) * len(bulge_sizes)
+        image_results, i = results[i:i+num_results], i+num_results
+        graphs[p] = dict()
+        for j, bulge_size in enumerate(bulge_sizes):
+            if any(r is None for r in image_results[j::len(bulge_sizes)]):
+                continue
+            graphs[p][bulge_size] = _finish_voreen_image(
+                p, sector_masks[p], source_dir=source_dir, output_dir=sweep_output_dir(output_dir, bulge_size), graph_image=graph_image,
+                colorize=colorize, color_thresholds=color_thresholds, mm=mm, radius_correction_factor=radius_correction_factor, etdrs_mode=etdrs_mode
+            )
+    return graphs
+
+def _prepare_voreen_image(
+        ves_seg_path: str,
+        source_dir: str,
+        tmp_dir: str,
+        output_dir: str,
+        container_name: str,
+        faz_code_name_map: dict[str, str] = None,
+        z_dim: int = 64,
+        etdrs: bool = False,
+        etdrs_mode: Literal["masked", "split"] = "masked",
+        crop_volumes: bool = False,
+        **kwargs) -> tuple[list[dict], dict[str, np.ndarray]]:
+    """
+    Saves the Voreen input volumes of a vessel segmentation. Preprocessing step of `schedule_voreen_extraction`.
+
+    Returns:
+        tuple[list[dict], dict[str, np.ndarray]]: The Voreen jobs (see `prepare_voreen_job`) and the ETDRS sector masks,
+            or None if no FAZ segmentation was found for ETDRS analysis.
+    """
+    sector_masks = _etdrs_sector_masks(ves_seg_path, faz_code_name_map) if etdrs else None
+    if etdrs and sector_masks is None:
+        return None
+    jobs = [
+        prepare_voreen_job(tmp_dir=tmp_dir, container_name=container_name, crop=crop_volumes, **volume)
+        for volume in _voreen_volumes(ves_seg_path, source_dir, output_dir, z_dim, sector_masks, etdrs_mode)
+    ]
+    return jobs, sector_masks
+
+def _finish_voreen_image(
+        ves_seg_path: str,
+        sector_masks: dict[str, np.ndarray],
+        source_dir: str,
+        output_dir: str,
+        graph_image: bool = True,
+        colorize: str = "continuous",
+        color_thresholds: list[float] = None,
+        mm: float = 3.0,
+        radius_correction_factor: float = -1.0,
+        etdrs_mode: Literal["masked", "split"] = "masked",
+        **kwargs) -> dict[str, str]:
+    """
+    Returns the graphs of a vessel segmentation after all its Voreen jobs were collected. In "split" mode, the full graph is split into the ETDRS sectors.
+    """
+    if sector_masks is None:
+        return {"": _graph_prefix(ves_seg_path, source_dir, output_dir)}
+    if etdrs_mode == "split":
+        image_name = os.path.basename(_graph_prefix(ves_seg_path, source_dir, output_dir))
+        with image_context(image_id(ves_seg_path)):
+            split_graph_by_sectors(
+                outdir=os.path.dirname(_graph_prefix(ves_seg_path, source_dir, output_dir, "C0")),
+                full_name=f"{image_name}_full",
+                image_name=image_name,
+                sector_masks=sector_masks,
+                ves_seg=_load_2d_segmentation(ves_seg_path),
+                graph_image=graph_image,
+                colorize=colorize,
+                color_thresholds=color_thresholds,
+                radius_correction_factor=radius_correction_factor,
+                image_size_mm=mm
+            )
+    return {suffix: _graph_prefix(ves_seg_path, source_dir, output_dir, suffix) for suffix in sector_masks}
+
+def _image_task(task: Callable[[str], dict[str, str]], ves_seg_path: str) -> dict[str, str]:
+    """Runs the graph extraction of one image. Profiling spans are attributed to the image."""
+    with image_context(image_id(ves_seg_path)):
+        return task(ves_seg_path)
+
+def _map_images(ves_seg_paths: list[str], task: Callable[[str], dict[str, str]]) -> dict[str, dict[str, str]]:
+    return {p: _image_task(task, p) for p in ves_seg_paths}
+
+def _tile_volume(ves_seg_path: str, tile: tuple[slice, slice], z_dim: int = 64) -> tuple[SlabVolume, object]:
+    """
+    Opens the region of a tile of a vessel segmentation as volume in the coordinates of the whole segmentation, see `SlabVolume.cropped`.
+    The height map of a 2D segmentation is only computed for the tile.
+
+    Returns:
+        tuple[SlabVolume, nib.Nifti1Header]: The volume and the header of a NIFTI file, or None for 2D images.
+    """
+    if is_nifti(ves_seg_path):
+        volume, header = SlabVolume.from_file(ves_seg_path)
+    else:
+        ves_seg = _load_2d_segmentation(ves_seg_path)
+        height_map = np.full(ves_seg.shape, -1, dtype=np.int32)
+        height_map[tile] = compute_height_map(ves_seg[tile])
+        volume, header = SlabVolume(height_map=height_map, z_dim=z_dim), None
+    return volume.cropped((*tile, slice(0, volume.full_shape[2]))), header
+
+def _extract_tile(
+        ves_seg_path: str,
+        tile: tuple[slice, slice],
+        index: int,
+        source_dir: str,
+        tmp_dir: str,
+        output_dir: str,
+        container_name: str,
         z_dim: int = 64,
         bulge_size: float = 3.0,
         voreen_workspace: str = project_folder + "/voreen/feature-vesselgraphextraction_customized_command_line.vws",
+        verbose: bool = False,
+        backend: Literal["voreen", "native"] = "voreen",
+        etdrs: bool = False,
+        crop_volumes: bool = False,
+        **kwargs) -> tuple[dict, pd.DataFrame, pd.DataFrame]:
+    """
+    Extracts the graph of one tile of a vessel segmentation, see `utils.graph_tiling`.
+
+    Returns:
+        tuple[dict, pd.DataFrame, pd.DataFrame]: The graph, node table and edge table of the tile in the coordinates of the whole segmentation.
+    """
+    if backend == "native":
+        with span("graph_extraction"):
+            graph_json = build_skeleton_graph(_load_2d_segmentation(ves_seg_path)[tile], z_dim=z_dim)
+            df_nodes, df_edges = graph_to_tables(graph_json)
+        shift_graph(graph_json, df_nodes, (tile[0].start, tile[1].start, 0))
+        return graph_json, df_nodes, df_edges
+
+    # The tile files are written next to the graph files of the image and removed once they are read
+    image_name = os.path.basename(_graph_prefix(ves_seg_path, source_dir, output_dir))
+    outdir = os.path.dirname(_graph_prefix(ves_seg_path, source_dir, output_dir, "C0" if etdrs else ""))
+    os.makedirs(outdir, exist_ok=True)
+    with span("convert_2d_to_3d"):
+        volume, header = _tile_volume(ves_seg_path, tile, z_dim)
+    tile_name = f"{image_name}_tile{index}"
+    results = extract_vessel_graphs(
+        [dict(
+            volume=volume, header=header, image_name=tile_name, outdir=outdir, image=image_id(ves_seg_path),
+            DOCKER_WORK_DIR=f"{DOCKER_WORK_DIR}/{image_name}" if etdrs else DOCKER_WORK_DIR
+        )],
+        tmp_dir=tmp_dir,
+        bulge_size=bulge_size,
+        workspace_file=voreen_workspace,
+        container_name=container_name,
+        graph_image=False,
+        verbose=bool(verbose),
+        crop=crop_volumes
+    )
+    if results[0] is None:
+        raise Exception(f"Graph extraction failed for tile {index} of {ves_seg_path}.")
+    prefix = os.path.join(outdir, tile_name)
+    df_nodes = pd.read_csv(prefix + "_nodes.csv", sep=";", index_col=0)
+    df_edges = pd.read_csv(prefix + "_edges.csv", sep=";", index_col=0)
+    with open(prefix + "_graph.json", "r") as file:
+        graph_json = json.load(file)
+    for suffix in GRAPH_FILE_SUFFIXES:
+        if os.path.isfile(prefix + suffix):
+            os.remove(prefix + suffix)
+    return graph_json, df_nodes, df_edges
+
+def _stitch_tiles(
+        ves_seg_path: str,
+        tiles: list[tuple[dict, pd.DataFrame, pd.DataFrame]],
+        cores: list[tuple[slice, slice]],
+        source_dir: str,
+        output_dir: str,
+        faz_code_name_map: dict[str, str] = None,
+        z_dim: int = 64,
         graph_image: bool = True,
         colorize: str = "continuous",
-        verbose: bool = False,
+        color_thresholds: list[float] = None,
         mm: float = 3.0,
         radius_correction_factor: float = -1.0,
-        threads: int = cpu_count() - 1,
-        **kwargs
-):
-    global DOCKER_WORK_DIR, DOCKER_VOREEN_BIN
-    # Clean tmpdir
-    if os.path.exists(tmp_dir):
-        os.system(f"rm -rf '{os.path.join(tmp_dir, "*")}'")
+        backend: Literal["voreen", "native"] = "voreen",
+        etdrs: bool = False,
+        **kwargs) -> dict[str, str]:
+    """
+    Stitches the tile graphs of a vessel segmentation and writes the graph files of the image like `full_graph`,
+    or like `etdrs_graph` in "split" mode. The sanity checks of the backend are applied to the stitched graph.
+    """
+    sector_masks = _etdrs_sector_masks(ves_seg_path, faz_code_name_map) if etdrs else None
+    if etdrs and sector_masks is None:
+        return {}
+    ves_seg = _load_2d_segmentation(ves_seg_path)
+    with span("graph_stitching"):
+        graph_json, df_nodes, df_edges = stitch_tile_graphs(tiles, cores, ves_seg.shape)
+    with span("csv_filter"):
+        # Constant radii are common for short edges in 2D, so only the Voreen-independent checks are applied to native graphs
+        df_edges, df_nodes = sanity_filter(df_edges, df_nodes, z_dim=z_dim, require_radius_variation=backend == "voreen")
+    prefix = _graph_prefix(ves_seg_path, source_dir, output_dir, "full" if etdrs else "")
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    write_graph_files(graph_json, os.path.dirname(prefix), os.path.basename(prefix), df_nodes=df_nodes, df_edges=df_edges)
+    if etdrs:
+        return _finish_voreen_image(
+            ves_seg_path, sector_masks, source_dir=source_dir, output_dir=output_dir, graph_image=graph_image, colorize=colorize,
+            color_thresholds=color_thresholds, mm=mm, radius_correction_factor=radius_correction_factor, etdrs_mode="split"
+        )
+    if graph_image:
+        with span("graph_rendering"):
+            save_graph_image(
+                graph_json,
+                df_edges,
+                segmentation_2d_mask=ves_seg,
+                path=prefix + "_graph.png",
+                image_size_mm=mm,
+                colorize=colorize,
+                color_thresholds=color_thresholds,
+                radius_correction_factor=radius_correction_factor
+            )
+    return {"": prefix}
 
-    ves_seg_files = [p for p in natsorted(glob.glob(image_files, recursive=True))]
-    assert len(ves_seg_files)>0, f"Found no matching vessel segmentation files for path {image_files}!"
-    source_dir = os.path.dirname(os.path.commonprefix(ves_seg_files))
+def _extract_tiled(
+        ves_seg_paths: list[str],
+        tile_task: Callable,
+        stitch_task: Callable,
+        tile_size: int,
+        tile_overlap: int,
+        threads: int) -> dict[str, dict[str, str]]:
+    """
+    Extracts the graphs of vessel segmentations tile by tile, see `utils.graph_tiling`. The tiles of all images share the worker processes,
+    so a single large image uses all of them. Each image is stitched by a worker as soon as all its tiles are done.
 
-    color_thresholds = [float(t) for t in thresholds.split(",")] if thresholds is not None else None
+    Args:
+        tile_task (Callable): `_extract_tile` with all arguments but the segmentation, the tile and its index.
+        stitch_task (Callable): `_stitch_tiles` with all arguments but the segmentation, the tile graphs and the cores.
+
+    Returns:
+        dict[str, dict[str, str]]: Map from vessel segmentation to its graphs. Segmentations whose extraction failed are missing.
+    """
+    graphs = dict()
+    boxes = {p: tile_boxes(segmentation_shape(p), tile_size, tile_overlap) for p in ves_seg_paths}
+    tiles = {p: [None] * len(boxes[p]) for p in ves_seg_paths}
+    remaining = {p: len(boxes[p]) for p in ves_seg_paths}
+    failed = set()
+    with tqdm(total=len(ves_seg_paths), desc="Extracting graph features...") as pbar:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+            # The stitching task of an image has the tile index None
+            running = {
+                executor.submit(_image_task, partial(tile_task, tile=tile, index=i), p): (p, i)
+                for p in ves_seg_paths for i, (tile, _) in enumerate(boxes[p])
+            }
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    p, i = running.pop(future)
+                    if future.exception() is not None:
+                        print(f"Graph extraction failed for {p}:\n{future.exception()}")
+                        failed.add(p)
+                    if i is None:
+                        if p not in failed:
+                            graphs[p] = future.result()
+                        pbar.update(1)
+                        continue
+                    if p not in failed:
+                        tiles[p][i] = future.result()
+                    remaining[p] -= 1
+                    if remaining[p] > 0:
+                        continue
+                    if p in failed:
+                        pbar.update(1)
+                    else:
+                        stitch = partial(stitch_task, tiles=tiles.pop(p), cores=[core for _, core in boxes[p]])
+                        running[executor.submit(_image_task, stitch, p)] = (p, None)
+    return graphs
 
+def _voreen_volumes_map(tmp_dir: str, source_dir: str, host_output_dir: str) -> dict[str, dict[str, str]]:
+    return {
+        tmp_dir: {'bind': "/var/tmp", 'mode': 'rw'},
+        source_dir: {'bind': "/var/src", 'mode': 'ro'},
+        host_output_dir: {'bind': DOCKER_WORK_DIR, 'mode': 'rw'}
+    }
+
+def _start_voreen_container(
+        tmp_dir: str,
+        source_dir: str,
+        output_dir: str,
+        voreen_image_name: str,
+        verbose: bool = False,
+        voreen_containers: int = 1,
+        voreen_container_concurrency: int = 1
+    ) -> tuple[str | VoreenContainerPool, str]:
+    """
+    Finds a running Voreen container or starts a new one with the required volume bindings.
+    With `voreen_containers` > 1, a pool of new containers is started instead, see `utils.voreen_container_pool`.
+    If the environment variable `VOREEN_TOOL_PATH` is set, the voreentool in that folder is run on the host instead.
+
+    Args:
+        voreen_containers (int): Number of Voreen containers.
+        voreen_container_concurrency (int): Maximum number of concurrent voreentool runs per container of a pool.
+
+    Returns:
+        tuple[str | VoreenContainerPool, str]: The container name or pool and the Voreen working directory inside the container.
+            Without container, None and the output directory.
+    """
+    if os.getenv("VOREEN_TOOL_PATH"):
+        if verbose:
+            print(f"Using the local voreentool in {os.getenv('VOREEN_TOOL_PATH')}.")
+        return None, output_dir
     container_name = None
     # Check if we're running in Docker (DooD setup)
     running_in_docker = os.path.exists("/.dockerenv")
     load_dotenv("/tmp/.env" if running_in_docker else None)
     HOST_OUTPUT_DIR = os.getenv("HOST_OUTPUT_DIR")
+
+    if voreen_containers > 1:
+        # All containers of the pool have the same bindings, so each job can run in any of them
+        HOST_OUTPUT_DIR = HOST_OUTPUT_DIR if running_in_docker else output_dir
+        pool = VoreenContainerPool.start(
+            voreen_image_name, _voreen_volumes_map(tmp_dir, source_dir, HOST_OUTPUT_DIR),
+            size=voreen_containers, max_concurrency=voreen_container_concurrency
+        )
+        print(f"Started {voreen_containers} Voreen containers with at most {voreen_container_concurrency} concurrent runs each: "
+              + ", ".join(pool.container_names()))
+        subfolder = "/" + str(output_dir).removeprefix(HOST_OUTPUT_DIR).removeprefix("/")
+        return pool, DOCKER_WORK_DIR + subfolder
     
     # Check if a voreen container from docker compose is already running
     docker_compose_container = None
@@ -218,22 +790,7 @@ def perform_graph_feature_extraction(
             if verbose:
                 print(f"No running container for image {voreen_image_name} found. Starting a new container...")
             HOST_OUTPUT_DIR = output_dir # .env file shoudl only be used in DooD setup
-            container = client.containers.run(
-                image=voreen_image_name,
-                detach=True,
-                tty=True,
-                stdin_open=True,
-                command="tail -f /dev/null",
-                user=f"{os.getuid()}:{os.getgid()}",
-                volumes={
-                    tmp_dir: {'bind': "/var/tmp", 'mode': 'rw'},
-                    source_dir: {'bind': "/var/src", 'mode': 'ro'},
-                    HOST_OUTPUT_DIR: {'bind': DOCKER_WORK_DIR, 'mode': 'rw'}
-                },
-            )
-            container_name = container.name
-            # Ensure Voreen can write to its internal data directory
-            container.exec_run(user="root", cmd=f"chmod 777 -R {DOCKER_VOREEN_BIN}/../data")
+            container_name = start_voreen_container(voreen_image_name, _voreen_volumes_map(tmp_dir, source_dir, HOST_OUTPUT_DIR))
             print(f"Started new Voreen container: {container_name} with volume mapping:\n"
                   f"  - {tmp_dir} <-> /var/tmp\n"
                   f"  - {source_dir} <-> /var/src\n"
@@ -250,22 +807,7 @@ def perform_graph_feature_extraction(
         if container_name is None:
             if verbose:
                 print(f"No running container for image {voreen_image_name} found. Starting a new container...")
-            container = client.containers.run(
-                image=voreen_image_name,
-                detach=True,
-                tty=True,
-                stdin_open=True,
-                command="tail -f /dev/null",
-                user=f"{os.getuid()}:{os.getgid()}",
-                volumes={
-                    tmp_dir: {'bind': "/var/tmp", 'mode': 'rw'},
-                    source_dir: {'bind': "/var/src", 'mode': 'ro'},
-                    HOST_OUTPUT_DIR: {'bind': DOCKER_WORK_DIR, 'mode': 'rw'}
-                },
-            )
-            container_name = container.name
-            # Ensure Voreen can write to its internal data directory
-            container.exec_run(user="root", cmd=f"chmod 777 -R {DOCKER_VOREEN_BIN}/../data")
+            container_name = start_voreen_container(voreen_image_name, _voreen_volumes_map(tmp_dir, source_dir, HOST_OUTPUT_DIR))
             if verbose:
                 print(f"Started new Voreen container: {container_name} with volume mapping:\n"
                     f"  - {tmp_dir} -> /var/tmp\n"
@@ -279,77 +821,256 @@ def perform_graph_feature_extraction(
     subfolder = "/" + str(output_dir).removeprefix(HOST_OUTPUT_DIR).removeprefix("/")
     if verbose:
         print(f"Running in Docker container with subfolder {subfolder}.")
-    DOCKER_WORK_DIR = DOCKER_WORK_DIR + subfolder
+    return container_name, DOCKER_WORK_DIR + subfolder
+
+def _stop_voreen_container(container_name: str | VoreenContainerPool, tmp_dir: str):
+    """
+    Stops and removes the Voreen container, or all containers of a pool, and cleans the temporary directory.
+    """
+    if isinstance(container_name, VoreenContainerPool):
+        container_name.close()
+    else:
+        client = docker.from_env()
+        container = client.containers.get(container_name)
+        container.stop()
+        container.remove()
+        print(f"Container '{container_name}' stopped and removed.")
+    try:
+        clear_dir(tmp_dir)
+        print(f"Temporary directory {tmp_dir} cleaned up successfully.")
+    except OSError:
+        print(f"Failed to clean up temporary directory {tmp_dir}.")
+
+
+def perform_graph_feature_extraction(
+        tmp_dir: str,
+        output_dir: str,
+        image_files: str,
+        faz_dir: str = None,
+        thresholds: str = None,
+        voreen_image_name: str="voreen",
+        etdrs: bool = False,
+        z_dim: int = 64,
+        bulge_size: float = 3.0,
+        voreen_workspace: str = project_folder + "/voreen/feature-vesselgraphextraction_customized_command_line.vws",
+        graph_image: bool = True,
+        colorize: str = "continuous",
+        verbose: bool = False,
+        mm: float = 3.0,
+        radius_correction_factor: float = None,
+        threads: int = cpu_count() - 1,
+        backend: Literal["voreen", "native"] = "voreen",
+        etdrs_mode: Literal["masked", "split"] = "masked",
+        manifest: str = None,
+        incremental: bool = False,
+        voreen_batch_size: int = 1,
+        scheduler: Literal["process_pool", "async"] = "process_pool",
+        voreen_concurrency: int = 1,
+        voreen_containers: int = 1,
+        voreen_container_concurrency: int = 1,
+        memory_budget: float = None,
+        memory_profile: str = None,
+        crop_volumes: bool = False,
+        tile_size: int = None,
+        tile_overlap: int = 64,
+        bulge_sizes: str = None,
+        **kwargs
+):
+    global DOCKER_WORK_DIR
+    assert not incremental or manifest is not None, "Incremental processing requires a manifest."
+    radius_correction_factor = resolve_radius_correction_factor(backend, radius_correction_factor)
+    if bulge_sizes is not None:
+        bulge_sizes = [float(b) for b in bulge_sizes.split(",")]
+        assert backend == "voreen", "Only the voreen backend has a bulge size."
+        assert output_dir is not None, "A bulge size sweep writes the graphs of each bulge size to a subfolder of the output folder."
+        assert not incremental and tile_size is None and scheduler == "process_pool" and memory_budget is None, \
+            "A bulge size sweep supports neither incremental processing, tiling, the async scheduler nor a memory budget."
+    if tile_size is not None:
+        assert not etdrs or etdrs_mode == "split", "Tiled extraction stitches the graph of the whole image, so ETDRS analysis requires the 'split' mode."
+        assert scheduler == "process_pool" and memory_budget is None, "Tiled extraction schedules the tiles itself and supports neither the async scheduler nor a memory budget."
+    # Clean tmpdir
+    clear_dir(tmp_dir)
+
+    # Without a manifest, index the given files in memory
+    dataset = Manifest(manifest) if manifest is not None else Manifest.build(":memory:", natsorted(glob.glob(image_files, recursive=True)))
+    ves_seg_files = dataset.segmentations()
+    assert len(ves_seg_files)>0, f"Found no matching vessel segmentation files for path {image_files}!"
+    source_dir = os.path.dirname(os.path.commonprefix(ves_seg_files))
+
+    color_thresholds = [float(t) for t in thresholds.split(",")] if thresholds is not None else None
 
     if etdrs:
-        assert bool(faz_dir)
-        faz_seg_files = natsorted(glob.glob(f'{faz_dir}/**/*.*', recursive=True))
+        if not dataset.faz_files():
+            assert bool(faz_dir)
+            dataset.add_faz(natsorted(glob.glob(f'{faz_dir}/**/*.*', recursive=True)))
+        faz_seg_files = dataset.faz_files()
         assert len(faz_seg_files)>0, f"Found no matching FAZ files at path {faz_dir}! Note, this script currently only supports .png, .jpg, and .bmp faz segmentation files."
         faz_code_name_map = {get_code_name(path): path for path in faz_seg_files if ("dvc" in path.lower()) or ("dcp" in path.lower())}
-        task = partial(
-            etdrs_graph,
-            source_dir=source_dir,
-            tmp_dir=tmp_dir,
-            output_dir=output_dir,
-            container_name=container_name,
-            faz_code_name_map=faz_code_name_map,
-            color_thresholds=color_thresholds,
-            z_dim=z_dim,
-            bulge_size=bulge_size,
-            voreen_workspace=voreen_workspace,
-            graph_image=graph_image,
-            colorize=colorize,
-            verbose=verbose,
-            mm=mm,
-            radius_correction_factor=radius_correction_factor
+
+    if incremental:
+        # The graphs of an image depend on the segmentation, the FAZ for ETDRS analysis, the Voreen workspace and the extraction parameters
+        inputs = dict()
+        for path in ves_seg_files:
+            inputs[path] = [path]
+            if etdrs and _faz_code_name(path) in faz_code_name_map:
+                inputs[path].append(faz_code_name_map[_faz_code_name(path)])
+            if backend == "voreen":
+                inputs[path].append(voreen_workspace)
+        params = {
+            "backend": backend, "z_dim": z_dim, "mm": mm, "radius_correction_factor": radius_correction_factor,
+            "graph_image": graph_image, "colorize": colorize, "thresholds": color_thresholds,
+            "etdrs": etdrs, "etdrs_mode": etdrs_mode if etdrs else None, "bulge_size": bulge_size if backend == "voreen" else None
+        }
+        if crop_volumes and backend == "voreen":
+            # Only added when enabled, so that the fingerprints of earlier runs stay valid
+            params["crop_volumes"] = True
+        if tile_size is not None:
+            params.update(tile_size=tile_size, tile_overlap=tile_overlap)
+        fingerprints, reused, ves_seg_files, duplicates = dataset.plan_incremental(
+            "graph", inputs, params, is_complete=lambda graphs: all(os.path.isfile(p + "_edges.csv") for p in graphs.values())
+        )
+        for path, graphs in reused.items():
+            dataset.add_graphs(graphs, segmentation=path)
+        print(f"Skipping {len(reused)} unchanged images.")
+    extracted_graphs: dict[str, dict[str, str]] = dict()
+
+    container_name = None
+    if backend == "voreen" and ves_seg_files:
+        container_name, DOCKER_WORK_DIR = _start_voreen_container(
+            tmp_dir, source_dir, output_dir, voreen_image_name, verbose=verbose,
+            voreen_containers=voreen_containers, voreen_container_concurrency=voreen_container_concurrency
         )
+
+    task_kwargs = dict(
+        source_dir=source_dir,
+        tmp_dir=tmp_dir,
+        output_dir=output_dir,
+        container_name=container_name,
+        color_thresholds=color_thresholds,
+        z_dim=z_dim,
+        bulge_size=bulge_size,
+        voreen_workspace=voreen_workspace,
+        graph_image=graph_image,
+        colorize=colorize,
+        verbose=verbose,
+        mm=mm,
+        radius_correction_factor=radius_correction_factor,
+        crop_volumes=crop_volumes
+    )
+    if etdrs:
+        task_kwargs.update(faz_code_name_map=faz_code_name_map, etdrs_mode=etdrs_mode)
+    if backend == "voreen":
+        # Each task extracts the volumes of multiple images with one voreentool run per batch
+        volumes_per_image = 5 if etdrs and etdrs_mode == "masked" else 1
+        if bulge_sizes is not None:
+            # Each volume is extracted once per bulge size in the same voreentool run
+            volumes_per_image *= len(bulge_sizes)
+        images_per_task = max(1, voreen_batch_size // volumes_per_image)
+        if bulge_sizes is not None:
+            task = partial(voreen_sweep_graphs, bulge_sizes=bulge_sizes, etdrs=etdrs, voreen_batch_size=voreen_batch_size, **task_kwargs)
+        else:
+            task = partial(voreen_batch_graphs, etdrs=etdrs, voreen_batch_size=voreen_batch_size, **task_kwargs)
     else:
-        task = partial(
-            full_graph,
-            source_dir=source_dir,
-            tmp_dir=tmp_dir,
-            output_dir=output_dir,
-            container_name=container_name,
-            color_thresholds=color_thresholds,
-            z_dim=z_dim,
-            bulge_size=bulge_size,
-            voreen_workspace=voreen_workspace,
-            graph_image=graph_image,
-            colorize=colorize,
-            verbose=verbose,
-            mm=mm,
-            radius_correction_factor=radius_correction_factor
-            )
+        images_per_task = 1
+        task = partial(_map_images, task=partial(etdrs_graph if etdrs else full_graph, backend=backend, **task_kwargs))
+    image_batches = [ves_seg_files[i:i+images_per_task] for i in range(0, len(ves_seg_files), images_per_task)]
+
+    # With a memory budget [GiB], jobs are admitted by their estimated memory, and their measured peak RSS improves later estimates
+    budget_bytes = int(memory_budget * 2**30) if memory_budget is not None else None
+    memory = None
+    if memory_budget is not None:
+        memory = MemoryProfile(memory_profile or os.path.join(output_dir or source_dir, "memory_profile.json"))
+        memory_job_type = job_type(backend, etdrs, etdrs_mode)
 
     if verbose:
         print(f"Using {threads} threads for graph feature extraction.")
     try:
-        if threads>1:
+        if tile_size is not None and ves_seg_files:
+            # The tiles of all images are extracted in parallel and stitched per image
+            extracted_graphs.update(_extract_tiled(
+                ves_seg_files,
+                tile_task=partial(_extract_tile, backend=backend, etdrs=etdrs, **task_kwargs),
+                stitch_task=partial(_stitch_tiles, backend=backend, etdrs=etdrs, **task_kwargs),
+                tile_size=tile_size,
+                tile_overlap=tile_overlap,
+                threads=threads
+            ))
+        elif backend == "voreen" and scheduler == "async" and ves_seg_files:
+            # Separate pools for pre- and postprocessing, and at most voreen_concurrency voreentool runs in the container
+            with tqdm(total=len(ves_seg_files), desc="Extracting graph features...") as pbar:
+                def on_done(path: str, graphs: dict[str, str]):
+                    if graphs is not None:
+                        extracted_graphs[path] = graphs
+                    pbar.update(1)
+                split = etdrs and etdrs_mode == "split"
+                schedule_voreen_extraction(
+                    ves_seg_files,
+                    prepare=partial(_prepare_voreen_image, etdrs=etdrs, **task_kwargs),
+                    run_batch=partial(run_voreen_batch, workspace_file=voreen_workspace, bulge_size=bulge_size, container_name=container_name, verbose=bool(verbose)),
+                    collect=partial(
+                        collect_voreen_job, graph_image=graph_image and not split, colorize=colorize, color_thresholds=color_thresholds,
+                        radius_correction_factor=radius_correction_factor, image_size_mm=mm
+                    ),
+                    finish=partial(_finish_voreen_image, **task_kwargs),
+                    on_done=on_done,
+                    batch_size=voreen_batch_size,
+                    voreen_concurrency=voreen_concurrency,
+                    preprocess_workers=threads,
+                    postprocess_workers=threads,
+                    memory_budget=budget_bytes,
+                    estimate=(lambda path: memory.estimate(memory_job_type, [path], z_dim)) if memory is not None else None,
+                    on_peak_rss=(lambda path, peak: memory.record(memory_job_type, [path], peak)) if memory is not None else None
+                )
+        elif threads>1:
             # Multi processing
             with tqdm(total=len(ves_seg_files), desc="Extracting graph features...") as pbar:
                 with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
-                    future_dict = {executor.submit(task, ves_seg_files[i]): i for i in range(len(ves_seg_files))}
-                    for _ in concurrent.futures.as_completed(future_dict):
-                        pbar.update(1)
-        else:
+                    estimates = [memory.estimate(memory_job_type, image_batch, z_dim) if memory is not None else 0 for image_batch in image_batches]
+                    for image_batch, future in submit_within_budget(executor, partial(measure_peak_rss, task), image_batches, estimates, budget_bytes):
+                        if future.exception() is None:
+                            graphs, peak = future.result()
+                            extracted_graphs.update(graphs)
+                            if memory is not None:
+                                memory.record(memory_job_type, image_batch, peak)
+                        pbar.update(len(image_batch))
+        elif ves_seg_files:
             # Single processing
-            for ves_seg_path in tqdm(ves_seg_files, desc="Extracting graph features..."):
-                task(ves_seg_path)
+            with tqdm(total=len(ves_seg_files), desc="Extracting graph features...") as pbar:
+                for image_batch in image_batches:
+                    graphs, peak = measure_peak_rss(task, image_batch)
+                    extracted_graphs.update(graphs)
+                    if memory is not None:
+                        memory.record(memory_job_type, image_batch, peak)
+                    pbar.update(len(image_batch))
+        for path, graphs in extracted_graphs.items():
+            if bulge_sizes is not None:
+                # The graphs of a sweep are analysed per bulge size folder and are not registered
+                continue
+            dataset.add_graphs(graphs, segmentation=path)
+            if incremental:
+                dataset.record("graph", path, fingerprints[path], graphs)
+        if incremental:
+            # Identical images are extracted once and their graph files are copied
+            for path, source in duplicates.items():
+                source_graphs = reused.get(source, extracted_graphs.get(source))
+                if source_graphs is None:
+                    continue
+                graphs = {sector: _graph_prefix(path, source_dir, output_dir, sector) for sector in source_graphs}
+                for sector, prefix in graphs.items():
+                    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+                    for suffix in GRAPH_FILE_SUFFIXES:
+                        if os.path.isfile(source_graphs[sector] + suffix):
+                            copy_file(source_graphs[sector] + suffix, prefix + suffix)
+                dataset.add_graphs(graphs, segmentation=path)
+                dataset.record("graph", path, fingerprints[path], graphs)
     except Exception as e:
         print(f"An error occurred during graph feature extraction:\n{e}")
     finally:
+        dataset.close()
+        if memory is not None:
+            memory.save()
         if container_name is not None:
-            client = docker.from_env()
-            container = client.containers.get(container_name)
-            container.stop()
-            container.remove()
-            print(f"Container '{container_name}' stopped and removed.")
-            if os.path.exists(tmp_dir):
-                result = os.system(f"rm -rf {os.path.join(tmp_dir, '*')}")
-                if result == 0:
-                    print(f"Temporary directory {tmp_dir} cleaned up successfully.")
-                else:
-                    print(f"Failed to clean up temporary directory {tmp_dir}.")
+            _stop_voreen_container(container_name, tmp_dir)
 
 
 if __name__ == "__main__":
@@ -358,7 +1079,7 @@ if __name__ == "__main__":
         description='Extract vessel graphs from OCTA images using Voreen.\
             \nPlease note that the predicted radii by Voreen might be subject to small additive error factor.\
             You can manually configure the necessary correction factor for image plotting with the --radius_correction_factor argument.\
-            On synthetic data, we measured 1 pixel overestimation, hence this is the default.')
+            On synthetic data, we measured 1 pixel overestimation, hence this is the default for the voreen backend.')
     parser.add_argument('--image_files', help="Absolute path to the segmentation maps", type=str, required=True)
     parser.add_argument('--tmp_dir', help="Absolute path to the temporary directory where voreen will store its temporary files", type=str, default=os.getenv("DOCKER_TMP_DIR", "/var/tmp"))
 
@@ -379,9 +1100,39 @@ if __name__ == "__main__":
 
     parser.add_argument('--etdrs', action="store_true", help="Analyse vessels in ETDRS grid")
     parser.add_argument('--mm', help="Size of the image in mm. Default is 3 mm", type=float, default=3.0)
-    parser.add_argument('--radius_correction_factor', help="Additive correction factor for the radius estimation. Default is -1.0 to correct for Voreen's overestimation by 1 pixel measured on synthetic data.", type=float, default=-1.0)
+    parser.add_argument('--radius_correction_factor', help="Additive correction factor for the radius estimation. Default is -1.0 for the voreen backend to correct for Voreen's overestimation by 1 pixel measured on synthetic data, "
+                        +"and 0.0 for the native backend, whose radii are the distance of the skeleton to the vessel surface.", type=float, default=None)
     parser.add_argument('--faz_dir', help="Absolute path to the folder containing all the faz segmentation maps. Only needed for ETDRS analysis", type=str, default=None)
     parser.add_argument('--threads', help="Number of parallel threads. By default all available threads but one are used.", type=int, default=max(1, cpu_count()-1))
+    parser.add_argument('--backend', help="Graph extraction backend. 'voreen' runs Voreen on the inflated 3D volume in a docker container. "
+                        +"'native' extracts the graph in-process from the 2D segmentation without docker.", choices=["voreen", "native"], default="voreen")
+    parser.add_argument('--etdrs_mode', help="'masked' extracts the graph of each ETDRS sector separately from the masked segmentation. "
+                        +"'split' extracts the graph once and clips it to the sectors.", choices=["masked", "split"], default="masked")
+    parser.add_argument('--manifest', help="Path to a dataset manifest. If given, the segmentation maps and FAZ files are taken from the manifest "
+                        +"instead of --image_files and --faz_dir, and the extracted graphs are registered in it.", type=str, default=None)
+    parser.add_argument('--voreen_batch_size', help="Maximum number of volumes extracted by a single voreentool run. "
+                        +"Larger batches amortize the startup of Voreen, but increase its memory usage. With --etdrs, each image has one volume per sector.", type=int, default=1)
+    parser.add_argument('--scheduler', help="'process_pool' runs each image in one worker process. 'async' runs the preprocessing, the Voreen calls and the postprocessing "
+                        +"as separate steps, each with its own concurrency limit. Only used with the voreen backend.", choices=["process_pool", "async"], default="process_pool")
+    parser.add_argument('--voreen_concurrency', help="Maximum number of concurrent voreentool runs with --scheduler async.", type=int, default=1)
+    parser.add_argument('--voreen_containers', help="Number of Voreen containers. With more than one, new containers are started and each voreentool run "
+                        +"is routed to the least loaded container. Dead containers are replaced.", type=int, default=1)
+    parser.add_argument('--voreen_container_concurrency', help="Maximum number of concurrent voreentool runs per container with --voreen_containers > 1.", type=int, default=1)
+    parser.add_argument('--crop_volumes', action="store_true", help="Crop each volume sent to Voreen to the bounding box of its vessels and to the depth "
+                        +"that their radii need. Empty ETDRS sectors skip Voreen. The outputs are shifted back to the coordinates of the full image.")
+    parser.add_argument('--memory_budget', help="Memory budget in GiB. Extraction jobs are only started while their estimated memory, "
+                        +"including Voreen's memory in the container, stays within the budget. The measured peak memory of each job type "
+                        +"is stored in --memory_profile and improves later estimates. Unlimited by default.", type=float, default=None)
+    parser.add_argument('--memory_profile', help="JSON file with the measured peak memory per job type. Defaults to memory_profile.json in the output folder.", type=str, default=None)
+    parser.add_argument('--tile_size', help="Height and width of the tiles in pixels, e.g. for widefield scans. If given, each segmentation is cut into overlapping tiles "
+                        +"whose graphs are extracted in parallel and stitched into one graph. Requires --etdrs_mode split with --etdrs.", type=int, default=None)
+    parser.add_argument('--tile_overlap', help="Number of pixels each tile extends beyond its core region with --tile_size. It has to exceed the vessel radii, "
+                        +"so that the skeleton in the core does not depend on the tile border.", type=int, default=64)
+    parser.add_argument('--bulge_sizes', help="Comma separated bulge sizes for a parameter sweep, e.g. '1,2,3,4'. Each volume is saved once and extracted "
+                        +"with all bulge sizes in the same voreentool run. The graphs of each bulge size are written to the subfolder "
+                        +"bulge_size_<value> of --output_dir and are not registered in --manifest. Overrides --bulge_size.", type=str, default=None)
+    parser.add_argument('--incremental', action="store_true", help="Skip images whose segmentation, FAZ and parameters did not change since the last run. "
+                        +"Identical images are extracted only once. Requires --manifest.")
 
     args = parser.parse_args()
     kwargs = vars(args)
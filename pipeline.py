@@ -1,14 +1,21 @@
 
 import argparse
+import glob
 import os
 import pathlib
 from multiprocessing import cpu_count
 
 from dotenv import load_dotenv
+from natsort import natsorted
 
 from faz_segmentation import perform_faz_segmentation
 from generate_analysis_summary import generate_anylsis_file
-from graph_feature_extractor import perform_graph_feature_extraction
+from graph_feature_extractor import perform_graph_feature_extraction, resolve_radius_correction_factor
+from streaming_pipeline import run_streaming_pipeline
+from utils.file_io import set_io_mode
+from utils.manifest import Manifest
+from utils.profiling import set_profile_dir, write_chrome_trace
+from utils.volume_io import set_projection_cache
 
 load_dotenv()
 project_folder = str(pathlib.Path(__file__).parent.resolve())
@@ -29,61 +36,152 @@ parser.add_argument('--colorize', help="Generate colored radius graph", choices=
 parser.add_argument('--generate_graph_file', help="Generate the graph JSON file", action="store_true", default=True)
 parser.add_argument('--no_generate_graph_file', help="Do not generate the graph JSON file", action="store_false", dest="generate_graph_file")
 parser.add_argument('--z_dim', help="Z dimension of the 3D segmentation mask. Only needed for 2D segmentation masks.", type=int, default=64)
+parser.add_argument('--backend', help="Graph extraction backend. 'voreen' runs Voreen in a docker container, 'native' extracts the graph in-process.", choices=["voreen", "native"], default="voreen")
+parser.add_argument('--scheduler', help="'process_pool' runs each image in one worker process. 'async' runs the preprocessing, the Voreen calls and the postprocessing as separate steps, each with its own concurrency limit.", choices=["process_pool", "async"], default="process_pool")
+parser.add_argument('--voreen_concurrency', help="Maximum number of concurrent voreentool runs with --scheduler async.", type=int, default=1)
+parser.add_argument('--voreen_containers', help="Number of Voreen containers. With more than one, new containers are started and each voreentool run is routed to the least loaded container. Dead containers are replaced.", type=int, default=1)
+parser.add_argument('--voreen_container_concurrency', help="Maximum number of concurrent voreentool runs per container with --voreen_containers > 1.", type=int, default=1)
+parser.add_argument('--crop_volumes', action="store_true", help="Crop each volume sent to Voreen to the bounding box of its vessels and to the depth that their radii need. Empty ETDRS sectors skip Voreen. The outputs are shifted back to the coordinates of the full image.")
+parser.add_argument('--memory_budget', help="Memory budget in GiB for the graph extraction. Jobs are only started while their estimated memory, including Voreen's memory in the container, stays within the budget. The measured peak memory of each job type is stored in <output_dir>/graphs/memory_profile.json and improves later estimates. Unlimited by default.", type=float, default=None)
+parser.add_argument('--tile_size', help="Height and width of the tiles in pixels, e.g. for widefield scans. If given, each segmentation is cut into overlapping tiles whose graphs are extracted in parallel and stitched into one graph. Requires --etdrs_mode split with --etdrs.", type=int, default=None)
+parser.add_argument('--tile_overlap', help="Number of pixels each tile extends beyond its core region with --tile_size. It has to exceed the vessel radii, so that the skeleton in the core does not depend on the tile border.", type=int, default=64)
+parser.add_argument('--voreen_batch_size', help="Maximum number of volumes extracted by a single voreentool run. Larger batches amortize the startup of Voreen, but increase its memory usage.", type=int, default=1)
 
-parser.add_argument('--radius_correction_factor', help="Additive correction factor for the radius estimation. Default is -1.0 to correct for Voreen's overestimation by 1 pixel measured on synthetic data.", type=float, default=-1.0)
+parser.add_argument('--radius_correction_factor', help="Additive correction factor for the radius estimation. Default is -1.0 for the voreen backend to correct for Voreen's overestimation by 1 pixel measured on synthetic data, and 0.0 for the native backend, whose radii are the distance of the skeleton to the vessel surface.", type=float, default=None)
+parser.add_argument('--rasterizer', help="Backend used to render the graph for the density measurements. 'matplotlib' is the reference renderer. 'numpy' is much faster, but stamps slightly more pixels at disc borders, which raises the densities, most in the smallest radius interval: by up to 0.35 percentage points in the ETDRS sectors of synthetic benchmark data (see python -m benchmarks.rasterizer_agreement). With 'matplotlib', every --density_mode renders each radius interval separately.", choices=["matplotlib", "numpy"], default="matplotlib")
+parser.add_argument('--density_mode', help="'single_pass' renders the graph once and assigns the pixels to all radius intervals at once. 'per_interval' renders the graph separately for each radius interval. 'coverage' stores the pixels covered by each edge in a _coverage.npz file next to the graph and aggregates them per radius interval, so later runs with other --radius_thresholds or --mm skip the rendering. 'single_pass' and 'coverage' require --rasterizer numpy; with 'matplotlib', each radius interval is rendered separately.", choices=["single_pass", "per_interval", "coverage"], default="single_pass")
 parser.add_argument('--radius_thresholds', type=str, default="0,inf", help="Comma separated list of thresholds for vessel stratification [um].")
 parser.add_argument('--mm', type=float, default=3.0, help="Height of the segmentation volume in mm. Default is 3 mm")
 parser.add_argument('--etdrs', action="store_true", help="If set, use ETDRS grid stratification")
+parser.add_argument('--faz_engine', help="'shared' computes the skeleton of the FAZ segmentation once for all border candidates. 'reference' recomputes the full segmentation per candidate.", choices=["shared", "reference"], default="shared")
+parser.add_argument('--etdrs_mode', help="'masked' extracts the graph of each ETDRS sector separately. 'split' extracts the graph once and clips it to the sectors.", choices=["masked", "split"], default="masked")
 parser.add_argument('--center_radius', type=float, default=3/6, help="Radius of ETDRS center radius in mm")
 parser.add_argument('--inner_radius', type=float, default=3/2.4, help="Radius of ETDRS center radius in mm")
 
 parser.add_argument('--verbose', action="store_true", help="Print log information from voreen")
 parser.add_argument('--threads', help="Number of parallel threads. By default all available threads but one are used.", type=int, default=cpu_count()-1)
+parser.add_argument('--io_mode', help="'durable' fsyncs every written output file before it is renamed into place. 'fast' skips the fsync. Sets OCTA_IO_MODE for all stages.", choices=["durable", "fast"], default=os.getenv("OCTA_IO_MODE", "durable"))
+parser.add_argument('--mode', help="'stages' runs each stage for all images before the next stage starts. 'streaming' passes each image through FAZ segmentation, graph extraction and density measurement as soon as its inputs are ready.", choices=["stages", "streaming"], default="stages")
+parser.add_argument('--max_in_flight', help="Maximum number of images processed at the same time with --mode streaming. By default, twice the number of threads.", type=int, default=None)
+parser.add_argument('--incremental', action="store_true", help="Only process images whose content or parameters changed since the last run in the same output folder.")
+parser.add_argument('--parquet', action="store_true", help="Also save the summary as Parquet file with typed columns. Requires pyarrow.")
+parser.add_argument('--profile', action="store_true", help="Record the duration of the hot sections of all stages per image. Writes <output_dir>/trace.json in the Chrome trace format and adds timing columns to the summary.")
 args = parser.parse_args()
+set_io_mode(args.io_mode)
+# The graph images and the density measurements use the same correction
+args.radius_correction_factor = resolve_radius_correction_factor(args.backend, args.radius_correction_factor)
 
 source_files = args.source_dir + "/*.png"
 output_dir = args.output_dir.removesuffix("/") if args.output_dir is not None else args.source_dir.removesuffix("/")
 
-if args.etdrs:
-    perform_faz_segmentation(
-        source_files=source_files,
-        output_dir=args.output_dir + "/faz",
-        threads=args.threads
+# Index the dataset once. All stages look up their files in the manifest and register their outputs.
+manifest = os.path.join(output_dir, "manifest.sqlite")
+Manifest.build(manifest, natsorted(glob.glob(source_files))).close()
+# The 2D projections of 3D segmentations are computed once and shared by all stages
+set_projection_cache(os.getenv("OCTA_PROJECTION_CACHE") or os.path.join(output_dir, "projections"))
+if args.profile:
+    set_profile_dir(os.path.join(output_dir, "profile"))
+
+if args.mode == "streaming":
+    assert not args.incremental, "Incremental processing is only supported with --mode stages."
+    assert args.memory_budget is None, "The memory budget is only supported with --mode stages. Use --max_in_flight to bound the memory of the streaming mode."
+    assert args.tile_size is None, "Tiled extraction is only supported with --mode stages."
+    run_streaming_pipeline(
+        image_files=Manifest(manifest).segmentations(),
+        output_dir=args.output_dir,
+        tmp_dir=args.tmp_dir,
+        etdrs=args.etdrs,
+        etdrs_mode=args.etdrs_mode,
+        faz_engine=args.faz_engine,
+        backend=args.backend,
+        voreen_image_name=args.voreen_image_name,
+        voreen_containers=args.voreen_containers,
+        voreen_container_concurrency=args.voreen_container_concurrency,
+        radius_thresholds=args.radius_thresholds,
+        mm=args.mm,
+        radius_correction_factor=args.radius_correction_factor,
+        center_radius=args.center_radius,
+        inner_radius=args.inner_radius,
+        rasterizer=args.rasterizer,
+        density_mode=args.density_mode,
+        threads=args.threads,
+        max_in_flight=args.max_in_flight,
+        manifest=manifest,
+        parquet=args.parquet,
+        thresholds=args.radius_thresholds,
+        voreen_workspace=args.voreen_workspace,
+        bulge_size=args.bulge_size,
+        graph_image=args.colorize_graph,
+        colorize=args.colorize,
+        z_dim=args.z_dim,
+        crop_volumes=args.crop_volumes,
+        verbose=args.verbose
+    )
+else:
+    if args.etdrs:
+        perform_faz_segmentation(
+            source_files=source_files,
+            output_dir=args.output_dir + "/faz",
+            threads=args.threads,
+            manifest=manifest,
+            incremental=args.incremental,
+            engine=args.faz_engine
+        )
+
+    perform_graph_feature_extraction(
+        tmp_dir=args.tmp_dir,
+        output_dir=args.output_dir+"/graphs",
+        image_files=source_files,
+        faz_dir=args.output_dir+"/faz",
+        thresholds=args.radius_thresholds,
+        voreen_image_name=args.voreen_image_name,
+        voreen_workspace=args.voreen_workspace,
+        bulge_size=args.bulge_size,
+        graph_image=args.colorize_graph,
+        colorize=args.colorize,
+        generate_graph_file=args.generate_graph_file,
+        z_dim=args.z_dim,
+        etdrs=args.etdrs,
+        mm=args.mm,
+        radius_thresholds=args.radius_thresholds,
+        center_radius=args.center_radius,
+        inner_radius=args.inner_radius,
+        verbose=args.verbose,
+        radius_correction_factor=args.radius_correction_factor,
+        threads=args.threads,
+        backend=args.backend,
+        etdrs_mode=args.etdrs_mode,
+        voreen_batch_size=args.voreen_batch_size,
+        scheduler=args.scheduler,
+        voreen_concurrency=args.voreen_concurrency,
+        voreen_containers=args.voreen_containers,
+        voreen_container_concurrency=args.voreen_container_concurrency,
+        memory_budget=args.memory_budget,
+        crop_volumes=args.crop_volumes,
+        tile_size=args.tile_size,
+        tile_overlap=args.tile_overlap,
+        manifest=manifest,
+        incremental=args.incremental
     )
 
-perform_graph_feature_extraction(
-    tmp_dir=args.tmp_dir,
-    output_dir=args.output_dir+"/graphs",
-    image_files=source_files,
-    faz_dir=args.output_dir+"/faz",
-    thresholds=args.radius_thresholds,
-    voreen_image_name=args.voreen_image_name,
-    voreen_workspace=args.voreen_workspace,
-    bulge_size=args.bulge_size,
-    graph_image=args.colorize_graph,
-    colorize=args.colorize,
-    generate_graph_file=args.generate_graph_file,
-    z_dim=args.z_dim,
-    etdrs=args.etdrs,
-    mm=args.mm,
-    radius_thresholds=args.radius_thresholds,
-    center_radius=args.center_radius,
-    inner_radius=args.inner_radius,
-    verbose=args.verbose,
-    radius_correction_factor=args.radius_correction_factor,
-    threads=args.threads
-)
+    generate_anylsis_file(
+        source_dir=args.output_dir+"/graphs",
+        segmentation_dir=args.source_dir,
+        output_dir=args.output_dir,
+        faz_files= args.output_dir+"/faz/*.png",
+        radius_thresholds=args.radius_thresholds,
+        mm=args.mm,
+        etdrs=args.etdrs,
+        radius_correction_factor=args.radius_correction_factor,
+        center_radius=args.center_radius,
+        inner_radius=args.inner_radius,
+        threads=args.threads,
+        rasterizer=args.rasterizer,
+        density_mode=args.density_mode,
+        manifest=manifest,
+        incremental=args.incremental,
+        parquet=args.parquet
+    )
 
-generate_anylsis_file(
-    source_dir=args.output_dir+"/graphs",
-    segmentation_dir=args.source_dir,
-    output_dir=args.output_dir,
-    faz_files= args.output_dir+"/faz/*.png",
-    radius_thresholds=args.radius_thresholds,
-    mm=args.mm,
-    etdrs=args.etdrs,
-    radius_correction_factor=args.radius_correction_factor,
-    center_radius=args.center_radius,
-    inner_radius=args.inner_radius,
-    threads=args.threads
-)
+if args.profile:
+    print(f"Profiling trace saved to {write_chrome_trace(os.path.join(output_dir, 'trace.json'))}")
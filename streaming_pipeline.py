@@ -0,0 +1,192 @@
+import asyncio
+import concurrent.futures
+import os
+from functools import partial
+from multiprocessing import cpu_count
+from typing import Literal
+
+from natsort import natsorted
+from tqdm import tqdm
+
+import graph_feature_extractor
+from faz_segmentation import faz_output_path
+from faz_segmentation import task as faz_task
+from generate_analysis_summary import area_factor_map, compute_faz_areas, process_image_files, resolve_density_mode, with_faz_area, with_timings, write_summary
+from graph_feature_extractor import _faz_code_name, _image_task, _start_voreen_container, _stop_voreen_container, etdrs_graph, full_graph, resolve_radius_correction_factor
+from utils.file_io import clear_dir
+from utils.manifest import Manifest, get_code_name
+from utils.profiling import image_timings, profile_dir
+from utils.volume_io import segmentation_shape
+
+
+async def _stream(
+        image_files: list[str],
+        source_dir: str,
+        faz_dir: str,
+        faz_pool: concurrent.futures.Executor,
+        graph_pool: concurrent.futures.Executor,
+        density_pool: concurrent.futures.Executor,
+        graph_task: partial,
+        density_args: partial,
+        etdrs: bool,
+        faz_engine: str,
+        max_in_flight: int,
+        pbar: tqdm) -> tuple[dict[str, str], dict[str, dict[str, str]], dict[str, tuple]]:
+    loop = asyncio.get_running_loop()
+    faz_futures: dict[str, asyncio.Future] = dict()
+    graphs: dict[str, dict[str, str]] = dict()
+    densities: dict[str, tuple] = dict()
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    # The ETDRS grid of an image is centered at the FAZ of the DVC image with the same code name
+    faz_sources = dict()
+    for path in image_files:
+        faz_path = faz_output_path(path, source_dir, faz_dir)
+        if ("dvc" in faz_path.lower()) or ("dcp" in faz_path.lower()):
+            faz_sources[get_code_name(faz_path)] = path
+
+    def faz(path: str) -> asyncio.Future:
+        # Each FAZ is segmented once, as soon as the first image needs it
+        if path not in faz_futures:
+            faz_futures[path] = loop.run_in_executor(faz_pool, faz_task, path, source_dir, faz_dir, faz_engine)
+        return faz_futures[path]
+
+    async def process(path: str):
+        async with in_flight:
+            try:
+                faz_code_name_map = dict()
+                if etdrs:
+                    await faz(path)
+                    faz_source = faz_sources.get(_faz_code_name(path))
+                    if faz_source is not None:
+                        faz_code_name_map[_faz_code_name(path)] = await faz(faz_source)
+                graphs[path] = await loop.run_in_executor(graph_pool, partial(_image_task, partial(graph_task, faz_code_name_map=faz_code_name_map)), path)
+                # The densities of all graphs of an image, e.g. its ETDRS sectors, are computed by one task
+                prefixes = list(graphs[path].values())
+                if prefixes:
+                    results = await loop.run_in_executor(density_pool, process_image_files, density_args(prefixes, path))
+                    densities.update(zip(prefixes, results))
+            except Exception as e:
+                print(f"An error occurred while processing {path}:\n{e}")
+            pbar.update(1)
+
+    await asyncio.gather(*[process(path) for path in image_files])
+    faz_files = {path: future.result() for path, future in faz_futures.items() if future.exception() is None}
+    return faz_files, graphs, densities
+
+def _density_args(prefixes: list[str], seg_file: str, etdrs: bool, thresholds: list[float], mm: float, radius_correction_factor: float,
+                  center_radius: float, inner_radius: float, rasterizer: str, density_mode: str) -> tuple:
+    """Arguments of `process_image_files` for the graphs of a segmentation. The FAZ area is added after all FAZ segmentations are done."""
+    shape = segmentation_shape(seg_file)
+    return (
+        [(f"{prefix}_edges.csv", f"{prefix}_graph.json") for prefix in prefixes], seg_file, {},
+        area_factor_map(shape, etdrs, mm, center_radius, inner_radius),
+        [None, *thresholds, None], thresholds, etdrs, mm, radius_correction_factor, shape, rasterizer, density_mode
+    )
+
+def run_streaming_pipeline(
+        image_files: list[str],
+        output_dir: str,
+        tmp_dir: str,
+        etdrs: bool = False,
+        etdrs_mode: Literal["masked", "split"] = "masked",
+        faz_engine: Literal["shared", "reference"] = "shared",
+        backend: Literal["voreen", "native"] = "voreen",
+        voreen_image_name: str = "voreen",
+        voreen_containers: int = 1,
+        voreen_container_concurrency: int = 1,
+        radius_thresholds: str = "0,inf",
+        mm: float = 3.0,
+        radius_correction_factor: float = None,
+        center_radius: float = 3/6,
+        inner_radius: float = 3/2.4,
+        rasterizer: Literal["matplotlib", "numpy"] = "matplotlib",
+        density_mode: Literal["single_pass", "per_interval", "coverage"] = "single_pass",
+        threads: int = cpu_count() - 1,
+        max_in_flight: int = None,
+        manifest: str = None,
+        parquet: bool = False,
+        **kwargs):
+    """
+    Runs FAZ segmentation, graph extraction and density measurement for each image as soon as its inputs are ready,
+    instead of finishing each stage for the whole cohort before the next stage starts. Each stage has its own process pool.
+    The summary CSV is written when all images are done.
+
+    Args:
+        image_files (list[str]): Paths of the vessel segmentations.
+        output_dir (str): Output folder. FAZ segmentations are written to `<output_dir>/faz`, graphs to `<output_dir>/graphs`.
+        tmp_dir (str): Temporary directory for Voreen.
+        threads (int): Number of processes per stage.
+        faz_engine (Literal["shared", "reference"]): FAZ segmentation engine, see `faz_segmentation.get_faz_mask_robust`.
+        max_in_flight (int): Maximum number of images that are processed at the same time. This bounds the work between the stages.
+            By default, twice the number of threads.
+        manifest (str): Path of a dataset manifest. The FAZ segmentations and graphs are registered in it.
+        parquet (bool): Also save the summary as Parquet file, see `write_summary`.
+        **kwargs: Additional arguments of `full_graph` and `etdrs_graph`, e.g. `bulge_size` or `colorize`.
+        For the remaining arguments, see `perform_graph_feature_extraction` and `generate_anylsis_file`.
+    """
+    density_mode = resolve_density_mode(rasterizer, density_mode)
+    radius_correction_factor = resolve_radius_correction_factor(backend, radius_correction_factor)
+    assert image_files, "Found no vessel segmentation files!"
+    source_dir = os.path.dirname(os.path.commonprefix(image_files))
+    faz_dir = os.path.join(output_dir, "faz")
+    graph_dir = os.path.join(output_dir, "graphs")
+    thresholds = [float(t) for t in radius_thresholds.split(",")] if radius_thresholds else []
+    color_thresholds = [float(t) for t in kwargs.pop("thresholds").split(",")] if kwargs.get("thresholds") else None
+
+    clear_dir(tmp_dir)
+    container_name = None
+    if backend == "voreen":
+        container_name, graph_feature_extractor.DOCKER_WORK_DIR = _start_voreen_container(
+            tmp_dir, source_dir, graph_dir, voreen_image_name,
+            voreen_containers=voreen_containers, voreen_container_concurrency=voreen_container_concurrency
+        )
+    graph_task = partial(
+        etdrs_graph if etdrs else full_graph,
+        source_dir=source_dir,
+        tmp_dir=tmp_dir,
+        output_dir=graph_dir,
+        container_name=container_name,
+        color_thresholds=color_thresholds,
+        mm=mm,
+        radius_correction_factor=radius_correction_factor,
+        backend=backend,
+        etdrs_mode=etdrs_mode,
+        **kwargs
+    )
+    density_args = partial(
+        _density_args, etdrs=etdrs, thresholds=thresholds, mm=mm, radius_correction_factor=radius_correction_factor,
+        center_radius=center_radius, inner_radius=inner_radius, rasterizer=rasterizer, density_mode=density_mode
+    )
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as faz_pool, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=threads) as graph_pool, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=threads) as density_pool, \
+                tqdm(total=len(image_files), desc="Processing images...") as pbar:
+            faz_files, graphs, densities = asyncio.run(_stream(
+                image_files, source_dir, faz_dir, faz_pool, graph_pool, density_pool,
+                graph_task, density_args, etdrs, faz_engine, max_in_flight or 2 * threads, pbar
+            ))
+    finally:
+        if container_name is not None:
+            _stop_voreen_container(container_name, tmp_dir)
+
+    if manifest is not None:
+        dataset = Manifest(manifest)
+        dataset.add_faz(natsorted(faz_files.values()))
+        for path, image_graphs in graphs.items():
+            dataset.add_graphs(image_graphs, segmentation=path)
+        dataset.close()
+
+    faz_map, _ = compute_faz_areas(natsorted(faz_files.values()), mm)
+    timings = image_timings() if profile_dir() is not None else None
+    results = dict()
+    for prefix, (dd, new_entry, area) in densities.items():
+        if new_entry and faz_map:
+            dd = with_faz_area(dd, f"{prefix}_edges.csv", area, faz_map)
+        if new_entry and timings is not None:
+            dd = with_timings(dd, f"{prefix}_edges.csv", etdrs, timings)
+        results[f"{prefix}_edges.csv"] = (dd, new_entry, area)
+    assert results, "No graphs were extracted!"
+    output_path = write_summary(results, output_dir, etdrs, parquet=parquet)
+    print(f"Analysis summary saved to {output_path}")
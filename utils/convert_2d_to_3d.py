@@ -1,39 +1,121 @@
+from typing import Literal
+
 import numpy as np
 from scipy.ndimage import distance_transform_edt
 from skimage.morphology import skeletonize
 
-def convert_2d_to_3d(ves_seg: np.ndarray, z_dim: int) -> np.ndarray:
+
+def _skeleton_radii(ves_seg: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
     """
-    Vectorized version of convert_2d_to_3d for better performance.
-    
+    Computes the skeleton points of a 2D vessel segmentation and their distance to the vessel surface.
+
     Args:
         ves_seg (np.ndarray): 2D vessel segmentation mask.
-        z_dim (int): Depth dimension for the 3D volume.
-        
+
     Returns:
-        np.ndarray: 3D vessel segmentation mask.
+        tuple[np.ndarray, np.ndarray]: Coordinates of shape (N, 2) and radii of shape (N,) of all skeleton points.
     """
     image_dist = distance_transform_edt(ves_seg)
     skeleton = skeletonize(ves_seg, method='lee')
     dist_skeleton = image_dist * skeleton
-    
-    # Get coordinates and radii of all skeleton points
     coords = np.argwhere(dist_skeleton > 0)
-    if len(coords) == 0:
-        return np.zeros((ves_seg.shape[0], ves_seg.shape[1], z_dim), dtype=np.uint8)
-    
     radii = dist_skeleton[coords[:, 0], coords[:, 1]]
-    
+    return coords, radii
+
+def _ball_half_heights(radius: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the half height of a discrete ball for every in-plane offset.
+
+    A voxel (dy, dx, dz) belongs to the ball if dy²+dx²+dz² < radius². As the ball is symmetric in z,
+    each column (dy, dx) is fully described by the largest |dz| that is still inside.
+
+    Args:
+        radius (float): Radius of the ball.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: In-plane offsets of shape (M, 2) and the half height of each column of shape (M,).
+    """
+    r = int(radius)
+    offsets = np.arange(-r, r + 1)
+    dy, dx, dz = np.meshgrid(offsets, offsets, offsets, indexing='ij')
+    ball = (dy ** 2 + dx ** 2 + dz ** 2) < radius ** 2
+    counts = ball.sum(axis=2)
+    inside = counts > 0
+    half_heights = (counts[inside] - 1) // 2
+    return np.stack([dy[..., 0][inside], dx[..., 0][inside]], axis=-1), half_heights
+
+def compute_height_map(ves_seg: np.ndarray) -> np.ndarray:
+    """
+    Computes the 2D height map of the tubular 3D representation of a vessel segmentation.
+
+    Every skeleton point is inflated to a ball with its distance to the vessel surface as radius.
+    The union of all balls is fully described by the largest half height of any ball at each pixel.
+    Skeleton points are grouped by their (exact) radius so that one precomputed ball kernel is reused per radius.
+
+    Args:
+        ves_seg (np.ndarray): 2D vessel segmentation mask.
+
+    Returns:
+        np.ndarray: Integer height map of the same shape as `ves_seg`. Pixels not covered by any ball are -1.
+    """
+    height_map = np.full(ves_seg.shape, -1, dtype=np.int32)
+    coords, radii = _skeleton_radii(ves_seg)
+    if len(coords) == 0:
+        return height_map
+
+    h, w = ves_seg.shape
+    flat_height_map = height_map.ravel()
+    unique_radii, inverse = np.unique(radii, return_inverse=True)
+    for i, radius in enumerate(unique_radii):
+        centers = coords[inverse == i]
+        offsets, half_heights = _ball_half_heights(radius)
+        # Stamp all columns of equal height at once. Duplicate indices then carry the same value, so their write order does not matter.
+        for half_height in np.unique(half_heights):
+            level_offsets = offsets[half_heights == half_height]
+            y = (centers[:, 0, np.newaxis] + level_offsets[np.newaxis, :, 0]).ravel()
+            x = (centers[:, 1, np.newaxis] + level_offsets[np.newaxis, :, 1]).ravel()
+            valid = (y >= 0) & (y < h) & (x >= 0) & (x < w)
+            indices = y[valid] * w + x[valid]
+            flat_height_map[indices] = np.maximum(flat_height_map[indices], half_height)
+    return height_map
+
+def height_map_to_volume(height_map: np.ndarray, z_dim: int, z_start: int = 0, z_stop: int = None) -> np.ndarray:
+    """
+    Expands a height map into a binary 3D volume with all balls centered at z_dim // 2.
+
+    Args:
+        height_map (np.ndarray): 2D height map as computed by `compute_height_map`.
+        z_dim (int): Depth dimension for the 3D volume.
+        z_start (int): First z slice to generate. Allows to generate the volume in slabs.
+        z_stop (int): Last (exclusive) z slice to generate. Defaults to z_dim.
+
+    Returns:
+        np.ndarray: uint8 volume of shape (H, W, z_stop-z_start) with values in {0, 255}.
+    """
+    z_stop = z_dim if z_stop is None else z_stop
+    z_dist = np.abs(np.arange(z_start, z_stop) - z_dim // 2)
+    image_vol = (z_dist[np.newaxis, np.newaxis, :] <= height_map[..., np.newaxis]).view(np.uint8)
+    image_vol *= 255
+    return image_vol
+
+def _convert_2d_to_3d_loop(ves_seg: np.ndarray, z_dim: int) -> np.ndarray:
+    """
+    Reference implementation of `convert_2d_to_3d` that stamps one sphere per skeleton point.
+    """
+    coords, radii = _skeleton_radii(ves_seg)
+
     # Create the 3D volume (height, width, depth)
     image_vol = np.zeros((ves_seg.shape[0], ves_seg.shape[1], z_dim), dtype=np.uint8)
-    
+    if len(coords) == 0:
+        return image_vol
+
     # Fixed z-center for all spheres
     z_center = z_dim // 2
-    
+
     # For each skeleton point, compute which voxels fall within its sphere
     for i, (y_center, x_center) in enumerate(coords):
         radius = radii[i]
-        
+
         # Define bounding box to limit computation
         y_min = max(0, int(y_center - radius))
         y_max = min(ves_seg.shape[0], int(y_center + radius + 1))
@@ -41,7 +123,7 @@ def convert_2d_to_3d(ves_seg: np.ndarray, z_dim: int) -> np.ndarray:
         x_max = min(ves_seg.shape[1], int(x_center + radius + 1))
         z_min = max(0, int(z_center - radius))
         z_max = min(z_dim, int(z_center + radius + 1))
-        
+
         # Create coordinate grids only for the bounding box
         y_local, x_local, z_local = np.meshgrid(
             np.arange(y_min, y_max),
@@ -49,14 +131,35 @@ def convert_2d_to_3d(ves_seg: np.ndarray, z_dim: int) -> np.ndarray:
             np.arange(z_min, z_max),
             indexing='ij'
         )
-        
+
         # Compute squared distances
-        dist_sq = ((y_local - y_center) ** 2 + 
-                   (x_local - x_center) ** 2 + 
+        dist_sq = ((y_local - y_center) ** 2 +
+                   (x_local - x_center) ** 2 +
                    (z_local - z_center) ** 2)
-        
+
         # Set voxels within radius to 255
         mask = dist_sq < radius ** 2
         image_vol[y_min:y_max, x_min:x_max, z_min:z_max][mask] = 255
-    
+
     return image_vol
+
+def convert_2d_to_3d(ves_seg: np.ndarray, z_dim: int, engine: Literal["kernel", "loop"] = "kernel") -> np.ndarray:
+    """
+    Converts a 2D vessel segmentation into a 3D volume by inflating every skeleton point to a sphere.
+
+    Args:
+        ves_seg (np.ndarray): 2D vessel segmentation mask.
+        z_dim (int): Depth dimension for the 3D volume.
+        engine (Literal["kernel", "loop"]): Implementation used to stamp the spheres.
+            - "kernel": Reuses one ball kernel per radius and derives the volume from a 2D height map.
+            - "loop": Reference implementation that stamps each sphere separately. Produces the identical volume.
+
+    Returns:
+        np.ndarray: 3D vessel segmentation mask.
+    """
+    if engine == "loop":
+        return _convert_2d_to_3d_loop(ves_seg, z_dim)
+    elif engine == "kernel":
+        return height_map_to_volume(compute_height_map(ves_seg), z_dim)
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
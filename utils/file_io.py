@@ -0,0 +1,96 @@
+"""
+File system helpers shared by all stages.
+
+Outputs are written to a temporary file in the target directory and renamed into place, so that other processes
+never observe partially written files. The environment variable `OCTA_IO_MODE` controls the durability:
+    - "durable" (default): Written files and their directory entries are fsynced before the function returns.
+    - "fast": Files are renamed into place without fsync. They may be lost if the host crashes shortly after the write.
+Only the affected files are synced. This avoids `os.sync`, which flushes all dirty pages of the host, including those of other jobs.
+"""
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from typing import Literal
+
+
+def io_mode() -> Literal["durable", "fast"]:
+    mode = os.getenv("OCTA_IO_MODE", "durable")
+    assert mode in ["durable", "fast"], f"Unknown OCTA_IO_MODE '{mode}'. Use 'durable' or 'fast'."
+    return mode
+
+def set_io_mode(mode: Literal["durable", "fast"]):
+    """Sets the I/O mode of this process and all worker processes started afterwards."""
+    os.environ["OCTA_IO_MODE"] = mode
+    io_mode()
+
+def fsync(path: str):
+    """Flushes a file or directory entry to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_files(paths: list[str]):
+    """
+    Flushes files written by another process, e.g. Voreen, to disk. Does nothing in "fast" mode.
+    """
+    if io_mode() != "durable":
+        return
+    for path in paths:
+        fsync(path)
+    for directory in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+        fsync(directory)
+
+@contextmanager
+def atomic_path(path: str):
+    """
+    Yields a temporary path next to `path`. The file written to the temporary path replaces `path` when the context exits without error.
+    The temporary file name ends with the name of the target, so that writers that infer the format from the extension keep working.
+
+    Example:
+        with atomic_path("image.png") as tmp_path:
+            Image.fromarray(img).save(tmp_path)
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f".{uuid.uuid4().hex[:8]}.{name}")
+    try:
+        yield tmp_path
+        durable = io_mode() == "durable"
+        if durable:
+            fsync(tmp_path)
+        os.replace(tmp_path, path)
+        if durable:
+            fsync(directory)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    """
+    Opens a file for writing that replaces `path` when the context exits without error. See `atomic_path`.
+    """
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode) as file:
+            yield file
+
+def copy_file(source: str, destination: str):
+    """Copies a file atomically."""
+    with atomic_path(destination) as tmp_path:
+        shutil.copyfile(source, tmp_path)
+
+def remove_tree(path: str):
+    """Removes a directory with all its content. Missing directories are ignored."""
+    shutil.rmtree(path, ignore_errors=True)
+
+def clear_dir(path: str):
+    """Removes the content of a directory but keeps the directory itself."""
+    if not os.path.isdir(path):
+        return
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
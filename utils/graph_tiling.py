@@ -0,0 +1,155 @@
+"""
+Tiled graph extraction of large segmentations, e.g. widefield scans.
+
+The segmentation is cut into a grid of core regions of `tile_size` pixels. Each tile is its core region extended by `overlap`
+pixels on every side, so that the skeleton and the radii in the core do not depend on the tile border. The graph of each tile
+is extracted independently and clipped to its core with `clip_graph`, which cuts edges that leave the core at the midpoint
+between their last voxel inside and their first voxel outside. The neighbouring tile cuts the same edge at the same midpoint,
+so the clipped graphs are stitched by merging boundary nodes at equal positions and joining the two edge halves at each of them.
+If only the end node of an edge lies in a core, that core has no half of the edge, and the other half is attached to the node.
+The features of joined edges are recomputed from their skeleton voxels. Boundary nodes without a counterpart, e.g. where the
+tiles disagree on the skeleton because the overlap is too small, are kept as endpoints on the core border.
+"""
+import numpy as np
+import pandas as pd
+
+from utils.vessel_graph import clip_graph, graph_to_tables
+
+
+def tile_boxes(shape: tuple[int, int], tile_size: int, overlap: int) -> list[tuple[tuple[slice, slice], tuple[slice, slice]]]:
+    """
+    Cuts an image into tiles.
+
+    Args:
+        shape (tuple[int, int]): Height and width of the image.
+        tile_size (int): Height and width of the core region of each tile.
+        overlap (int): Number of pixels each tile extends beyond its core region.
+
+    Returns:
+        list[tuple[tuple[slice, slice], tuple[slice, slice]]]: The tile and the core region of each tile. The core regions partition the image.
+    """
+    assert tile_size > 0 and overlap >= 0, "The tile size must be positive and the overlap non-negative."
+    tiles = []
+    for y in range(0, shape[0], tile_size):
+        for x in range(0, shape[1], tile_size):
+            core = (slice(y, min(y + tile_size, shape[0])), slice(x, min(x + tile_size, shape[1])))
+            tile = tuple(slice(max(s.start - overlap, 0), min(s.stop + overlap, n)) for s, n in zip(core, shape))
+            tiles.append((tile, core))
+    return tiles
+
+def _renumber(graph_json: dict, df_nodes: pd.DataFrame, df_edges: pd.DataFrame, first_node_id: int, first_edge_id: int):
+    """Assigns consecutive ids starting at the given ones to the nodes and edges of a graph and its tables."""
+    node_ids = {n["id"]: first_node_id + i for i, n in enumerate(graph_json["graph"]["nodes"])}
+    edge_ids = {e["id"]: first_edge_id + i for i, e in enumerate(graph_json["graph"]["edges"])}
+    nodes = [{**n, "id": node_ids[n["id"]]} for n in graph_json["graph"]["nodes"]]
+    edges = [{**e, "id": edge_ids[e["id"]], "node1": node_ids[e["node1"]], "node2": node_ids[e["node2"]]} for e in graph_json["graph"]["edges"]]
+    df_nodes = df_nodes.rename(index=node_ids)
+    df_edges = df_edges.rename(index=edge_ids)
+    df_edges["node1id"] = df_edges["node1id"].map(node_ids)
+    df_edges["node2id"] = df_edges["node2id"].map(node_ids)
+    return nodes, edges, df_nodes, df_edges
+
+def _concat(tables: list[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenates tables, skipping empty ones so that the column dtypes are kept."""
+    non_empty = [df for df in tables if len(df)]
+    return pd.concat(non_empty) if non_empty else tables[0]
+
+def stitch_tile_graphs(
+        tiles: list[tuple[dict, pd.DataFrame, pd.DataFrame]],
+        cores: list[tuple[slice, slice]],
+        shape: tuple[int, int]) -> tuple[dict, pd.DataFrame, pd.DataFrame]:
+    """
+    Stitches the graphs of the tiles of an image into one graph. See the module documentation.
+
+    Args:
+        tiles (list[tuple[dict, pd.DataFrame, pd.DataFrame]]): Graph, node table and edge table of each tile in the coordinates of the image.
+        cores (list[tuple[slice, slice]]): Core region of each tile, see `tile_boxes`.
+        shape (tuple[int, int]): Height and width of the image.
+
+    Returns:
+        tuple[dict, pd.DataFrame, pd.DataFrame]: The graph of the image, its node table and its edge table.
+    """
+    nodes, edges, node_tables, edge_tables = [], [], [], []
+    boundary = set()
+    for (graph_json, df_nodes, df_edges), core in zip(tiles, cores):
+        mask = np.zeros(shape, dtype=np.bool_)
+        mask[core] = True
+        original_ids = {n["id"] for n in graph_json["graph"]["nodes"]}
+        clipped = clip_graph(graph_json, df_nodes, df_edges, mask)
+        tile_nodes, tile_edges, df_nodes, df_edges = _renumber(*clipped, first_node_id=len(nodes), first_edge_id=len(edges))
+        boundary.update(new["id"] for old, new in zip(clipped[0]["graph"]["nodes"], tile_nodes) if old["id"] not in original_ids)
+        nodes.extend(tile_nodes)
+        edges.extend(tile_edges)
+        node_tables.append(df_nodes)
+        edge_tables.append(df_edges)
+
+    # Both tiles of a cut edge place a boundary node at the same position
+    merged_ids: dict[tuple, int] = dict()
+    replaced: dict[int, int] = dict()
+    for node in nodes:
+        if node["id"] in boundary:
+            replaced[node["id"]] = merged_ids.setdefault(tuple(np.round(node["pos"], 3)), node["id"])
+    # An edge whose only position in a core is its end node has no run there, so the other half ends at a boundary node halfway
+    # between its outermost voxel and that node. Such a half is attached to the node itself.
+    nodes_by_id = {n["id"]: n for n in nodes}
+    node_at = {tuple(np.round(n["pos"], 3)): n["id"] for n in nodes if n["id"] not in boundary}
+    cut_ends = dict()
+    reattached_ids = set()
+    for edge in edges:
+        voxels = edge.get("skeletonVoxels", [])
+        for end, voxel in [("node1", voxels[:1]), ("node2", voxels[-1:])]:
+            if edge[end] in boundary and voxel:
+                cut_ends.setdefault(replaced[edge[end]], []).append((edge, end, voxel[0]["pos"]))
+    for node_id, ends in cut_ends.items():
+        if len(ends) != 1:
+            continue
+        edge, end, voxel_pos = ends[0]
+        position = tuple(np.round([2 * b - v for b, v in zip(nodes_by_id[node_id]["pos"], voxel_pos)], 3))
+        if position in node_at:
+            replaced[edge[end]] = node_at[position]
+            reattached_ids.add(edge["id"])
+
+    for edge in edges:
+        edge["node1"] = replaced.get(edge["node1"], edge["node1"])
+        edge["node2"] = replaced.get(edge["node2"], edge["node2"])
+
+    # Join the two halves of each cut edge
+    edges_by_id = {e["id"]: e for e in edges}
+    incident: dict[int, list[int]] = {n["id"]: [] for n in nodes}
+    for edge in edges:
+        incident[edge["node1"]].append(edge["id"])
+        incident[edge["node2"]].append(edge["id"])
+    joined_ids = set(reattached_ids)
+    for node_id in merged_ids.values():
+        if len(incident[node_id]) != 2 or incident[node_id][0] == incident[node_id][1]:
+            continue
+        first, second = (edges_by_id[i] for i in incident[node_id])
+        first_voxels = first.get("skeletonVoxels", []) if first["node2"] == node_id else first.get("skeletonVoxels", [])[::-1]
+        second_voxels = second.get("skeletonVoxels", []) if second["node1"] == node_id else second.get("skeletonVoxels", [])[::-1]
+        start = first["node1"] if first["node2"] == node_id else first["node2"]
+        end = second["node2"] if second["node1"] == node_id else second["node1"]
+        edges_by_id[first["id"]] = {**first, "node1": start, "node2": end, "skeletonVoxels": first_voxels + second_voxels}
+        del edges_by_id[second["id"]]
+        incident[node_id] = []
+        incident[end] = [first["id"] if i == second["id"] else i for i in incident[end]]
+        joined_ids.discard(second["id"])
+        joined_ids.add(first["id"])
+
+    # Boundary nodes are kept once, and only if an edge still ends at them
+    used_nodes = {e["node1"] for e in edges_by_id.values()} | {e["node2"] for e in edges_by_id.values()}
+    graph_nodes = [n for n in nodes if n["id"] not in boundary or (replaced[n["id"]] == n["id"] and n["id"] in used_nodes)]
+    graph_json = {"graph": {"nodes": graph_nodes, "edges": list(edges_by_id.values())}}
+
+    # Joined and reattached edges get features computed from their voxels, all others keep the features of their tile
+    computed_nodes, computed_edges = graph_to_tables(graph_json, edge_ids=joined_ids)
+    df_edges = _concat(edge_tables)
+    df_edges = _concat([df_edges.loc[[i for i in df_edges.index if i in edges_by_id and i not in joined_ids]], computed_edges]).sort_index()
+    df_edges["node1id"] = [edges_by_id[i]["node1"] for i in df_edges.index]
+    df_edges["node2id"] = [edges_by_id[i]["node2"] for i in df_edges.index]
+    degree = computed_nodes["degree"]
+    df_edges["node1_degree"] = degree.loc[df_edges.node1id].to_numpy()
+    df_edges["node2_degree"] = degree.loc[df_edges.node2id].to_numpy()
+
+    df_nodes = _concat(node_tables).loc[[n["id"] for n in graph_nodes]].sort_index()
+    df_nodes["degree"] = degree.loc[df_nodes.index]
+    return graph_json, df_nodes, df_edges
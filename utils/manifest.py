@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Callable
+
+from natsort import natsorted
+
+
+def get_code_name(path: str) -> str:
+    extension = ".nii.gz" if path.endswith(".nii.gz") else "."+path.split(".")[-1]
+    return os.path.basename(path).removesuffix(extension).removeprefix("faz_").removeprefix("model_").removeprefix("model_")
+
+def remove_plexus_code(name: str):
+    """Remove plexus layer codes from filename."""
+    for code in ["_DCP", "_dcp", "_DVC", "_dvc", "_SCP", "_scp", "_SVC", "_svc"]:
+        name = name.replace(code, "")
+    return name
+
+def remove_eye_code(name: str):
+    """Remove eye codes (OS/OD) from filename."""
+    return name.replace("_OS", "").replace("_OD", "")
+
+def remove_extensions(basename: str):
+    """Remove file extensions and suffixes from basename."""
+    return basename.replace(" .", ".").removesuffix(".png").removesuffix(".nii.gz").removesuffix("_edges.csv").removesuffix("_full")
+
+def code_name(path: str):
+    """Extract standardized code name from file path."""
+    return (remove_prefixes(remove_plexus_code(remove_extensions(os.path.basename(path))).removeprefix("faz_"))
+            .replace(" OCTA", "")
+            .replace(" ", "_")
+            .replace("__", "_"))
+
+def remove_prefixes(name: str):
+    return name.removeprefix("model_").removeprefix("pred_")
+
+def image_id(path: str) -> str:
+    """Image ID of a segmentation file as used by the analysis summary."""
+    return remove_prefixes(remove_extensions(os.path.basename(path)))
+
+def file_hash(path: str) -> str:
+    """SHA-256 hash of the file content."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def fingerprint(input_hashes: list[str], params: dict) -> str:
+    """
+    Fingerprint of a unit of work, combining the content of its input files and the parameters that affect its outputs.
+
+    Args:
+        input_hashes (list[str]): Content hashes of all input files (see `file_hash`).
+        params (dict): JSON serializable parameters.
+
+    Returns:
+        str: Hex digest of the fingerprint.
+    """
+    payload = json.dumps({"inputs": input_hashes, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class Manifest:
+    """
+    Index of all files of a dataset, stored in a sqlite database. The manifest is built once per run and shared by all pipeline stages,
+    so that each stage looks up its input files instead of scanning the file system.
+
+    Tables:
+        - images: One row per vessel segmentation with its code name (see `get_code_name`) and image ID (see `image_id`).
+        - faz: One row per FAZ segmentation with its code name.
+        - graphs: One row per extracted graph with the path prefix of its `_nodes.csv`, `_edges.csv` and `_graph.json` files.
+        - fingerprints: The fingerprint and outputs of the last processing of each input per stage. Used for incremental processing.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        """
+        Args:
+            path (str): Path of the sqlite database. The database is created if it does not exist. By default, the manifest is kept in memory.
+        """
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS images (segmentation TEXT PRIMARY KEY, code_name TEXT NOT NULL, image_id TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS faz (path TEXT PRIMARY KEY, code_name TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS graphs (prefix TEXT PRIMARY KEY, segmentation TEXT, sector TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS fingerprints (stage TEXT, input TEXT, fingerprint TEXT NOT NULL, outputs TEXT, PRIMARY KEY (stage, input));
+            """)
+
+    @classmethod
+    def build(cls, path: str, image_files: list[str]) -> "Manifest":
+        """
+        Creates a new manifest for the given vessel segmentations. The file index of an existing manifest at the same path is replaced,
+        while the recorded fingerprints are kept for incremental processing.
+
+        Args:
+            path (str): Path of the sqlite database.
+            image_files (list[str]): Paths of the vessel segmentations.
+
+        Returns:
+            Manifest: The new manifest.
+        """
+        manifest = cls(path)
+        with manifest.connection:
+            manifest.connection.executescript("DELETE FROM images; DELETE FROM faz; DELETE FROM graphs;")
+        manifest.add_segmentations(image_files)
+        return manifest
+
+    def close(self):
+        self.connection.close()
+
+    def add_segmentations(self, paths: list[str]):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                [(p, get_code_name(p), image_id(p)) for p in paths]
+            )
+
+    def add_faz(self, paths: list[str]):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO faz VALUES (?, ?)", [(p, get_code_name(p)) for p in paths])
+
+    def add_graphs(self, graphs: dict[str, str], segmentation: str = None):
+        """
+        Registers extracted graphs.
+
+        Args:
+            graphs (dict[str, str]): Map from ETDRS sector ("" for the full image) to the path prefix of the graph files,
+                i.e. the path of the `_edges.csv` file without this suffix.
+            segmentation (str): The vessel segmentation the graphs were extracted from.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO graphs VALUES (?, ?, ?)",
+                [(prefix, segmentation, sector) for sector, prefix in graphs.items()]
+            )
+
+    def segmentations(self) -> list[str]:
+        return natsorted(p for (p,) in self.connection.execute("SELECT segmentation FROM images"))
+
+    def faz_files(self) -> list[str]:
+        return natsorted(p for (p,) in self.connection.execute("SELECT path FROM faz"))
+
+    def graphs(self) -> list[str]:
+        return natsorted(p for (p,) in self.connection.execute("SELECT prefix FROM graphs"))
+
+    def segmentations_by_image_id(self) -> dict[str, str]:
+        """
+        Returns:
+            dict[str, str]: Map from image ID to segmentation. If multiple segmentations share an ID, the first in natural order is used.
+        """
+        image_ids = dict(self.connection.execute("SELECT segmentation, image_id FROM images"))
+        segmentations = dict()
+        for path in natsorted(image_ids.keys()):
+            segmentations.setdefault(image_ids[path], path)
+        return segmentations
+
+    def record(self, stage: str, input: str, fingerprint: str, outputs):
+        """
+        Records that an input was processed by a stage.
+
+        Args:
+            stage (str): Name of the stage.
+            input (str): Path of the input.
+            fingerprint (str): Fingerprint of the input and parameters (see `fingerprint`).
+            outputs: JSON serializable description of the outputs, e.g. the written files.
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                (stage, input, fingerprint, json.dumps(outputs, default=float))
+            )
+
+    def plan_incremental(
+            self,
+            stage: str,
+            inputs: dict[str, list[str]],
+            params: dict,
+            is_complete: Callable[[object], bool] = lambda outputs: True
+        ) -> tuple[dict[str, str], dict[str, object], list[str], dict[str, str]]:
+        """
+        Determines which inputs of a stage need to be processed. An input is skipped if its fingerprint matches the recorded one
+        and its recorded outputs are complete. Inputs with identical fingerprints, e.g. byte-identical files, are processed only once.
+
+        Args:
+            stage (str): Name of the stage.
+            inputs (dict[str, list[str]]): Map from each input to all files its outputs depend on, including the input itself.
+            params (dict): Parameters of the stage that affect the outputs.
+            is_complete (Callable[[object], bool]): Checks whether recorded outputs still exist.
+
+        Returns:
+            tuple[dict[str, str], dict[str, object], list[str], dict[str, str]]:
+                - The fingerprint of each input.
+                - The recorded outputs of each input that can be skipped.
+                - The inputs that need to be processed.
+                - Map from each remaining input to the input with the same fingerprint whose outputs can be copied.
+                    The source is either skipped or processed.
+        """
+        hashes = dict()
+        fingerprints = dict()
+        for input, files in inputs.items():
+            for f in files:
+                if f not in hashes:
+                    hashes[f] = file_hash(f)
+            fingerprints[input] = fingerprint([hashes[f] for f in files], params)
+
+        recorded = {
+            input: (fp, json.loads(outputs))
+            for input, fp, outputs in self.connection.execute("SELECT input, fingerprint, outputs FROM fingerprints WHERE stage = ?", (stage,))
+        }
+        reused = dict()
+        for input, fp in fingerprints.items():
+            if input in recorded and recorded[input][0] == fp and is_complete(recorded[input][1]):
+                reused[input] = recorded[input][1]
+
+        sources = {fingerprints[input]: input for input in reused}
+        pending = []
+        duplicates = dict()
+        for input in natsorted(fingerprints.keys()):
+            if input in reused:
+                continue
+            fp = fingerprints[input]
+            if fp in sources:
+                duplicates[input] = sources[fp]
+            else:
+                sources[fp] = input
+                pending.append(input)
+        return fingerprints, reused, pending, duplicates
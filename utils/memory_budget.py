@@ -0,0 +1,166 @@
+"""
+Memory-budget-aware admission of graph extraction jobs.
+
+A job extracts the graphs of one image or of a batch of images. Its memory footprint is estimated from the image size, `z_dim`
+and the job type, i.e. the backend and ETDRS mode (see `job_type`). A job is only started while the estimated footprint of all
+running jobs stays within the budget. If no job is running, the next job is started regardless, so an image that exceeds the
+budget on its own is still processed, just alone.
+
+Without measurements, the footprint in the worker process is estimated with `STATIC_BYTES_PER_PIXEL` per pixel of the 2D
+segmentation and, for Voreen, with `STATIC_BYTES_PER_VOXEL` per voxel of each input volume. The peak RSS of every job in its
+worker is recorded in a `MemoryProfile`, and later estimates of that job type use the largest measured bytes per pixel instead.
+Voreen runs in its container, so its memory is not part of the worker RSS and is always added with `VOREEN_BYTES_PER_VOXEL`.
+"""
+import json
+import os
+import resource
+import sys
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from typing import Callable, Iterator, Literal
+
+import nibabel as nib
+
+from utils.file_io import atomic_path
+from utils.volume_io import is_nifti, segmentation_shape
+
+# Worker memory of a job per pixel of the 2D segmentation: segmentation, skeleton, distance transform and rendered graph images
+STATIC_BYTES_PER_PIXEL = 256
+# Worker memory of a Voreen job per voxel of each input volume: the uint8 volume and the copy written to NIFTI
+STATIC_BYTES_PER_VOXEL = 2
+# Memory of voreentool per voxel of each input volume in the container
+VOREEN_BYTES_PER_VOXEL = 16
+
+
+def job_type(backend: Literal["voreen", "native"], etdrs: bool, etdrs_mode: Literal["masked", "split"] = "masked") -> str:
+    """Name of the job type in a `MemoryProfile`, e.g. `voreen/masked` or `native/full`."""
+    return f"{backend}/{etdrs_mode if etdrs else 'full'}"
+
+def image_size(path: str, z_dim: int = 64) -> tuple[int, int]:
+    """
+    Returns:
+        tuple[int, int]: Number of pixels of the 2D segmentation and number of voxels of the 3D volume that Voreen extracts the graph from.
+    """
+    height, width = segmentation_shape(path)
+    if is_nifti(path) and len(nib.load(path).shape) > 2:
+        z_dim = nib.load(path).shape[2]
+    return height * width, height * width * z_dim
+
+def _proc_status(field: str) -> int:
+    """Value of a memory field of `/proc/self/status` in bytes, or None if it is not available."""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss() -> bool:
+    """Resets the peak RSS of this process to its current RSS. Only supported on Linux."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+def measure_peak_rss(func: Callable, *args, **kwargs) -> tuple[object, int]:
+    """
+    Runs `func` and measures how much the RSS of this process grew at its peak while it ran.
+
+    Returns:
+        tuple[object, int]: The result of `func` and the peak RSS increase in bytes, or None if the RSS is not available.
+    """
+    reset = _reset_peak_rss()
+    start = _proc_status("VmRSS")
+    result = func(*args, **kwargs)
+    if start is None:
+        return result, None
+    # Without reset, the peak of the process may predate the job, which overestimates its footprint
+    peak = _proc_status("VmHWM") if reset else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return result, max(0, peak - start)
+
+
+class MemoryProfile:
+    """
+    Measured peak RSS per pixel of each job type, stored as JSON so that later runs start with the measured values.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path (str): Path of the JSON file. If None, the measurements are kept in memory only.
+        """
+        self.path = path
+        self.measurements: dict[str, dict[str, float]] = dict()
+        if path is not None and os.path.isfile(path):
+            with open(path) as file:
+                self.measurements = json.load(file)
+
+    def estimate(self, job_type: str, paths: list[str], z_dim: int = 64) -> int:
+        """Estimated peak memory in bytes of a job that extracts the graphs of the given images."""
+        backend, mode = job_type.split("/")
+        volumes = 5 if mode == "masked" else 1
+        measurement = self.measurements.get(job_type)
+        total = 0
+        for path in paths:
+            pixels, voxels = image_size(path, z_dim)
+            if measurement is not None:
+                total += measurement["bytes_per_pixel"] * pixels
+            else:
+                total += STATIC_BYTES_PER_PIXEL * pixels + (STATIC_BYTES_PER_VOXEL * voxels * volumes if backend == "voreen" else 0)
+            if backend == "voreen":
+                total += VOREEN_BYTES_PER_VOXEL * voxels * volumes
+        return int(total)
+
+    def record(self, job_type: str, paths: list[str], peak_rss: int):
+        """Records the measured peak RSS increase of a job, see `measure_peak_rss`."""
+        if peak_rss is None or not paths:
+            return
+        bytes_per_pixel = peak_rss / sum(image_size(path)[0] for path in paths)
+        measurement = self.measurements.setdefault(job_type, {"bytes_per_pixel": 0.0, "samples": 0})
+        measurement["bytes_per_pixel"] = max(measurement["bytes_per_pixel"], bytes_per_pixel)
+        measurement["samples"] += 1
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with atomic_path(self.path) as tmp_path:
+            with open(tmp_path, "w") as file:
+                json.dump(self.measurements, file, indent=2)
+
+
+def submit_within_budget(
+        executor: Executor,
+        task: Callable,
+        items: list,
+        estimates: list[int],
+        memory_budget: int = None) -> Iterator[tuple[object, Future]]:
+    """
+    Submits `task(item)` for each item in order while the estimated memory of the running tasks stays within the budget.
+
+    Args:
+        executor (Executor): Executor that runs the tasks.
+        task (Callable): The task.
+        items (list): The arguments of the tasks.
+        estimates (list[int]): Estimated peak memory of each task in bytes.
+        memory_budget (int): Memory budget in bytes. If None, all tasks are submitted at once.
+
+    Yields:
+        tuple[object, Future]: Each item and its future, as soon as the task is done.
+    """
+    pending = list(zip(items, estimates))
+    running: dict[Future, tuple[object, int]] = dict()
+    in_use = 0
+    while pending or running:
+        while pending and (memory_budget is None or not running or in_use + pending[0][1] <= memory_budget):
+            item, estimate = pending.pop(0)
+            running[executor.submit(task, item)] = (item, estimate)
+            in_use += estimate
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            item, estimate = running.pop(future)
+            in_use -= estimate
+            yield item, future
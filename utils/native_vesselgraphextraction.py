@@ -0,0 +1,201 @@
+import math
+import os
+from typing import Literal
+
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import distance_transform_edt
+from scipy.sparse import csgraph
+from skimage.morphology import skeletonize
+
+from utils.file_io import atomic_write
+from utils.profiling import span
+from utils.vessel_graph import sanity_filter, write_graph_files
+from utils.visualizer import save_graph_image
+
+# Offsets of the 8-neighborhood. Only half of the neighbors are needed to enumerate each adjacent pair once.
+_HALF_NEIGHBORHOOD = [(0, 1), (1, -1), (1, 0), (1, 1)]
+
+def _skeleton_adjacency(skeleton: np.ndarray) -> tuple[np.ndarray, sparse.csr_matrix]:
+    """
+    Builds the 8-connected adjacency matrix of all skeleton pixels.
+
+    Returns:
+        tuple[np.ndarray, sparse.csr_matrix]: Pixel coordinates of shape (N, 2) and the symmetric adjacency matrix of shape (N, N).
+    """
+    coords = np.argwhere(skeleton)
+    index_map = np.full(skeleton.shape, -1, dtype=np.int64)
+    index_map[coords[:, 0], coords[:, 1]] = np.arange(len(coords))
+    h, w = skeleton.shape
+    rows, cols = [], []
+    for dy, dx in _HALF_NEIGHBORHOOD:
+        y, x = coords[:, 0] + dy, coords[:, 1] + dx
+        valid = (y >= 0) & (y < h) & (x >= 0) & (x < w)
+        neighbor = np.full(len(coords), -1, dtype=np.int64)
+        neighbor[valid] = index_map[y[valid], x[valid]]
+        found = neighbor >= 0
+        rows.append(np.flatnonzero(found))
+        cols.append(neighbor[found])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    adjacency = sparse.coo_matrix(
+        (np.ones(2 * len(rows), dtype=np.int8), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=(len(coords), len(coords))
+    ).tocsr()
+    return coords, adjacency
+
+def _skeleton_voxel(pos: np.ndarray, radius: float, z: float) -> dict:
+    return {
+        "pos": [float(pos[0]), float(pos[1]), z],
+        "minDistToSurface": radius,
+        "maxDistToSurface": radius,
+        "avgDistToSurface": radius,
+        "numSurfaceVoxels": 0,
+        # Cross-section of the tube that Voreen would see in the inflated 3D volume
+        "volume": math.pi * radius ** 2,
+        "nearOtherEdge": False
+    }
+
+def build_skeleton_graph(ves_seg: np.ndarray, z_dim: int = 64) -> dict:
+    """
+    Builds a vessel graph from a 2D vessel segmentation without Voreen.
+
+    The segmentation is skeletonized with the same method used for the 3D inflation. Skeleton pixels with exactly two neighbors
+    form the edges, all other skeleton pixels are clustered into nodes. The radius of each skeleton voxel is its distance to the vessel surface.
+    Coordinates follow the axis order of the inflated volume, i.e. the node at pixel (y, x) is located at (y, x, z_dim//2).
+
+    Args:
+        ves_seg (np.ndarray): 2D vessel segmentation mask.
+        z_dim (int): Depth of the corresponding 3D volume. Only used for the z coordinate.
+
+    Returns:
+        dict: The graph in Voreen's graph JSON schema.
+    """
+    ves_seg = ves_seg > 0
+    z = float(z_dim // 2)
+    image_dist = distance_transform_edt(ves_seg)
+    skeleton = skeletonize(ves_seg, method='lee') > 0
+    coords, adjacency = _skeleton_adjacency(skeleton)
+    if len(coords) == 0:
+        return {"graph": {"nodes": [], "edges": []}}
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    is_node = degree != 2
+
+    # Cluster adjacent node pixels into one node
+    node_pixels = np.flatnonzero(is_node)
+    n_clusters, cluster_labels = csgraph.connected_components(adjacency[node_pixels][:, node_pixels], directed=False)
+    pixel_cluster = np.full(len(coords), -1, dtype=np.int64)
+    pixel_cluster[node_pixels] = cluster_labels
+    node_voxels: list[list[np.ndarray]] = [[] for _ in range(n_clusters)]
+    for pixel, label in zip(node_pixels, cluster_labels):
+        node_voxels[label].append(coords[pixel])
+
+    # Chains of regular pixels form the edges. Each chain is a simple path or a closed loop.
+    chain_pixels = np.flatnonzero(~is_node)
+    chain_adjacency = adjacency[chain_pixels][:, chain_pixels]
+    chain_neighbors = np.split(chain_adjacency.indices, chain_adjacency.indptr[1:-1])
+    chain_degree = np.diff(chain_adjacency.indptr)
+
+    def adjacent_cluster(chain_index: int, exclude: int = -1) -> int:
+        pixel = chain_pixels[chain_index]
+        neighbors = adjacency.indices[adjacency.indptr[pixel]:adjacency.indptr[pixel + 1]]
+        clusters = [pixel_cluster[n] for n in neighbors if pixel_cluster[n] >= 0]
+        if len(clusters) > 1 and exclude in clusters:
+            clusters.remove(exclude)
+        return clusters[0]
+
+    def walk(start: int) -> list[int]:
+        path = [start]
+        visited[start] = True
+        current = start
+        while True:
+            unvisited = [n for n in chain_neighbors[current] if not visited[n]]
+            if not unvisited:
+                return path
+            current = unvisited[0]
+            visited[current] = True
+            path.append(current)
+
+    visited = np.zeros(len(chain_pixels), dtype=bool)
+    paths = [walk(start) for start in np.flatnonzero(chain_degree <= 1) if not visited[start]]
+    edges = []
+    for path in paths:
+        node1 = adjacent_cluster(path[0])
+        node2 = adjacent_cluster(path[-1], exclude=node1 if len(path) == 1 else -1)
+        edges.append((node1, node2, path))
+    for start in np.flatnonzero(~visited):
+        if visited[start]:
+            continue
+        # Closed loop without any junction. Promote one of its pixels to a node.
+        node_voxels.append([coords[chain_pixels[start]]])
+        loop_node = len(node_voxels) - 1
+        edges.append((loop_node, loop_node, walk(start)[1:]))
+
+    edges = [{
+        "id": i,
+        "node1": int(node1),
+        "node2": int(node2),
+        "skeletonVoxels": [_skeleton_voxel(p, float(image_dist[p[0], p[1]]), z) for p in coords[chain_pixels[path]]]
+    } for i, (node1, node2, path) in enumerate(edges)]
+
+    h, w = ves_seg.shape
+    nodes = []
+    for i, voxels in enumerate(node_voxels):
+        voxels = np.array(voxels)
+        pos = voxels.mean(axis=0)
+        nodes.append({
+            "id": i,
+            "pos": [float(pos[0]), float(pos[1]), z],
+            "voxels_": [[int(v[0]), int(v[1]), int(z)] for v in voxels],
+            "radius": float(image_dist[voxels[:, 0], voxels[:, 1]].max()),
+            "isAtSampleBorder": bool((voxels == 0).any() or (voxels[:, 0] == h - 1).any() or (voxels[:, 1] == w - 1).any())
+        })
+    return {"graph": {"nodes": nodes, "edges": edges}}
+
+def extract_vessel_graph_native(
+        ves_seg: np.ndarray,
+        image_name: str,
+        outdir: str,
+        z_dim: int = 64,
+        graph_image: bool = True,
+        colorize: Literal["continuous", "thresholds", "random", "white"] = "continuous",
+        color_thresholds: list[float] = None,
+        radius_correction_factor: float = 0.0,
+        image_size_mm: float = 3.0
+    ):
+    """
+    Extracts a vessel graph from a 2D segmentation in-process and stores the results in the same format as `extract_vessel_graph`.
+    Writes `<image_name>_nodes.csv`, `<image_name>_edges.csv`, `<image_name>_graph.json` and optionally `<image_name>_graph.png`.
+
+    Args:
+        ves_seg (np.ndarray): 2D vessel segmentation mask.
+        image_name (str): The name of the image file (without extension).
+        outdir (str): Directory where the output files will be saved.
+        z_dim (int): Depth of the corresponding 3D volume. Only used for the z coordinate of nodes and voxels.
+        graph_image (bool): Whether to generate a graph image from the extracted vessel graph.
+        colorize (Literal["continuous", "thresholds", "random", "white"]): Specifies how to color the edges in the graph image.
+        color_thresholds (list[float]): A list of thresholds for coloring edges when `colorize` is set to "thresholds".
+        radius_correction_factor (float): Additive correction factor for the radius estimation used for the graph image.
+        image_size_mm (float): The size of the image in millimeters, used for scaling.
+    """
+    with span("graph_extraction"):
+        graph_json = build_skeleton_graph(ves_seg, z_dim=z_dim)
+        df_nodes, df_edges = write_graph_files(graph_json, outdir, image_name)
+    # Constant radii are common for short edges in 2D, so only the Voreen-independent checks are applied
+    with span("csv_filter"):
+        df_edges, df_nodes = sanity_filter(df_edges, df_nodes, z_dim=z_dim, require_radius_variation=False)
+        with atomic_write(os.path.join(outdir, f'{image_name}_edges.csv')) as file:
+            df_edges.to_csv(file, sep=";")
+
+    if graph_image:
+        with span("graph_rendering"):
+            save_graph_image(
+                graph_json,
+                df_edges,
+                segmentation_2d_mask=ves_seg,
+                path=os.path.join(outdir, f'{image_name}_graph.png'),
+                image_size_mm=image_size_mm,
+                colorize=colorize,
+                color_thresholds=color_thresholds,
+                radius_correction_factor=radius_correction_factor
+            )
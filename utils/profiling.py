@@ -0,0 +1,107 @@
+"""
+Optional profiling of the hot sections of all stages.
+
+If the environment variable `OCTA_PROFILE_DIR` is set, every `span` is recorded as a Chrome trace event with the PID and thread
+of the process that ran it and the image it belongs to. Each process appends its events to `spans_<pid>.jsonl` in that folder,
+so worker processes never share a file. `write_chrome_trace` merges the events into one trace that can be opened in
+`chrome://tracing` or https://ui.perfetto.dev, and `image_timings` sums the durations per image and span name.
+Without `OCTA_PROFILE_DIR`, `span` does nothing.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Names of the recorded spans, in the order of the processing stages
+SPANS = ["faz_mask", "convert_2d_to_3d", "nifti_save", "voreentool", "graph_extraction", "graph_stitching", "csv_filter", "graph_rendering", "density"]
+
+_current_image: ContextVar[str] = ContextVar("current_image", default=None)
+
+
+def profile_dir() -> str:
+    return os.getenv("OCTA_PROFILE_DIR") or None
+
+def set_profile_dir(path: str):
+    """
+    Enables profiling for this process and all worker processes started afterwards. Spans of earlier runs in the folder are removed.
+    """
+    os.makedirs(path, exist_ok=True)
+    for file in glob.glob(os.path.join(path, "spans_*.jsonl")):
+        os.remove(file)
+    os.environ["OCTA_PROFILE_DIR"] = path
+
+@contextmanager
+def image_context(image: str):
+    """Attributes all spans in the context to the given image, unless they name their images explicitly."""
+    token = _current_image.set(image)
+    try:
+        yield
+    finally:
+        _current_image.reset(token)
+
+@contextmanager
+def span(name: str, image: str | list[str] = None):
+    """
+    Records the duration of the context as a span.
+
+    Args:
+        name (str): Name of the span, see `SPANS`.
+        image (str | list[str]): The image or images the work belongs to. The duration of a span of multiple images,
+            e.g. a batched voreentool run, is split evenly between them. Defaults to the image of the current `image_context`.
+    """
+    directory = profile_dir()
+    if directory is None:
+        yield
+        return
+    images = image if isinstance(image, list) else [image or _current_image.get()]
+    ts = time.time_ns() // 1000
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        event = {
+            "name": name, "ph": "X", "ts": ts, "dur": (time.perf_counter_ns() - start) / 1000,
+            "pid": os.getpid(), "tid": threading.get_native_id(), "args": {"images": images}
+        }
+        with open(os.path.join(directory, f"spans_{os.getpid()}.jsonl"), "a") as file:
+            file.write(json.dumps(event) + "\n")
+
+def load_spans(directory: str = None) -> list[dict]:
+    """Loads the spans recorded by all processes, ordered by start time."""
+    events = []
+    for path in glob.glob(os.path.join(directory or profile_dir(), "spans_*.jsonl")):
+        with open(path) as file:
+            events.extend(json.loads(line) for line in file if line.strip())
+    return sorted(events, key=lambda e: e["ts"])
+
+def write_chrome_trace(path: str, directory: str = None) -> str:
+    """
+    Writes all recorded spans as Chrome trace JSON.
+
+    Returns:
+        str: The path of the trace.
+    """
+    events = load_spans(directory)
+    for event in events:
+        event["args"]["images"] = ", ".join(i for i in event["args"]["images"] if i)
+    with open(path, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+    return path
+
+def image_timings(directory: str = None) -> dict[str, dict[str, float]]:
+    """
+    Sums the durations of the recorded spans per image and span name.
+
+    Returns:
+        dict[str, dict[str, float]]: Map from image to the total duration of each span name in seconds.
+    """
+    timings = dict()
+    for event in load_spans(directory):
+        images = [i for i in event["args"]["images"] if i]
+        for image in images:
+            durations = timings.setdefault(image, dict())
+            durations[event["name"]] = durations.get(event["name"], 0) + event["dur"] / 1e6 / len(images)
+    return timings
@@ -0,0 +1,330 @@
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.file_io import atomic_path, atomic_write
+
+NODE_COLUMNS = ["pos_x", "pos_y", "pos_z", "degree", "isAtSampleBorder"]
+EDGE_COLUMNS = [
+    "node1id", "node2id", "length", "distance", "curveness", "volume", "avgCrossSection",
+    "minRadiusAvg", "minRadiusStd", "avgRadiusAvg", "avgRadiusStd", "maxRadiusAvg", "maxRadiusStd",
+    "roundnessAvg", "roundnessStd", "node1_degree", "node2_degree", "num_voxels", "hasNodeAtSampleBorder"
+]
+
+def _path_length(points: np.ndarray) -> float:
+    if len(points) < 2:
+        return 0.0
+    return float(np.linalg.norm(np.diff(points, axis=0), axis=1).sum())
+
+def edge_features(node1_pos: np.ndarray, node2_pos: np.ndarray, skeleton_voxels: list[dict]) -> dict:
+    """
+    Computes the Voreen edge features of a single edge from its skeleton voxels.
+
+    Args:
+        node1_pos (np.ndarray): Position of the first node.
+        node2_pos (np.ndarray): Position of the second node.
+        skeleton_voxels (list[dict]): Ordered skeleton voxels of the edge in Voreen's graph JSON schema.
+
+    Returns:
+        dict: Edge features following the column names of Voreen's `_edges.csv`.
+    """
+    node1_pos = np.asarray(node1_pos, dtype=np.float64)
+    node2_pos = np.asarray(node2_pos, dtype=np.float64)
+    voxels = [v for v in skeleton_voxels if math.isfinite(v["minDistToSurface"])]
+    points = np.array([node1_pos, *[v["pos"] for v in voxels], node2_pos], dtype=np.float64)
+    length = _path_length(points)
+    distance = float(np.linalg.norm(node2_pos - node1_pos))
+    min_radii = np.array([v["minDistToSurface"] for v in voxels], dtype=np.float64)
+    avg_radii = np.array([v["avgDistToSurface"] for v in voxels], dtype=np.float64)
+    max_radii = np.array([v["maxDistToSurface"] for v in voxels], dtype=np.float64)
+    volume = float(sum(v["volume"] for v in voxels))
+    roundness = np.divide(min_radii, max_radii, out=np.zeros_like(min_radii), where=max_radii > 0)
+
+    def stats(values: np.ndarray) -> tuple[float, float]:
+        return (float(values.mean()), float(values.std())) if len(values) else (0.0, 0.0)
+
+    features = {
+        "length": length,
+        "distance": distance,
+        # Voreen defines curveness as the ratio of distance and length
+        "curveness": distance / length if length > 0 else 0.0,
+        "volume": volume,
+        "avgCrossSection": volume / length if length > 0 else 0.0,
+        "num_voxels": len(voxels),
+    }
+    for name, values in [("minRadius", min_radii), ("avgRadius", avg_radii), ("maxRadius", max_radii), ("roundness", roundness)]:
+        features[f"{name}Avg"], features[f"{name}Std"] = stats(values)
+    return features
+
+def graph_to_tables(graph_json: dict, edge_ids: set[int] = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Computes the node and edge tables of a graph given in Voreen's graph JSON schema.
+
+    Args:
+        graph_json (dict): The graph with the keys `graph.nodes` and `graph.edges`.
+        edge_ids (set[int]): If given, only the features of these edges are computed. Node degrees always consider all edges.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The node and edge table in the format of Voreen's `_nodes.csv` and `_edges.csv`, indexed by id.
+    """
+    nodes = graph_json["graph"]["nodes"]
+    edges = graph_json["graph"]["edges"]
+    node_pos = {n["id"]: n["pos"] for n in nodes}
+    degree = {n["id"]: 0 for n in nodes}
+    for e in edges:
+        degree[e["node1"]] += 1
+        degree[e["node2"]] += 1
+    at_border = {n["id"]: bool(n.get("isAtSampleBorder", False)) for n in nodes}
+
+    df_nodes = pd.DataFrame(
+        [[*n["pos"], degree[n["id"]], at_border[n["id"]]] for n in nodes],
+        columns=NODE_COLUMNS,
+        index=pd.Index([n["id"] for n in nodes], name="id")
+    )
+    if edge_ids is not None:
+        edges = [e for e in edges if e["id"] in edge_ids]
+    rows = []
+    for e in edges:
+        features = edge_features(node_pos[e["node1"]], node_pos[e["node2"]], e.get("skeletonVoxels", []))
+        features.update({
+            "node1id": e["node1"],
+            "node2id": e["node2"],
+            "node1_degree": degree[e["node1"]],
+            "node2_degree": degree[e["node2"]],
+            "hasNodeAtSampleBorder": at_border[e["node1"]] or at_border[e["node2"]]
+        })
+        rows.append(features)
+    df_edges = pd.DataFrame(rows, columns=EDGE_COLUMNS, index=pd.Index([e["id"] for e in edges], name="id"))
+    return df_nodes, df_edges
+
+def sanity_filter(df_rows: pd.DataFrame, df_nodes: pd.DataFrame, z_dim, lower_z=0.3, upper_z=0.7, require_radius_variation=True) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Removes edges without volume, length, curveness or radius from an edge table. With `require_radius_variation`, edges with a
+    constant radius are removed as well. Constant radii are common for short edges of the native backend, so it skips that check.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The filtered edge table and the unchanged node table.
+    """
+    valid = (df_rows.volume>0) & (df_rows.distance>0) & (df_rows.curveness>0) & (df_rows.avgRadiusAvg>0)
+    if require_radius_variation:
+        valid &= df_rows.avgRadiusStd.astype(bool)
+    df_rows_filtered = df_rows[valid]
+    return df_rows_filtered, df_nodes
+
+def shift_graph(graph_json: dict, df_nodes: pd.DataFrame, offset: tuple[float, float, float]):
+    """
+    Shifts the node positions, node voxels and skeleton voxels of a graph and the positions of its node table in place by `offset`,
+    e.g. from the coordinates of a cropped volume to the coordinates of the uncropped volume.
+    """
+    for node in graph_json["graph"]["nodes"]:
+        node["pos"] = [p + o for p, o in zip(node["pos"], offset)]
+        if "voxels_" in node:
+            node["voxels_"] = [[p + o for p, o in zip(voxel, offset)] for voxel in node["voxels_"]]
+    for edge in graph_json["graph"]["edges"]:
+        for voxel in edge.get("skeletonVoxels", []):
+            voxel["pos"] = [p + o for p, o in zip(voxel["pos"], offset)]
+    for column, o in zip(["pos_x", "pos_y", "pos_z"], offset):
+        df_nodes[column] += o
+
+def write_graph_files(graph_json: dict, outdir: str, image_name: str, df_nodes: pd.DataFrame = None, df_edges: pd.DataFrame = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Writes `<image_name>_nodes.csv`, `<image_name>_edges.csv`, `<image_name>_graph.json` and its `<image_name>_graph.npz` cache to the given directory.
+
+    Args:
+        graph_json (dict): The graph in Voreen's graph JSON schema.
+        outdir (str): Output directory.
+        image_name (str): Name of the image used as file prefix.
+        df_nodes (pd.DataFrame): Node table to write. Computed from the graph if not given.
+        df_edges (pd.DataFrame): Edge table to write. Computed from the graph if not given.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The written node and edge table.
+    """
+    if df_nodes is None or df_edges is None:
+        df_nodes, df_edges = graph_to_tables(graph_json)
+    with atomic_write(os.path.join(outdir, f'{image_name}_nodes.csv')) as file:
+        df_nodes.to_csv(file, sep=";")
+    with atomic_write(os.path.join(outdir, f'{image_name}_edges.csv')) as file:
+        df_edges.to_csv(file, sep=";")
+    graph_file = os.path.join(outdir, f'{image_name}_graph.json')
+    with atomic_write(graph_file) as file:
+        json.dump(graph_json, file)
+    write_graph_cache(graph_json, graph_file)
+    return df_nodes, df_edges
+
+def graph_json_to_arrays(graph_json: dict) -> dict[str, np.ndarray]:
+    """
+    Converts the edges of a graph in Voreen's graph JSON schema to flat arrays.
+
+    Args:
+        graph_json (dict): The graph with the key `graph.edges`.
+
+    Returns:
+        dict[str, np.ndarray]: The graph arrays
+            - "edge_ids": Edge ids of shape (E,).
+            - "offsets": Start index of the skeleton voxels of each edge of shape (E+1,). The voxels of edge i are `offsets[i]:offsets[i+1]`.
+            - "voxel_pos": Skeleton voxel positions of shape (N, 3).
+            - "min_dist": Skeleton voxel `minDistToSurface` of shape (N,).
+    """
+    edges = graph_json["graph"]["edges"]
+    voxels = [v for e in edges for v in e.get("skeletonVoxels", [])]
+    offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e.get("skeletonVoxels", [])) for e in edges])
+    return {
+        "edge_ids": np.array([e["id"] for e in edges], dtype=np.int64),
+        "offsets": offsets,
+        "voxel_pos": np.array([v["pos"] for v in voxels], dtype=np.float64).reshape(-1, 3),
+        "min_dist": np.array([v["minDistToSurface"] for v in voxels], dtype=np.float64)
+    }
+
+def as_graph_arrays(graph: dict) -> dict[str, np.ndarray]:
+    """
+    Returns the graph arrays of a graph given either in Voreen's graph JSON schema or already as graph arrays.
+    """
+    return graph if "offsets" in graph else graph_json_to_arrays(graph)
+
+def graph_cache_path(graph_file: str) -> str:
+    return graph_file.removesuffix(".json") + ".npz"
+
+def write_graph_cache(graph: dict, graph_file: str) -> dict[str, np.ndarray]:
+    """
+    Writes the graph arrays of a graph next to its `_graph.json` file as `_graph.npz`.
+
+    Args:
+        graph (dict): The graph in Voreen's graph JSON schema or as graph arrays.
+        graph_file (str): Path of the `_graph.json` file.
+
+    Returns:
+        dict[str, np.ndarray]: The graph arrays.
+    """
+    arrays = as_graph_arrays(graph)
+    # An interrupted write must never leave a cache that is newer than the JSON file
+    with atomic_path(graph_cache_path(graph_file)) as tmp_path:
+        np.savez(tmp_path, **arrays)
+    return arrays
+
+def load_graph_arrays(graph_file: str) -> dict[str, np.ndarray]:
+    """
+    Loads the graph arrays of a `_graph.json` file. The `_graph.npz` cache next to the file is used if it is at least as new as the JSON file.
+    Otherwise, the JSON file is parsed and the cache is (re)written.
+
+    Args:
+        graph_file (str): Path of the `_graph.json` file.
+
+    Returns:
+        dict[str, np.ndarray]: The graph arrays, see `graph_json_to_arrays`.
+    """
+    cache_path = graph_cache_path(graph_file)
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(graph_file):
+        with np.load(cache_path) as data:
+            return {k: data[k] for k in data.files}
+    with open(graph_file, 'r') as file:
+        graph_json = json.load(file)
+    return write_graph_cache(graph_json, graph_file)
+
+def _inside(mask: np.ndarray, positions: list[list[float]]) -> np.ndarray:
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    y = np.clip(np.rint(positions[:, 0]).astype(np.int64), 0, mask.shape[0] - 1)
+    x = np.clip(np.rint(positions[:, 1]).astype(np.int64), 0, mask.shape[1] - 1)
+    return mask[y, x]
+
+def clip_graph(graph_json: dict, df_nodes: pd.DataFrame, df_edges: pd.DataFrame, mask: np.ndarray) -> tuple[dict, pd.DataFrame, pd.DataFrame]:
+    """
+    Clips a graph to a 2D region. Edges that cross the region boundary are cut at the boundary instead of being dropped.
+
+    Edges that lie completely inside the region keep their original features. Edges that cross the boundary are split into runs of
+    consecutive skeleton voxels inside the region. Each run becomes a new edge whose outer ends are connected to new nodes placed on the boundary.
+    The features of these edges are recomputed from their skeleton voxels.
+
+    Args:
+        graph_json (dict): The graph in Voreen's graph JSON schema.
+        df_nodes (pd.DataFrame): Node table of the graph, indexed by id.
+        df_edges (pd.DataFrame): Edge table of the graph, indexed by id. Edges missing in this table are ignored.
+        mask (np.ndarray): 2D boolean mask of the region. Positions are looked up with their first two coordinates.
+
+    Returns:
+        tuple[dict, pd.DataFrame, pd.DataFrame]: The clipped graph, its node table and its edge table.
+    """
+    nodes = {n["id"]: n for n in graph_json["graph"]["nodes"]}
+    node_inside = _inside(mask, [n["pos"] for n in nodes.values()])
+    kept_nodes = {i: n for (i, n), inside in zip(nodes.items(), node_inside) if inside}
+    # Look up all skeleton voxels at once
+    graph_edges = [e for e in graph_json["graph"]["edges"] if e["id"] in df_edges.index]
+    voxel_counts = [len(e.get("skeletonVoxels", [])) for e in graph_edges]
+    voxel_inside = np.split(
+        _inside(mask, [v["pos"] for e in graph_edges for v in e.get("skeletonVoxels", [])]),
+        np.cumsum(voxel_counts)[:-1]
+    ) if graph_edges else []
+    next_node_id = max(nodes.keys(), default=-1) + 1
+    next_edge_id = max((e["id"] for e in graph_json["graph"]["edges"]), default=-1) + 1
+    new_nodes = []
+    edges = []
+    clipped_edge_ids = []
+
+    def boundary_node(inside_pos: list[float], outside_pos: list[float]) -> int:
+        nonlocal next_node_id
+        node = {
+            "id": next_node_id,
+            "pos": [(a + b) / 2 for a, b in zip(inside_pos, outside_pos)],
+            "voxels_": [],
+            "radius": 0.0,
+            "isAtSampleBorder": True
+        }
+        new_nodes.append(node)
+        next_node_id += 1
+        return node["id"]
+
+    for e, inside in zip(graph_edges, voxel_inside):
+        voxels = e.get("skeletonVoxels", [])
+        node1_inside = e["node1"] in kept_nodes
+        node2_inside = e["node2"] in kept_nodes
+        if inside.all() and node1_inside and node2_inside:
+            edges.append(e)
+            continue
+        if not (inside.any() or node1_inside or node2_inside):
+            continue
+        # Positions along the edge including both nodes, so that runs can be attached to the original nodes or cut at the boundary
+        positions = [nodes[e["node1"]]["pos"], *[v["pos"] for v in voxels], nodes[e["node2"]]["pos"]]
+        inside = [node1_inside, *inside.tolist(), node2_inside]
+        i = 0
+        while i < len(inside):
+            if not inside[i]:
+                i += 1
+                continue
+            start = i
+            while i < len(inside) and inside[i]:
+                i += 1
+            stop = i  # exclusive
+            # positions[j] corresponds to voxels[j-1] for 1 <= j <= len(voxels)
+            run_voxels = voxels[max(start - 1, 0):max(stop - 1, 0)]
+            if not run_voxels:
+                continue
+            node1 = e["node1"] if start == 0 else boundary_node(positions[start], positions[start - 1])
+            node2 = e["node2"] if stop == len(inside) else boundary_node(positions[stop - 1], positions[stop])
+            clipped = {**e, "id": next_edge_id, "node1": node1, "node2": node2, "skeletonVoxels": run_voxels}
+            next_edge_id += 1
+            edges.append(clipped)
+            clipped_edge_ids.append(clipped["id"])
+
+    used_nodes = {e["node1"] for e in edges} | {e["node2"] for e in edges}
+    graph_nodes = list(kept_nodes.values()) + [n for n in new_nodes if n["id"] in used_nodes]
+    clipped_graph = {"graph": {**graph_json["graph"], "nodes": graph_nodes, "edges": edges}}
+
+    # Reuse the original features for untouched edges and recompute them for clipped edges.
+    # Clipped edges received new ids beyond the original ones.
+    kept_edge_ids = [e["id"] for e in edges if e["id"] in df_edges.index]
+    clipped_edge_ids = set(clipped_edge_ids)
+    computed_nodes, computed_edges = graph_to_tables(clipped_graph, edge_ids=clipped_edge_ids)
+    df_edges_clipped = pd.concat([df for df in [df_edges.loc[kept_edge_ids], computed_edges] if len(df)]).sort_index() if edges else df_edges.iloc[:0]
+    degree = computed_nodes["degree"]
+    df_edges_clipped["node1_degree"] = degree.loc[df_edges_clipped.node1id].to_numpy()
+    df_edges_clipped["node2_degree"] = degree.loc[df_edges_clipped.node2id].to_numpy()
+
+    kept_node_ids = [i for i in kept_nodes.keys() if i in df_nodes.index]
+    new_node_ids = [n["id"] for n in graph_nodes if n["id"] not in df_nodes.index]
+    df_nodes_clipped = pd.concat([df for df in [df_nodes.loc[kept_node_ids], computed_nodes.loc[new_node_ids]] if len(df)]).sort_index() if graph_nodes else df_nodes.iloc[:0]
+    df_nodes_clipped["degree"] = degree.loc[df_nodes_clipped.index]
+    return clipped_graph, df_nodes_clipped, df_edges_clipped
@@ -11,6 +11,12 @@ from matplotlib import pyplot as plt
 from matplotlib.patches import Circle
 from PIL import Image
 
+from utils.file_io import atomic_path
+from utils.vessel_graph import as_graph_arrays
+
+# Minimum distance (in pixels) a disc has to reach into a pixel to color it. Matches the coverage threshold of matplotlib's antialiased rendering.
+_COVERAGE_MARGIN = 0.05
+
 
 def rasterize_forest(forest: dict,
                      image_scale_factor: np.ndarray,
@@ -112,20 +118,158 @@ def node_edges_to_graph(nodes_file_path: str, edges_file_path: str, shape: tuple
     return img
 
 
+def _disc_pixels(centers: np.ndarray, radii: np.ndarray, dim: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds all pixels covered by a set of discs. A pixel is covered if the disc reaches at least `_COVERAGE_MARGIN` into the pixel area.
+    Discs are grouped by the size of their bounding box so that the distances of each group are computed at once.
+    Args:
+        centers (np.ndarray): Disc centers of shape (N, 2) in pixel units. Pixel (i, j) covers the area [i, i+1] x [j, j+1].
+        radii (np.ndarray): Non-negative disc radii of shape (N,) in pixel units.
+        dim (int): The dimension of the image (assumed square).
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Disc index and flat pixel index of every covered pixel.
+    """
+    extents = np.ceil(radii).astype(np.int64)
+    reach = np.maximum(radii - _COVERAGE_MARGIN, 0)
+    disc_indices = [np.empty(0, dtype=np.int64)]
+    pixel_indices = [np.empty(0, dtype=np.int64)]
+    for extent in np.unique(extents[reach > 0]):
+        discs = np.flatnonzero((extents == extent) & (reach > 0))
+        offsets = np.arange(-extent, extent + 1)
+        rows = np.floor(centers[discs, 0, np.newaxis]).astype(np.int64) + offsets
+        cols = np.floor(centers[discs, 1, np.newaxis]).astype(np.int64) + offsets
+        # Distance from the disc center to the closest point of each pixel
+        dy = np.maximum(np.abs(rows + .5 - centers[discs, 0, np.newaxis]) - .5, 0)
+        dx = np.maximum(np.abs(cols + .5 - centers[discs, 1, np.newaxis]) - .5, 0)
+        covered = dy[:, :, np.newaxis] ** 2 + dx[:, np.newaxis, :] ** 2 < reach[discs, np.newaxis, np.newaxis] ** 2
+        covered &= ((rows >= 0) & (rows < dim))[:, :, np.newaxis] & ((cols >= 0) & (cols < dim))[:, np.newaxis, :]
+        disc, row, col = np.nonzero(covered)
+        disc_indices.append(discs[disc])
+        pixel_indices.append(rows[disc, row] * dim + cols[disc, col])
+    return np.concatenate(disc_indices), np.concatenate(pixel_indices)
+
+
+def rasterize_discs(
+        centers: np.ndarray,
+        radii: np.ndarray,
+        colors: np.ndarray,
+        dim: int = 1216,
+        backend: Literal["matplotlib", "numpy"] = "matplotlib"
+    ) -> np.ndarray:
+    """
+    Draws filled discs into a black RGB image. Discs are drawn in the given order, i.e. later discs are drawn on top.
+    Args:
+        centers (np.ndarray): Disc centers of shape (N, 2) in normalized image coordinates [0, 1]. The first coordinate is the image row.
+        radii (np.ndarray): Disc radii of shape (N,) in normalized image coordinates.
+        colors (np.ndarray): RGBA colors of shape (N, 4) with values in [0, 1]. The alpha channel is ignored.
+        dim (int): The dimension of the image (assumed square).
+        backend (Literal["matplotlib", "numpy"]): Rasterization backend.
+            - "matplotlib": Draws a PatchCollection of circles on a figure and reads back the canvas.
+            - "numpy": Stamps all discs at once into a preallocated array. Pixels are not antialiased,
+                so colors at disc borders are not blended. The stamp covers slightly more border pixels than the matplotlib backend,
+                see `benchmarks.rasterizer_agreement`.
+    Returns:
+        np.ndarray: uint8 image of shape (dim, dim, 3).
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+    colors = np.asarray(colors, dtype=np.float64).reshape(-1, 4)
+    if backend == "matplotlib":
+        dpi=100
+        x_inch = dim / dpi
+        y_inch = dim / dpi
+        figure = plt.figure(figsize=(x_inch,y_inch))
+        figure.patch.set_facecolor('black')
+        ax = plt.axes([0., 0., 1., 1.], frameon=False, xticks=[], yticks=[])
+        circles = [Circle(xy=(x, y), radius=r) for (x, y), r in zip(centers, radii)]
+        ax.add_collection(collections.PatchCollection(circles, facecolors=colors, antialiaseds=True))
+        # Newer matplotlib versions autoscale the axes when adding a collection
+        ax.set_xlim(0, 1)
+        ax.set_ylim(0, 1)
+        figure.canvas.draw()
+        data = np.frombuffer(figure.canvas.buffer_rgba(), dtype=np.uint8)
+        image = data.reshape(figure.canvas.get_width_height()[::-1] + (4,))
+        image = image[:, :, :3]
+        plt.close(figure)
+        return np.ascontiguousarray(np.rot90(image, k=3))  # Rotate the image 90 degrees counter-clockwise
+    elif backend == "numpy":
+        # Pixel (i, j) of the rotated matplotlib image covers the normalized area [i, i+1] x [j, j+1] / dim.
+        # Matplotlib draws circles with negative radius like their absolute value.
+        disc_indices, pixel_indices = _disc_pixels(centers * dim, np.abs(radii) * dim, dim)
+        rgb = np.rint(colors[:, :3] * 255).astype(np.uint8)
+        image = np.zeros((dim * dim, 3), dtype=np.uint8)
+        if len(pixel_indices) and (rgb == rgb[0]).all():
+            # Drawing order does not matter for a single color
+            image[pixel_indices] = rgb[0]
+        elif len(pixel_indices):
+            # Keep the last disc drawn at each pixel
+            order = np.argsort(pixel_indices * len(radii) + disc_indices)
+            disc_indices, pixel_indices = disc_indices[order], pixel_indices[order]
+            last = np.append(pixel_indices[1:] != pixel_indices[:-1], True)
+            image[pixel_indices[last]] = rgb[disc_indices[last]]
+        return image.reshape(dim, dim, 3)
+    else:
+        raise ValueError(f"Unknown rasterization backend: {backend}")
+
+
+def _segment_medians(values: np.ndarray, segments: np.ndarray, num_segments: int) -> np.ndarray:
+    """
+    Computes the median of each segment like `np.median`. Empty segments have a median of 0.
+    """
+    sorted_values = values[np.lexsort((values, segments))]
+    counts = np.bincount(segments, minlength=num_segments)
+    starts = np.cumsum(counts) - counts
+    medians = np.zeros(num_segments, dtype=np.float64)
+    nonempty = counts > 0
+    lower = starts[nonempty] + (counts[nonempty] - 1) // 2
+    upper = starts[nonempty] + counts[nonempty] // 2
+    medians[nonempty] = (sorted_values[lower] + sorted_values[upper]) / 2
+    return medians
+
+
+def _edge_discs(graph: dict, edges_df: pd.DataFrame, dim: int, radius_correction_factor: float) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Computes the discs that render each edge of the graph. The radius of each disc is the distance of its skeleton voxel
+    to the vessel surface, limited to the corrected average radius of the edge.
+    Args:
+        graph (dict): The graph in Voreen's graph JSON schema or as graph arrays (see `utils.vessel_graph.graph_json_to_arrays`).
+        edges_df (pd.DataFrame): DataFrame containing edge properties, including 'avgRadiusAvg'. Edges missing in this table are skipped.
+        dim (int): The dimension of the image (assumed square).
+        radius_correction_factor (float): Additive correction factor for the average edge radius.
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Normalized disc centers of shape (N, 2), normalized disc radii of shape (N,),
+            edge index of each disc of shape (N,) and median disc radius of each edge of shape (E,). Edges are the edges of the graph
+            contained in `edges_df` in graph order.
+    """
+    arrays = as_graph_arrays(graph)
+    edge_ids = arrays["edge_ids"]
+    present = np.isin(edge_ids, edges_df.index.to_numpy())
+    # Correct the radius based on the correction factor
+    edge_radius = (edges_df["avgRadiusAvg"].reindex(edge_ids[present]).to_numpy(dtype=np.float64) + radius_correction_factor)/dim
+    voxel_edge = np.repeat(np.arange(len(edge_ids)), np.diff(arrays["offsets"]))
+    valid = present[voxel_edge] & np.isfinite(arrays["min_dist"])
+    # Index of each disc among the present edges
+    disc_edges = (np.cumsum(present) - 1)[voxel_edge[valid]]
+    radii = np.fmin(arrays["min_dist"][valid]/dim, edge_radius[disc_edges])
+    centers = arrays["voxel_pos"][valid, :2]/dim
+    return centers, radii, disc_edges, _segment_medians(radii, disc_edges, len(edge_radius))
+
+
 def generate_image_from_graph_json(
-        graph_json: pd.DataFrame,
+        graph_json: dict,
         edges_df: pd.DataFrame,
         radius_interval: tuple[float] = (0, np.inf),
         dim: int=1216,
         image_size_mm: float=3,
         colorize: Literal["continuous", "thresholds", "random", "white"] = "white",
         color_thresholds: list[float] = None,
-        radius_correction_factor: float = -1.0
+        radius_correction_factor: float = -1.0,
+        backend: Literal["matplotlib", "numpy"] = "matplotlib"
     ) -> np.ndarray:
     """
     Generates an image from a graph JSON structure and edges DataFrame.
     Args:
-        graph_json (pd.DataFrame): The graph JSON structure containing edges and their properties.
+        graph_json (dict): The graph in Voreen's graph JSON schema or as graph arrays loaded with `utils.vessel_graph.load_graph_arrays`.
         edges_df (pd.DataFrame): DataFrame containing edge properties, including 'avgRadiusAvg'.
         radius_interval (tuple[float]): A tuple specifying the minimum and maximum radius for edges to be included in the image.
         dim (int): The dimension of the image (assumed square).
@@ -137,72 +281,162 @@ def generate_image_from_graph_json(
             - None: Use a default color (white).
         color_thresholds (list[float]): A list of thresholds for coloring edges when `colorize` is set to "thresholds". 
             This should be provided as a list of floats representing the thresholds for edge radii.
+        backend (Literal["matplotlib", "numpy"]): Rasterization backend, see `rasterize_discs`.
     Returns:
         np.ndarray: An image represented as a NumPy array of shape (dim, dim).
     """
-    circles = list()
-    radii = list()
-    colors = list()
     colored_radius_add = .5/dim if colorize!="white" else 0 # Adjusted radius for colorized edges
-    if colorize == "thresholds":
+    centers, radii, disc_edges, edge_medians = _edge_discs(graph_json, edges_df, dim, radius_correction_factor)
+    # Check if the edge median is within the specified radius interval
+    selected_edges = (radius_interval[0] <= edge_medians*image_size_mm) & (edge_medians*image_size_mm <= radius_interval[1])
+    selected = selected_edges[disc_edges]
+    centers, radii, disc_edges = centers[selected], radii[selected], disc_edges[selected]
+    if colorize == "random":
+        edge_colors = np.ones((len(edge_medians), 4))
+        edge_colors[selected_edges, :3] = np.random.rand(selected_edges.sum(), 3)
+        colors = edge_colors[disc_edges]
+    elif colorize == "continuous":
+        cont_colors = np.minimum(radii * image_size_mm / 0.015,1)
+        colors = cm.plasma(cont_colors)
+    elif colorize == "thresholds":
         if color_thresholds is None:
             raise ValueError("color_thresholds must be provided when colorize is 'thresholds'")
         intensities = np.linspace(0.1, 1, num=len(color_thresholds) + 1)
         thresholds = np.array([0, *color_thresholds, math.inf]) / image_size_mm
-    for e in graph_json["graph"]["edges"]:
-        if e["id"] in edges_df.index:
-            # Correct the radius based on the correction factor
-            edge_radius= (edges_df.loc[e["id"], "avgRadiusAvg"] + radius_correction_factor)/dim
-            edge_radii = list()
-            edge_pos = list()
-            for v in e.get("skeletonVoxels", []):
-                if math.isfinite(v["minDistToSurface"]):
-                    radius = min(v["minDistToSurface"]/dim, edge_radius)
-                    edge_radii.append(radius)
-                    edge_pos.append((v["pos"][0]/dim, v["pos"][1]/dim))
-            edge_median = np.median(edge_radii) if edge_radii else 0
-            # Check if edge_median is within the specified radius interval
-            if not (radius_interval[0] <= edge_median*image_size_mm <= radius_interval[1]):
-                continue
-            circles.extend([Circle(xy=(x, y), radius=r+colored_radius_add) for (x, y), r in zip(edge_pos, edge_radii)])
-            radii.extend(edge_radii)
-            if colorize == "random":
-                color = np.random.rand(3)
-                colors.extend([color] * len(edge_radii))
-            elif colorize == "continuous":
-                cont_colors = np.minimum(np.array(edge_radii) * image_size_mm / 0.015,1)
-                colors.extend(cm.plasma(cont_colors))
-            elif colorize == "thresholds":
-                if color_thresholds is None:
-                    raise ValueError("color_thresholds must be provided when colorize is 'thresholds'")
-                c_new = np.zeros_like(edge_radii)
-                for i in range(1, len(thresholds)):
-                    c_new[(thresholds[i - 1] < edge_radii) & (edge_radii <= thresholds[i])] = intensities[i - 1]
-                colors.extend(cm.plasma(c_new))
-            elif colorize  == "white":
-                # Default color (white)
-                colors.extend([np.array([1, 1, 1, 1])] * len(edge_radii))
-            else:
-                raise ValueError(f"Unknown colorize option: {colorize}")
-    # Sort circles, random_colors, and radii together by radius in descending order
-    indices = sorted(range(len(radii)), key=lambda i: radii[i], reverse=True)
-    circles = [circles[i] for i in indices]
-    colors = [colors[i] for i in indices]
-    radii = [radii[i] for i in indices]
-
-    dpi=100
-    x_inch = dim / dpi
-    y_inch = dim / dpi
-    figure = plt.figure(figsize=(x_inch,y_inch))
-    figure.patch.set_facecolor('black')
-    ax = plt.axes([0., 0., 1., 1.], frameon=False, xticks=[], yticks=[])
-    ax.add_collection(collections.PatchCollection(circles, facecolors=colors, antialiaseds=True))
-    figure.canvas.draw()
-    data = np.frombuffer(figure.canvas.buffer_rgba(), dtype=np.uint8)
-    image = data.reshape(figure.canvas.get_width_height()[::-1] + (4,))
-    image = image[:, :, :3]
+        c_new = np.zeros_like(radii)
+        for i in range(1, len(thresholds)):
+            c_new[(thresholds[i - 1] < radii) & (radii <= thresholds[i])] = intensities[i - 1]
+        colors = cm.plasma(c_new)
+    elif colorize  == "white":
+        # Default color (white)
+        colors = np.ones((len(radii), 4))
+    else:
+        raise ValueError(f"Unknown colorize option: {colorize}")
+    # Sort circles, colors, and radii together by radius in descending order
+    indices = np.argsort(-radii, kind="stable")
+    image = rasterize_discs(
+        centers[indices],
+        radii[indices] + colored_radius_add,
+        colors[indices],
+        dim=dim,
+        backend=backend
+    )
     if colorize == "white":
         image = image.max(axis=-1)  # Convert to grayscale
         image[image>0] = 255  # Convert to binary image
-    plt.close(figure)
-    return np.rot90(image, k=3)  # Rotate the image 90 degrees counter-clockwise
+    return image
+
+
+def generate_interval_map_from_graph_json(
+        graph_json: dict,
+        edges_df: pd.DataFrame,
+        radius_intervals: list[tuple[float, float]],
+        dim: int = 1216,
+        image_size_mm: float = 3,
+        radius_correction_factor: float = -1.0
+    ) -> np.ndarray:
+    """
+    Renders the graph once for multiple radius intervals. Bit k of a pixel is set if the pixel is covered by an edge whose median radius
+    lies in the k-th interval. Interval bounds are inclusive as in `generate_image_from_graph_json`, so an edge can belong to multiple intervals.
+    Bit k is identical to `generate_image_from_graph_json(..., radius_interval=radius_intervals[k], colorize="white", backend="numpy") > 0`.
+    Args:
+        graph_json (dict): The graph in Voreen's graph JSON schema or as graph arrays loaded with `utils.vessel_graph.load_graph_arrays`.
+        edges_df (pd.DataFrame): DataFrame containing edge properties, including 'avgRadiusAvg'.
+        radius_intervals (list[tuple[float, float]]): Radius intervals in mm. At most 64 intervals are supported.
+        dim (int): The dimension of the image (assumed square).
+        image_size_mm (float): The size of the image in millimeters, used for scaling.
+        radius_correction_factor (float): Additive correction factor for the average edge radius.
+    Returns:
+        np.ndarray: Unsigned integer bitmask of shape (dim, dim). The dtype is the smallest that holds one bit per interval.
+    """
+    assert len(radius_intervals) <= 64, "At most 64 radius intervals are supported!"
+    dtype = next(t for t in [np.uint8, np.uint16, np.uint32, np.uint64] if np.iinfo(t).bits >= len(radius_intervals))
+    centers, radii, disc_edges, edge_medians = _edge_discs(graph_json, edges_df, dim, radius_correction_factor)
+    edge_bits = np.zeros(len(edge_medians), dtype=dtype)
+    for k, (lower, upper) in enumerate(radius_intervals):
+        edge_bits[(lower <= edge_medians*image_size_mm) & (edge_medians*image_size_mm <= upper)] |= dtype(1 << k)
+    disc_bits = edge_bits[disc_edges]
+    selected = disc_bits > 0
+    disc_bits = disc_bits[selected]
+    disc_indices, pixel_indices = _disc_pixels(centers[selected] * dim, np.abs(radii[selected]) * dim, dim)
+    interval_map = np.zeros(dim * dim, dtype=dtype)
+    pixel_bits = disc_bits[disc_indices]
+    # All pixels of a group receive the same bits, so duplicate pixel indices are harmless
+    for bits in np.unique(pixel_bits):
+        interval_map[pixel_indices[pixel_bits == bits]] |= bits
+    return interval_map.reshape(dim, dim)
+
+
+def generate_edge_coverage_from_graph_json(
+        graph_json: dict,
+        edges_df: pd.DataFrame,
+        seg_img: np.ndarray,
+        dim: int = 1216,
+        radius_correction_factor: float = -1.0
+    ) -> dict[str, np.ndarray]:
+    """
+    Renders the graph once and records which edges cover each segmented pixel, independently of any radius intervals.
+    The interval map of `generate_interval_map_from_graph_json` restricted to the segmentation follows from the coverage
+    and the median radius of each edge for any radius intervals and image size in mm.
+    Args:
+        graph_json (dict): The graph in Voreen's graph JSON schema or as graph arrays loaded with `utils.vessel_graph.load_graph_arrays`.
+        edges_df (pd.DataFrame): DataFrame containing edge properties, including 'avgRadiusAvg'.
+        seg_img (np.ndarray): Segmentation map of shape (dim, dim). Only pixels with non-zero values are counted.
+        dim (int): The dimension of the image (assumed square).
+        radius_correction_factor (float): Additive correction factor for the average edge radius.
+    Returns:
+        dict[str, np.ndarray]: The coverage arrays
+            - "edge_medians": Median disc radius of each rendered edge in normalized image units of shape (E,).
+            - "edge_pixels": Number of segmented pixels covered by this edge only of shape (E,).
+            - "shared_edges": Sets of edges that cover the same pixels of shape (G, K), padded with -1.
+            - "shared_pixels": Number of segmented pixels covered by exactly each set of edges of shape (G,).
+    """
+    centers, radii, disc_edges, edge_medians = _edge_discs(graph_json, edges_df, dim, radius_correction_factor)
+    num_edges = len(edge_medians)
+    disc_indices, pixel_indices = _disc_pixels(centers * dim, np.abs(radii) * dim, dim)
+    segmented = np.asarray(seg_img).ravel()[pixel_indices] > 0
+    # Each covered segmented pixel once per edge, ordered by pixel and edge
+    pairs = np.unique(pixel_indices[segmented] * max(num_edges, 1) + disc_edges[disc_indices[segmented]])
+    pixels, edges = np.divmod(pairs, max(num_edges, 1))
+    starts = np.flatnonzero(np.append(True, pixels[1:] != pixels[:-1])) if len(pixels) else np.empty(0, dtype=np.int64)
+    counts = np.diff(np.append(starts, len(pixels)))
+    single = counts == 1
+    shared_starts, shared_counts = starts[~single], counts[~single]
+    shared = np.full((len(shared_starts), int(shared_counts.max(initial=0))), -1, dtype=np.int64)
+    for j in range(shared.shape[1]):
+        has_edge = shared_counts > j
+        shared[has_edge, j] = edges[shared_starts[has_edge] + j]
+    shared_edges, shared_pixels = np.unique(shared, axis=0, return_counts=True)
+    return {
+        "edge_medians": edge_medians,
+        "edge_pixels": np.bincount(edges[starts[single]], minlength=num_edges),
+        "shared_edges": shared_edges.reshape(-1, shared.shape[1]),
+        "shared_pixels": shared_pixels
+    }
+
+
+def save_graph_image(
+        graph_json: dict,
+        edges_df: pd.DataFrame,
+        segmentation_2d_mask: np.ndarray,
+        path: str,
+        **kwargs
+    ):
+    """
+    Renders the graph with `generate_image_from_graph_json`, masks it with the segmentation and saves it as an image.
+    Args:
+        graph_json (dict): The graph in Voreen's graph JSON schema or as graph arrays.
+        edges_df (pd.DataFrame): DataFrame containing edge properties, including 'avgRadiusAvg'.
+        segmentation_2d_mask (np.ndarray): 2D segmentation used to mask the rendered graph. Values can be in {0,1} or {0,255}.
+        path (str): Output path of the image.
+        **kwargs: Additional arguments passed to `generate_image_from_graph_json`. The image dimension defaults to the mask height.
+    """
+    segmentation_2d_mask = segmentation_2d_mask.astype(np.uint8)
+    if segmentation_2d_mask.max() > 1:
+        segmentation_2d_mask = segmentation_2d_mask // 255
+    kwargs.setdefault("dim", segmentation_2d_mask.shape[0])
+    img = generate_image_from_graph_json(graph_json, edges_df, **kwargs)
+    if img.ndim == 3:
+        segmentation_2d_mask = segmentation_2d_mask[..., np.newaxis]
+    with atomic_path(path) as tmp_path:
+        Image.fromarray(img * segmentation_2d_mask).save(tmp_path)
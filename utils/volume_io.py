@@ -0,0 +1,244 @@
+"""
+Slab-wise access to 3D segmentation volumes.
+
+The Voreen graph extraction needs every volume, and every ETDRS sector of a volume, as an uncompressed NIFTI file.
+Instead of materializing a masked copy of the volume and saving it with nibabel, the volume is read (or generated from the
+height map of a 2D segmentation) a few z-slices at a time, masked, and appended to the output file. The memory of a writer is
+therefore bounded by one slab, independent of the number of sectors:
+    - 2D segmentations: the int32 height map (4 bytes per pixel), plus one slab in the output dtype.
+    - NIFTI segmentations: one slab of the input and of the output dtype. The input is read through the nibabel array proxy,
+      i.e. `.nii` files are read slice-wise from disk and `.nii.gz` files are decompressed sequentially.
+The output is written with sequential writes instead of a memory map, so written pages are never mapped into the process
+and do not count towards its resident set size. A volume can be cropped to the bounding box of its non-zero voxels
+(see `SlabVolume.bounding_box`), so that only that region is generated and written.
+
+The stages that need a 2D segmentation use the maximum projection of 3D inputs, see `load_2d_segmentation`. The projection is
+computed slab-wise in the native data type of the NIFTI file instead of float64. If the environment variable `OCTA_PROJECTION_CACHE`
+points to a folder, the projection of each volume is cached there, so that the stages and their worker processes compute it once.
+"""
+import hashlib
+import os
+
+import nibabel as nib
+import numpy as np
+from PIL import Image
+
+from utils.convert_2d_to_3d import compute_height_map, height_map_to_volume
+from utils.file_io import atomic_path
+
+NIFTI_DATA_OFFSET = 352
+
+
+def is_nifti(path: str) -> bool:
+    return path.endswith(".nii.gz") or path.endswith(".nii")
+
+
+class SlabVolume:
+    """
+    A read-only 3D volume that is produced in z-slabs. A 2D mask restricts the volume to a region without copying the voxels,
+    and a bounding box crops it to a box.
+
+    Args:
+        data: 3D array or nibabel array proxy with the voxels. Mutually exclusive with `height_map`.
+        height_map (np.ndarray): Height map of a 2D segmentation as computed by `compute_height_map`.
+        z_dim (int): Depth of the volume generated from `height_map`.
+        mask (np.ndarray): 2D boolean mask. Voxels outside of the mask are zero.
+        bbox (tuple[slice, slice, slice]): Region of the uncropped volume that this volume consists of. Defaults to the whole volume.
+    """
+    def __init__(self, data=None, height_map: np.ndarray = None, z_dim: int = None, mask: np.ndarray = None, bbox: tuple[slice, slice, slice] = None):
+        assert (data is None) != (height_map is None), "Provide either the voxel data or a height map."
+        assert height_map is None or z_dim is not None, "A height map requires the z dimension."
+        self.data = data
+        self.height_map = height_map
+        self.z_dim = z_dim
+        self.mask = mask
+        if data is not None:
+            self.full_shape = tuple(data.shape)
+            # Array proxies return scaled values, so the dtype is taken from an empty slab
+            self.dtype = np.asarray(data[:, :, 0:0]).dtype
+        else:
+            self.full_shape = (*height_map.shape, z_dim)
+            self.dtype = np.dtype(np.uint8)
+        assert len(self.full_shape) == 3, f"Expected a 3D volume, got shape {self.full_shape}."
+        self.bbox = bbox if bbox is not None else tuple(slice(0, n) for n in self.full_shape)
+        self.shape = tuple(s.stop - s.start for s in self.bbox)
+
+    @property
+    def offset(self) -> tuple[int, int, int]:
+        """Position of the first voxel of this volume in the uncropped volume."""
+        return tuple(s.start for s in self.bbox)
+
+    @classmethod
+    def from_file(cls, path: str, z_dim: int = 64) -> tuple["SlabVolume", nib.Nifti1Header]:
+        """
+        Opens a vessel segmentation without loading its voxels. 2D images are represented by their height map.
+
+        Returns:
+            tuple[SlabVolume, nib.Nifti1Header]: The volume and the header of a NIFTI file, or None for 2D images.
+        """
+        if is_nifti(path):
+            nifti: nib.Nifti1Image = nib.load(path, keep_file_open=True)
+            return cls(data=nifti.dataobj), nifti.header
+        return cls(height_map=compute_height_map(np.array(Image.open(path), np.uint8)), z_dim=z_dim), None
+
+    @classmethod
+    def from_nifti(cls, nifti: nib.Nifti1Image) -> "SlabVolume":
+        return cls(data=nifti.dataobj)
+
+    def masked(self, mask: np.ndarray) -> "SlabVolume":
+        """
+        Returns the volume restricted to a 2D mask. The voxels are shared with this volume.
+        For height maps, the pixels outside of the mask are removed from the (2D) height map instead.
+        """
+        assert mask.shape == self.full_shape[:2], f"The mask shape {mask.shape} does not match the volume shape {self.full_shape}."
+        mask = mask if self.mask is None else (mask & self.mask)
+        if self.height_map is not None:
+            return SlabVolume(height_map=np.where(mask, self.height_map, -1), z_dim=self.z_dim, bbox=self.bbox)
+        return SlabVolume(data=self.data, mask=mask, bbox=self.bbox)
+
+    def bounding_box(self, margin: int = 2) -> tuple[slice, slice, slice]:
+        """
+        Bounding box of the non-zero voxels in the uncropped volume, extended by `margin` empty voxels on each side that does not touch
+        the border of the volume. Voxels at the border of the box are then only at the border of the uncropped volume, too.
+        For height maps, the z range is symmetric to the center slice, so that the center of the cropped volume is the center of the balls.
+
+        Returns:
+            tuple[slice, slice, slice]: The bounding box, or None if the volume is empty.
+        """
+        if self.height_map is not None:
+            height_map = self.height_map[self.bbox[:2]]
+            if height_map.max(initial=-1) < 0:
+                return None
+            projection = height_map >= 0
+            center = self.z_dim // 2
+            half_height = int(height_map.max()) + margin
+            z_range = (center - half_height, center + half_height + 1)
+            if z_range[0] < self.bbox[2].start or z_range[1] > self.bbox[2].stop:
+                z_range = (self.bbox[2].start, self.bbox[2].stop)
+        else:
+            projection, z_occupied = None, []
+            for slab in self.slabs():
+                projection = slab.max(axis=2) > 0 if projection is None else projection | (slab.max(axis=2) > 0)
+                z_occupied.extend(slab.any(axis=(0, 1)))
+            if not np.any(z_occupied):
+                return None
+            z = np.flatnonzero(z_occupied) + self.bbox[2].start
+            z_range = (max(z[0] - margin, self.bbox[2].start), min(z[-1] + margin + 1, self.bbox[2].stop))
+        bbox = []
+        for axis, s in enumerate(self.bbox[:2]):
+            occupied = np.flatnonzero(projection.any(axis=1 - axis)) + s.start
+            bbox.append(slice(int(max(occupied[0] - margin, s.start)), int(min(occupied[-1] + margin + 1, s.stop))))
+        return (*bbox, slice(int(z_range[0]), int(z_range[1])))
+
+    def cropped(self, bbox: tuple[slice, slice, slice]) -> "SlabVolume":
+        """Returns the volume cropped to a bounding box in the uncropped volume, e.g. of `bounding_box`. The voxels are shared with this volume."""
+        return SlabVolume(data=self.data, height_map=self.height_map, z_dim=self.z_dim, mask=self.mask, bbox=bbox)
+
+    def slabs(self, slab_size: int = 8):
+        """Yields the volume in slabs of `slab_size` z-slices."""
+        for z_start in range(0, self.shape[2], slab_size):
+            yield self.slab(z_start, min(z_start + slab_size, self.shape[2]))
+
+    def max_projection(self, slab_size: int = 8) -> np.ndarray:
+        """Maximum intensity projection along the z-axis in the data type of the volume."""
+        projection = None
+        for slab in self.slabs(slab_size):
+            projection = slab.max(axis=2) if projection is None else np.maximum(projection, slab.max(axis=2))
+        return projection
+
+    def slab(self, z_start: int, z_stop: int) -> np.ndarray:
+        """Returns the voxels of the z-slices `z_start` to `z_stop` (exclusive)."""
+        rows, cols, z = self.bbox
+        z_start, z_stop = z_start + z.start, z_stop + z.start
+        if self.height_map is not None:
+            return height_map_to_volume(self.height_map[rows, cols], self.z_dim, z_start=z_start, z_stop=z_stop)
+        slab = np.asarray(self.data[rows, cols, z_start:z_stop])
+        if self.mask is not None:
+            slab = np.where(self.mask[rows, cols, np.newaxis], slab, slab.dtype.type(0))
+        return slab
+
+
+def default_nifti_header(shape: tuple[int, int, int]) -> nib.Nifti1Header:
+    """
+    Header of a segmentation volume without NIFTI source: identity affine, mm units and the default float32 data type.
+    """
+    header = nib.Nifti1Header()
+    header.set_xyzt_units(xyz="mm", t="sec")
+    header.set_data_shape(shape)
+    return nib.Nifti1Image(np.broadcast_to(np.zeros((), np.uint8), shape), np.eye(4), header=header).header
+
+def write_nifti(volume: SlabVolume, path: str, header: nib.Nifti1Header = None, slab_size: int = 8) -> np.ndarray:
+    """
+    Writes a volume to an uncompressed NIFTI file slab by slab. The file is identical to the output of `nib.save` for the same voxels and header.
+
+    Args:
+        volume (SlabVolume): The volume to write.
+        path (str): Path of the `.nii` file.
+        header (nib.Nifti1Header): Header of the file, e.g. of the source segmentation. The data type of the header is kept if the
+            voxels can be cast safely. By default, see `default_nifti_header`.
+        slab_size (int): Number of z-slices written at once. Bounds the memory usage of the writer.
+
+    Returns:
+        np.ndarray: Maximum intensity projection of the volume along the z-axis.
+    """
+    assert path.endswith(".nii"), "Only uncompressed NIFTI files can be written slab-wise."
+    header = default_nifti_header(volume.shape) if header is None else header.copy()
+    header.set_data_shape(volume.shape)
+    if not np.can_cast(volume.dtype, header.get_data_dtype()):
+        header.set_data_dtype(volume.dtype)
+    out_dtype = header.get_data_dtype()
+    # The voxels are written unscaled, i.e. the values of scaled NIFTI sources are already applied
+    header.set_slope_inter(1.0, 0.0)
+    header.set_data_offset(NIFTI_DATA_OFFSET)
+
+    projection = None
+    with open(path, "wb") as file:
+        header.write_to(file)
+        file.write(b"\0" * (NIFTI_DATA_OFFSET - file.tell()))
+        # NIFTI stores voxels in Fortran order, so each z-slab is a contiguous block of the file
+        for slab in volume.slabs(slab_size):
+            projection = slab.max(axis=2) if projection is None else np.maximum(projection, slab.max(axis=2))
+            file.write(np.ascontiguousarray(slab.T, dtype=out_dtype))
+    return projection
+
+def set_projection_cache(path: str):
+    """Sets the projection cache folder of this process and all worker processes started afterwards."""
+    os.environ["OCTA_PROJECTION_CACHE"] = path
+
+def _projection_cache_path(path: str) -> str:
+    """Cache file of the projection of a volume. The key changes when the file is modified."""
+    cache_dir = os.getenv("OCTA_PROJECTION_CACHE")
+    if not cache_dir:
+        return None
+    stat = os.stat(path)
+    key = hashlib.sha256(f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.npy")
+
+def load_2d_segmentation(path: str) -> np.ndarray:
+    """
+    Loads a vessel segmentation as 2D image. NIFTI volumes are reduced by a maximum projection along z in their native data type.
+
+    Args:
+        path (str): Path of a 2D image or a `.nii`/`.nii.gz` volume.
+
+    Returns:
+        np.ndarray: The 2D segmentation.
+    """
+    if not is_nifti(path):
+        return np.array(Image.open(path))
+    cache_path = _projection_cache_path(path)
+    if cache_path is not None and os.path.isfile(cache_path):
+        return np.load(cache_path)
+    projection = SlabVolume.from_file(path)[0].max_projection()
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with atomic_path(cache_path) as tmp_path:
+            with open(tmp_path, "wb") as file:
+                np.save(file, projection)
+    return projection
+
+def segmentation_shape(path: str) -> tuple[int, int]:
+    """Shape of the 2D segmentation of `load_2d_segmentation` without loading the voxels."""
+    if is_nifti(path):
+        return tuple(nib.load(path).shape[:2])
+    return Image.open(path).size[::-1]
@@ -0,0 +1,176 @@
+"""
+Pool of Voreen containers that share the voreentool runs of all worker processes.
+
+The pool starts N containers from the Voreen image with the same volume bindings, so every job can run in any container.
+Each container has `max_concurrency` slots. A slot is a lock file in a host folder, so worker processes and threads coordinate
+without a server: `acquire` takes a free slot of the container with the fewest busy slots and waits if all slots are busy.
+The operating system releases the lock of a worker that dies, so slots never leak.
+Before a container is used, it is checked to be running. A container that died is replaced by a new one with the same bindings.
+The pool is picklable and is passed to the workers instead of a container name (see `run_voreentool`).
+"""
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import docker
+from utils.voreen_vesselgraphextraction import DOCKER_VOREEN_TOOL_PATH
+
+
+def start_voreen_container(voreen_image_name: str, volumes: dict[str, dict[str, str]]) -> str:
+    """
+    Starts a Voreen container that idles until commands are executed in it.
+
+    Args:
+        voreen_image_name (str): Name of the Voreen image.
+        volumes (dict[str, dict[str, str]]): Volume bindings in the format of `docker.models.containers.ContainerCollection.run`.
+
+    Returns:
+        str: The name of the container.
+    """
+    client = docker.from_env()
+    container = client.containers.run(
+        image=voreen_image_name,
+        detach=True,
+        tty=True,
+        stdin_open=True,
+        command="tail -f /dev/null",
+        user=f"{os.getuid()}:{os.getgid()}",
+        volumes=volumes,
+    )
+    # Ensure Voreen can write to its internal data directory
+    container.exec_run(user="root", cmd=f"chmod 777 -R {DOCKER_VOREEN_TOOL_PATH}/../data")
+    return container.name
+
+def _try_lock(path: str) -> int:
+    """Returns a file descriptor holding an exclusive lock of the file, or None if the file is locked by someone else."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+def _unlock(fd: int):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+class VoreenContainerPool:
+    """
+    Voreen containers with a concurrency limit per container. See the module documentation.
+    """
+
+    def __init__(self, voreen_image_name: str, volumes: dict[str, dict[str, str]], size: int, max_concurrency: int, state_dir: str):
+        """
+        Use `VoreenContainerPool.start` to create a pool.
+
+        Args:
+            voreen_image_name (str): Name of the Voreen image.
+            volumes (dict[str, dict[str, str]]): Volume bindings of all containers.
+            size (int): Number of containers.
+            max_concurrency (int): Maximum number of concurrent voreentool runs per container.
+            state_dir (str): Host folder with the current container names and the slot lock files.
+        """
+        self.voreen_image_name = voreen_image_name
+        self.volumes = volumes
+        self.size = size
+        self.max_concurrency = max_concurrency
+        self.state_dir = state_dir
+
+    @classmethod
+    def start(cls, voreen_image_name: str, volumes: dict[str, dict[str, str]], size: int, max_concurrency: int = 1) -> "VoreenContainerPool":
+        """Starts `size` containers and returns the pool."""
+        assert size >= 1 and max_concurrency >= 1, "The pool needs at least one container and one slot per container."
+        pool = cls(voreen_image_name, volumes, size, max_concurrency, tempfile.mkdtemp(prefix="voreen_pool_"))
+        for i in range(size):
+            pool._write_name(i, start_voreen_container(voreen_image_name, volumes))
+        return pool
+
+    def _name_path(self, i: int) -> str:
+        return os.path.join(self.state_dir, f"{i}.name")
+
+    def _slot_path(self, i: int, slot: int) -> str:
+        return os.path.join(self.state_dir, f"{i}.{slot}.slot")
+
+    def _write_name(self, i: int, name: str):
+        with open(self._name_path(i) + ".tmp", "w") as file:
+            file.write(name)
+        os.replace(self._name_path(i) + ".tmp", self._name_path(i))
+
+    def container_names(self) -> list[str]:
+        names = []
+        for i in range(self.size):
+            with open(self._name_path(i)) as file:
+                names.append(file.read())
+        return names
+
+    def _healthy_container(self, i: int) -> str:
+        """Returns the name of the i-th container. If it is not running anymore, it is replaced by a new container."""
+        fd = os.open(self._name_path(i) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Only one worker replaces a container. The others wait and use the replacement.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with open(self._name_path(i)) as file:
+                name = file.read()
+            client = docker.from_env()
+            try:
+                container = client.containers.get(name)
+                if container.status == "running":
+                    return name
+                container.remove(force=True)
+            except docker.errors.NotFound:
+                pass
+            new_name = start_voreen_container(self.voreen_image_name, self.volumes)
+            self._write_name(i, new_name)
+            print(f"Voreen container {name} is not running anymore. Replaced it with {new_name}.")
+            return new_name
+        finally:
+            _unlock(fd)
+
+    @contextmanager
+    def acquire(self, poll_interval: float = 0.1):
+        """
+        Reserves a slot of the least loaded container for the duration of the context.
+
+        Yields:
+            str: The name of the running container.
+        """
+        while True:
+            # Probing a slot locks it, so the free slots of the best container found so far are kept until a better one is found
+            best, best_free = None, []
+            for i in range(self.size):
+                free = [fd for fd in (_try_lock(self._slot_path(i, s)) for s in range(self.max_concurrency)) if fd is not None]
+                if len(free) > len(best_free):
+                    for fd in best_free:
+                        _unlock(fd)
+                    best, best_free = i, free
+                else:
+                    for fd in free:
+                        _unlock(fd)
+            if best is not None:
+                break
+            time.sleep(poll_interval)
+        slot, *unused = best_free
+        for fd in unused:
+            _unlock(fd)
+        try:
+            yield self._healthy_container(best)
+        finally:
+            _unlock(slot)
+
+    def close(self):
+        """Stops and removes all containers of the pool."""
+        client = docker.from_env()
+        for name in self.container_names():
+            try:
+                container = client.containers.get(name)
+                container.stop()
+                container.remove()
+                print(f"Container '{name}' stopped and removed.")
+            except docker.errors.NotFound:
+                pass
+        shutil.rmtree(self.state_dir, ignore_errors=True)
@@ -0,0 +1,184 @@
+"""
+Asynchronous scheduler for the Voreen graph extraction.
+
+Each image passes three steps that are limited by different resources:
+    1. Preprocessing (CPU): Build the 3D volumes and save them as NIFTI files. Runs in a process pool.
+    2. Voreen (container): Run voreentool on a batch of volumes. At most `voreen_concurrency` runs are in flight.
+       They are awaited in threads, so a waiting run costs no extra interpreter process.
+    3. Postprocessing (CPU): Filter the CSV files, render the graph images and split ETDRS graphs. Runs in a second process pool.
+Volumes that are ready while all Voreen slots are busy are combined into batches of up to `batch_size` volumes.
+The number of images between preprocessing and postprocessing is bounded by `max_pending`,
+which limits the memory and temporary disk space that queued volumes occupy. With a memory budget, an image is only admitted
+while the estimated memory of all admitted images stays within the budget (see `utils.memory_budget`).
+"""
+import asyncio
+import concurrent.futures
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Callable
+
+from utils.memory_budget import measure_peak_rss
+
+
+async def _dispatch_batches(queue: asyncio.Queue, run_batch: Callable[[list[dict]], None], batch_size: int, voreen_concurrency: int):
+    semaphore = asyncio.Semaphore(voreen_concurrency)
+    running = set()
+
+    async def run(batch: list[tuple[dict, asyncio.Future]]):
+        try:
+            await asyncio.to_thread(run_batch, [job for job, _ in batch])
+            for _, done in batch:
+                done.set_result(None)
+        except Exception as e:
+            for _, done in batch:
+                done.set_exception(e)
+        finally:
+            semaphore.release()
+
+    closed = False
+    while not closed:
+        item = await queue.get()
+        if item is None:
+            break
+        await semaphore.acquire()
+        # Add the jobs that arrived while waiting for a free Voreen slot
+        batch = [item]
+        while len(batch) < batch_size and not queue.empty():
+            item = queue.get_nowait()
+            if item is None:
+                closed = True
+                break
+            batch.append(item)
+        task = asyncio.create_task(run(batch))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    await asyncio.gather(*running)
+
+class _MemoryAdmission:
+    """Admits images while their estimated memory stays within the budget, or if no other image is admitted."""
+
+    def __init__(self, memory_budget: int = None):
+        self.memory_budget = memory_budget
+        self.in_use = 0
+        self.admitted = 0
+        self.changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, estimate: int):
+        async with self.changed:
+            await self.changed.wait_for(
+                lambda: self.memory_budget is None or self.admitted == 0 or self.in_use + estimate <= self.memory_budget
+            )
+            self.in_use += estimate
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            async with self.changed:
+                self.in_use -= estimate
+                self.admitted -= 1
+                self.changed.notify_all()
+
+async def _measured(loop: asyncio.AbstractEventLoop, pool: concurrent.futures.Executor, peaks: list[int], func: Callable, *args):
+    result, peak = await loop.run_in_executor(pool, partial(measure_peak_rss, func), *args)
+    peaks.append(peak)
+    return result
+
+async def _process_image(
+        path: str,
+        prepare: Callable,
+        collect: Callable,
+        finish: Callable,
+        on_done: Callable,
+        queue: asyncio.Queue,
+        admission: asyncio.Semaphore,
+        memory: _MemoryAdmission,
+        estimate: Callable[[str], int],
+        on_peak_rss: Callable[[str, int], None],
+        preprocess_pool: concurrent.futures.Executor,
+        postprocess_pool: concurrent.futures.Executor):
+    loop = asyncio.get_running_loop()
+    peaks = []
+    async with admission, memory.reserve(estimate(path) if memory.memory_budget is not None else 0):
+        try:
+            prepared = await _measured(loop, preprocess_pool, peaks, prepare, path)
+            if prepared is None:
+                on_done(path, {})
+                return
+            jobs, state = prepared
+            done = [loop.create_future() for _ in jobs]
+            for job, future in zip(jobs, done):
+                queue.put_nowait((job, future))
+            await asyncio.gather(*done)
+            await asyncio.gather(*[_measured(loop, postprocess_pool, peaks, collect, job) for job in jobs])
+            graphs = await _measured(loop, postprocess_pool, peaks, finish, path, state)
+        except Exception as e:
+            print(f"An error occurred during graph feature extraction of {path}:\n{e}")
+            on_done(path, None)
+            return
+    if on_peak_rss is not None and None not in peaks:
+        on_peak_rss(path, max(peaks))
+    on_done(path, graphs)
+
+async def _schedule(
+        paths, prepare, run_batch, collect, finish, on_done, batch_size, voreen_concurrency, preprocess_workers, postprocess_workers, max_pending,
+        memory_budget, estimate, on_peak_rss):
+    queue = asyncio.Queue()
+    admission = asyncio.Semaphore(max_pending)
+    memory = _MemoryAdmission(memory_budget)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=preprocess_workers) as preprocess_pool, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=postprocess_workers) as postprocess_pool:
+        dispatcher = asyncio.create_task(_dispatch_batches(queue, run_batch, batch_size, voreen_concurrency))
+        await asyncio.gather(*[
+            _process_image(path, prepare, collect, finish, on_done, queue, admission, memory, estimate, on_peak_rss, preprocess_pool, postprocess_pool)
+            for path in paths
+        ])
+        queue.put_nowait(None)
+        await dispatcher
+
+def schedule_voreen_extraction(
+        paths: list[str],
+        prepare: Callable[[str], tuple[list[dict], object]],
+        run_batch: Callable[[list[dict]], None],
+        collect: Callable[[dict], object],
+        finish: Callable[[str, object], dict[str, str]],
+        on_done: Callable[[str, dict[str, str]], None],
+        batch_size: int = 1,
+        voreen_concurrency: int = 1,
+        preprocess_workers: int = 1,
+        postprocess_workers: int = 1,
+        max_pending: int = None,
+        memory_budget: int = None,
+        estimate: Callable[[str], int] = None,
+        on_peak_rss: Callable[[str, int], None] = None):
+    """
+    Runs the Voreen graph extraction of all images with separate resource limits for each step.
+
+    Args:
+        paths (list[str]): Paths of the vessel segmentations.
+        prepare (Callable): Preprocessing of an image. Returns the Voreen jobs of the image and a state that is passed to `finish`,
+            or None if the image is skipped. Must be picklable.
+        run_batch (Callable): Runs voreentool on a list of jobs.
+        collect (Callable): Postprocessing of a single job. Must be picklable.
+        finish (Callable): Postprocessing of an image after all its jobs were collected. Returns the graphs of the image. Must be picklable.
+        on_done (Callable): Called in the calling thread with the path and the graphs of each image, or None if the extraction failed.
+        batch_size (int): Maximum number of jobs per voreentool run.
+        voreen_concurrency (int): Maximum number of concurrent voreentool runs.
+        preprocess_workers (int): Number of preprocessing processes.
+        postprocess_workers (int): Number of postprocessing processes.
+        max_pending (int): Maximum number of images between preprocessing and postprocessing.
+            By default, twice as many images as Voreen processes at once.
+        memory_budget (int): Maximum estimated memory in bytes of the images between preprocessing and postprocessing. Unlimited by default.
+        estimate (Callable): Estimated memory of an image in bytes. Required with `memory_budget`.
+        on_peak_rss (Callable): Called with the path and the largest peak RSS increase of the preprocessing and postprocessing steps
+            of each image, see `utils.memory_budget.measure_peak_rss`.
+    """
+    assert batch_size >= 1 and voreen_concurrency >= 1, "The batch size and Voreen concurrency must be at least 1."
+    assert memory_budget is None or estimate is not None, "A memory budget requires a memory estimate."
+    if max_pending is None:
+        max_pending = 2 * voreen_concurrency * batch_size
+    asyncio.run(_schedule(
+        paths, prepare, run_batch, collect, finish, on_done,
+        batch_size, voreen_concurrency, preprocess_workers, postprocess_workers, max_pending,
+        memory_budget, estimate, on_peak_rss
+    ))
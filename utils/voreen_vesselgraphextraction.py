@@ -1,193 +1,442 @@
+import json
 import os
 import uuid
-from typing import Literal
+import xml.etree.ElementTree as ET
+from typing import Iterable, Literal
 
 import h5py
 import nibabel as nib
 import numpy as np
 import pandas as pd
-from PIL import Image
 
 import docker
-from utils.visualizer import generate_image_from_graph_json
+from utils.file_io import atomic_write, remove_tree, sync_files
+from utils.profiling import span
+from utils.vessel_graph import load_graph_arrays, sanity_filter, shift_graph, write_graph_files
+from utils.visualizer import save_graph_image
+from utils.volume_io import SlabVolume, write_nifti
 
 DOCKER_TMP_DIR = '/var/tmp'
 DOCKER_CACHE_DIR = '/var/cache'
 DOCKER_VOREEN_TOOL_PATH = '/home/software/voreen-voreen-5.3.0/voreen/bin/'
 # DOCKER_VOREEN_TOOL_PATH = '/home/software/voreen-src-unix-nightly/bin'
 
-def _sanity_filter(df_rows: pd.DataFrame, df_nodes: pd.DataFrame, z_dim, lower_z=0.3, upper_z=0.7) -> tuple[pd.DataFrame, pd.DataFrame]:
-    df_rows_filtered = df_rows[
-        (df_rows.volume>0) & (df_rows.distance>0) & (df_rows.curveness>0) & (df_rows.avgRadiusAvg>0) & (df_rows.avgRadiusStd)
-    ]
-    return df_rows_filtered, df_nodes
+VOREEN_WORKSPACE = 'feature-vesselgraphextraction_customized_command_line.vws'
 
-def extract_vessel_graph(
-        img_nii: nib.nifti1.Nifti1Image,
+def prepare_voreen_job(
+        volume: SlabVolume,
         image_name: str,
         outdir: str,
         DOCKER_WORK_DIR: str,
         tmp_dir: str,
-        bulge_size: float,
-        workspace_file: str,
         container_name: str,
-        graph_image: bool = True,
-        colorize: Literal["continuous", "thresholds", "random", "white"] = "continuous",
-        color_thresholds: list[float] = None,
-        verbose=False,
-        radius_correction_factor: float = -1.0,
-        image_size_mm: float = 3.0
-    ):
+        header: nib.Nifti1Header = None,
+        image: str = None,
+        crop: bool = False
+    ) -> dict:
     """
-    Extracts a vessel graph from a NIFTI image using Voreen's vessel graph extraction tool and stores the results in the specified output directory.
+    Saves a volume to a new temporary directory for the Voreen vessel graph extraction.
+    The volume is written slab by slab, so masked volumes are never copied in memory.
+    With `crop`, only the bounding box of the non-zero voxels is saved (see `SlabVolume.bounding_box`) and `collect_voreen_job`
+    shifts the outputs back to the coordinates of the uncropped volume. An empty volume is not saved at all and gets an empty graph.
+
     Args:
-        img_nii (nib.nifti1.Nifti1Image): The input NIFTI image containing the OCTA data.
+        volume (SlabVolume): The OCTA segmentation volume.
         image_name (str): The name of the image file (without extension).
         outdir (str): Directory where the output files will be saved.
-        tempdir (str): Temporary directory for intermediate files.
-        bulge_size (float): Minimum size of a bulge in the vessel graph.
-        workspace_file (str): Path to the Voreen workspace file.
+        DOCKER_WORK_DIR (str): Directory where Voreen writes the output files. Inside the container, this is the mount point of `outdir`.
+        tmp_dir (str): Temporary directory for intermediate files.
         container_name (str): Name of the Docker container to run the Voreen tool in.
-        graph_image (bool): Whether to generate a graph image from the extracted vessel graph.
-        colorize (Literal["continuous", "thresholds", "random", "white"]): Specifies how to color the edges in the graph image.
-            - "continuous": Color edges based on their radius, using a continuous color map.
-            - "thresholds": Color edges based on the given thresholds.
-            - "random": Assign a random color to each segment.
-            - "white": Use a default color (white).
-        color_thresholds (list[float]): A list of thresholds for coloring edges when `colorize` is set to "thresholds". 
-            This should be provided as a list of floats
-        verbose (bool): Whether to print verbose output.
-        radius_correction_factor (float): Additive correction factor for the radius estimation. Default is -1.0 to correct for Voreen's overestimation by 1 pixel measured on synthetic data.
-        image_size_mm (float): The size of the image in millimeters, used for scaling.
+        header (nib.Nifti1Header): NIFTI header of the volume, e.g. of the source segmentation. See `write_nifti`.
+        image (str): The image the volume belongs to, e.g. for ETDRS sectors. Profiling spans of the job are attributed to it. Defaults to `image_name`.
+        crop (bool): Whether to crop the volume to its non-zero voxels.
 
     Returns:
-        np.ndarray: The extracted vessel graph as a NumPy array.
-    Raises:
-        Exception: If the graph file is not found after extraction.
+        dict: Description of the job as used by `write_voreen_workspace`, `run_voreentool` and `collect_voreen_job`.
     """
+    image = image or image_name
+    full_shape = volume.full_shape
+    if crop:
+        bbox = volume.bounding_box()
+        if bbox is None:
+            # Nothing to extract, so Voreen is skipped
+            return {
+                "image_name": image_name, "image": image, "outdir": outdir, "empty": True,
+                "z_dim": full_shape[2], "segmentation_2d": np.zeros(full_shape[:2], np.uint8)
+            }
+        volume = volume.cropped(bbox)
     while True:
         tempdir = f"{tmp_dir}/{str(uuid.uuid4())}/"
         if not os.path.isdir(tempdir):
             break
     os.makedirs(tempdir)
     volume_path = os.path.join(tempdir, f'{image_name}.nii')
-    nib.save(img_nii, volume_path)
-
-    bulge_size_identifier = f'{bulge_size}'
-    bulge_size_identifier = bulge_size_identifier.replace('.','_')
-
-    bulge_path = f'<Property mapKey="minBulgeSize" name="minBulgeSize" value="{bulge_size}"/>'
+    with span("nifti_save", image=image):
+        projection = write_nifti(volume, volume_path, header)
+    if volume.shape != full_shape:
+        # The graph image is rendered on the uncropped segmentation
+        rows, cols, _ = volume.bbox
+        full_projection = np.zeros(full_shape[:2], projection.dtype)
+        full_projection[rows, cols] = projection
+        projection = full_projection
 
     if container_name is not None:
         tmp_dir_folder = tempdir.removesuffix("/").split('/')[-1]
-        DOCKER_TMP_SUB_DIR = f"{DOCKER_TMP_DIR}/{tmp_dir_folder}"
+        docker_tmp_sub_dir = f"{DOCKER_TMP_DIR}/{tmp_dir_folder}"
         # Use container paths for Voreen commands
         docker_volume_path = volume_path.replace(tmp_dir, DOCKER_TMP_DIR)
-        out_path = f'{DOCKER_TMP_SUB_DIR}/sample.h5'
+        out_path = f'{docker_tmp_sub_dir}/sample.h5'
     else:
+        docker_tmp_sub_dir = tempdir.removesuffix("/")
         docker_volume_path = volume_path
         out_path = f'{tempdir}sample.h5'
+    return {
+        "image_name": image_name,
+        "image": image,
+        "outdir": outdir,
+        "DOCKER_WORK_DIR": DOCKER_WORK_DIR,
+        "tempdir": tempdir,
+        "docker_tmp_sub_dir": docker_tmp_sub_dir,
+        "volume_path": docker_volume_path,
+        "out_path": out_path,
+        "z_dim": full_shape[2],
+        "offset": volume.offset,
+        "segmentation_2d": projection.astype(np.uint8)
+    }
 
-    bulge_size_identifier = f'{bulge_size}'
-    bulge_size_identifier = bulge_size_identifier.replace('.','_')
-    edge_path = f'{DOCKER_WORK_DIR}/{image_name}_edges.csv'
-    node_path = f'{DOCKER_WORK_DIR}/{image_name}_nodes.csv'
-    graph_path = f'{DOCKER_WORK_DIR}/{image_name}_graph.vvg'
+def job_variants(job: dict, variants: list[dict]) -> list[dict]:
+    """
+    Derives jobs that extract the saved volume of a job with different parameters, e.g. for a sweep over bulge sizes.
+    The variants share the volume, so it is saved once. Each variant gets its own subfolder of the temporary directory of the job
+    for the workspace and the processed volume. `collect_voreen_job` removes the temporary directory with the last variant.
 
-    voreen_workspace = 'feature-vesselgraphextraction_customized_command_line.vws'
+    Args:
+        job (dict): The job, see `prepare_voreen_job`.
+        variants (list[dict]): Per variant, the `bulge_size`, `outdir` and `DOCKER_WORK_DIR` that replace the ones of the job.
 
-    # Read in the file
-    with open(workspace_file, 'r') as file :
-        filedata = file.read()
+    Returns:
+        list[dict]: One job per variant.
+    """
+    if job.get("empty"):
+        return [{**job, **variant} for variant in variants]
+    jobs = []
+    for i, variant in enumerate(variants):
+        tempdir = os.path.join(job["tempdir"], f"variant{i}/")
+        os.makedirs(tempdir)
+        docker_tmp_sub_dir = f"{job['docker_tmp_sub_dir']}/variant{i}"
+        jobs.append({
+            **job, **variant,
+            "tempdir": tempdir,
+            "docker_tmp_sub_dir": docker_tmp_sub_dir,
+            "out_path": f"{docker_tmp_sub_dir}/sample.h5",
+            "volume_dir": job["tempdir"]
+        })
+    return jobs
 
+def _fill_workspace(template: str, job: dict, bulge_size: float) -> str:
+    """Replaces the placeholder paths and parameters of the workspace template with the ones of the given job."""
+    edge_path = f'{job["DOCKER_WORK_DIR"]}/{job["image_name"]}_edges.csv'
+    node_path = f'{job["DOCKER_WORK_DIR"]}/{job["image_name"]}_nodes.csv'
+    graph_path = f'{job["DOCKER_WORK_DIR"]}/{job["image_name"]}_graph.vvg'
+    bulge_path = f'<Property mapKey="minBulgeSize" name="minBulgeSize" value="{bulge_size}"/>'
 
-    # Replace the target string
-    filedata = filedata.replace("volume.nii", docker_volume_path if container_name else volume_path)
+    filedata = template.replace("volume.nii", job["volume_path"])
     filedata = filedata.replace("nodes.csv", node_path)
     filedata = filedata.replace("edges.csv", edge_path)
     filedata = filedata.replace("graph.vvg", graph_path)
     filedata = filedata.replace('<Property mapKey="minBulgeSize" name="minBulgeSize" value="3" />', bulge_path)
-    filedata = filedata.replace("input.nii", docker_volume_path if container_name else volume_path)
-    filedata = filedata.replace("output.h5", out_path)
+    filedata = filedata.replace("input.nii", job["volume_path"])
+    filedata = filedata.replace("output.h5", job["out_path"])
+    return filedata
 
-    # Write the file out again
-    with open(os.path.join(tempdir,voreen_workspace), 'w') as file:
+def _merge_workspaces(workspaces: list[str]) -> str:
+    """
+    Merges the processor networks of multiple workspaces into the first workspace.
+    Processor IDs and names are made unique, so that each network remains an independent processing chain.
+    """
+    roots = [ET.fromstring(workspace) for workspace in workspaces]
+    network = roots[0].find("Workspace/ProcessorNetwork")
+    for i, root in enumerate(roots[1:], start=1):
+        other = root.find("Workspace/ProcessorNetwork")
+        for element in other.iter("Processor"):
+            if "id" in element.attrib:
+                element.set("id", f"{element.get('id')}_{i}")
+                element.set("name", f"{element.get('name')} {i}")
+            if "ref" in element.attrib:
+                element.set("ref", f"{element.get('ref')}_{i}")
+        network.find("Processors").extend(other.find("Processors"))
+        network.find("Connections").extend(other.find("Connections"))
+    return ET.tostring(roots[0], encoding="unicode", xml_declaration=True)
+
+def write_voreen_workspace(jobs: list[dict], workspace_file: str, bulge_size: float) -> str:
+    """
+    Writes a workspace with one processing chain per job to the temporary directory of the first job.
+
+    Args:
+        jobs (list[dict]): Jobs as returned by `prepare_voreen_job` or `job_variants`.
+        workspace_file (str): Path to the Voreen workspace template.
+        bulge_size (float): Minimum size of a bulge in the vessel graph. Jobs with their own `bulge_size` (see `job_variants`) use that instead.
+
+    Returns:
+        str: Path of the written workspace.
+    """
+    with open(workspace_file, 'r') as file:
+        template = file.read()
+    workspaces = [_fill_workspace(template, job, job.get("bulge_size", bulge_size)) for job in jobs]
+    filedata = workspaces[0] if len(workspaces) == 1 else _merge_workspaces(workspaces)
+
+    path = os.path.join(jobs[0]["tempdir"], VOREEN_WORKSPACE)
+    with open(path, 'w') as file:
         file.write(filedata)
         file.flush()
+    return path
 
-    workspace_file = os.path.join(tempdir,voreen_workspace)
-
-    absolute_temp_path = os.path.join(tempdir)
+def run_voreentool(job: dict, container_name, verbose: bool = False):
+    """
+    Runs voreentool on the workspace written by `write_voreen_workspace` to the temporary directory of the given job.
 
+    Args:
+        job (dict): The job, see `prepare_voreen_job`.
+        container_name: Name of the Voreen container, a `utils.voreen_container_pool.VoreenContainerPool`, or None for a local Voreen installation.
+        verbose (bool): Whether to print the output of voreentool.
+    """
     if container_name is None:
-        # extract graph and delete temp directory
-        os.system(f'cd {DOCKER_VOREEN_TOOL_PATH} ; ./voreentool \
-            --workspace {workspace_file} \
+        # Local Voreen installation
+        os.system(f'cd {os.getenv("VOREEN_TOOL_PATH", DOCKER_VOREEN_TOOL_PATH)} ; ./voreentool \
+            --workspace {os.path.join(job["tempdir"], VOREEN_WORKSPACE)} \
             -platform minimal --trigger-volumesaves --trigger-geometrysaves  --trigger-imagesaves \
-            --workdir {outdir} --tempdir {tempdir} --cachedir {DOCKER_CACHE_DIR}' + ("" if verbose else "--logLevel error >/dev/null 2>&1")
+            --workdir {job["outdir"]} --tempdir {job["tempdir"]} --cachedir {DOCKER_CACHE_DIR}' + ("" if verbose else " --logLevel error >/dev/null 2>&1")
         )
+    elif not isinstance(container_name, str):
+        # Run in the least loaded container of a pool
+        with container_name.acquire() as name:
+            run_voreentool(job, name, verbose=verbose)
     else:
         # Run the command in the docker container
         client = docker.from_env()
         container = client.containers.get(container_name)
         command = f"cd {DOCKER_VOREEN_TOOL_PATH} ; ./voreentool \
-            --workspace {DOCKER_TMP_SUB_DIR}/{voreen_workspace} \
+            --workspace {job['docker_tmp_sub_dir']}/{VOREEN_WORKSPACE} \
             -platform minimal --trigger-volumesaves --trigger-geometrysaves  --trigger-imagesaves \
-            --workdir {DOCKER_WORK_DIR} --tempdir {DOCKER_TMP_SUB_DIR} --cachedir {DOCKER_CACHE_DIR}" + ("" if verbose else " --logLevel error >/dev/null 2>&1")
+            --workdir {job['DOCKER_WORK_DIR']} --tempdir {job['docker_tmp_sub_dir']} --cachedir {DOCKER_CACHE_DIR}" + ("" if verbose else " --logLevel error >/dev/null 2>&1")
         exec_command = f"/bin/bash -c \"{command}\""
         result = container.exec_run(user=str(os.getuid()), cmd=exec_command, detach=False, stream=True)
         for line in result.output:
             print(line.decode(), end='')
         # Reset terminal formatting after container execution
         print('\033[0m', end='', flush=True)
+
+def collect_voreen_job(
+        job: dict,
+        graph_image: bool = True,
+        colorize: Literal["continuous", "thresholds", "random", "white"] = "continuous",
+        color_thresholds: list[float] = None,
+        radius_correction_factor: float = -1.0,
+        image_size_mm: float = 3.0
+    ) -> np.ndarray:
+    """
+    Post-processes the outputs of a job after voreentool finished. Removes the temporary directory of the job.
+    The outputs of a cropped volume are shifted to the coordinates of the uncropped volume.
+
+    Returns:
+        np.ndarray: The processed volume of the job. For cropped volumes, the processed region only. Empty for skipped empty volumes.
+    Raises:
+        Exception: If the graph file is not found after extraction.
+    """
+    outdir = job["outdir"]
+    image_name = job["image_name"]
+    if job.get("empty"):
+        graph_json = {"graph": {"nodes": [], "edges": []}}
+        df_nodes, df_edges = write_graph_files(graph_json, outdir, image_name)
+        if graph_image:
+            with span("graph_rendering", image=job["image"]):
+                save_graph_image(
+                    graph_json, df_edges, segmentation_2d_mask=job["segmentation_2d"], path=os.path.join(outdir, f'{image_name}_graph.png'),
+                    image_size_mm=image_size_mm, colorize=colorize, color_thresholds=color_thresholds, radius_correction_factor=radius_correction_factor
+                )
+        return np.zeros((0, 0, 0), np.uint8)
     try:
-        graph_host_path = graph_path.replace(DOCKER_WORK_DIR, outdir)
-        os.rename(graph_host_path, graph_host_path.replace(".vvg", ".json"))
-        # Make sure all files are written and flushed to disk
-        os.sync()
+        graph_host_path = os.path.join(outdir, f'{image_name}_graph.vvg')
+        graph_file = graph_host_path.replace(".vvg", ".json")
+        os.rename(graph_host_path, graph_file)
+        edges_file = os.path.join(outdir, f'{image_name}_edges.csv')
+        nodes_file = os.path.join(outdir, f'{image_name}_nodes.csv')
+        if any(job["offset"]):
+            with open(graph_file, "r") as file:
+                graph_json = json.load(file)
+            df_nodes = pd.read_csv(nodes_file, sep=";", index_col=0)
+            shift_graph(graph_json, df_nodes, job["offset"])
+            with atomic_write(graph_file) as file:
+                json.dump(graph_json, file)
+            with atomic_write(nodes_file) as file:
+                df_nodes.to_csv(file, sep=";")
+        # Flush the files written by Voreen to disk. The edges file is rewritten below.
+        sync_files([graph_file, nodes_file])
 
-        h5_file_path = out_path.replace(DOCKER_TMP_SUB_DIR + "/", tempdir) if container_name else out_path
-        with h5py.File(h5_file_path, "r") as f:
+        with h5py.File(os.path.join(job["tempdir"], "sample.h5"), "r") as f:
             # Print all root level object names (aka keys) 
             # these can be group or dataset names 
             a_group_key = list(f.keys())[0]
             ds_arr = f[a_group_key][()]  # returns as a numpy array
-            os.system(f"rm -rf '{absolute_temp_path}' 2> /dev/null")
+        remove_tree(job["tempdir"])
+        if "volume_dir" in job and not any(entry.is_dir() for entry in os.scandir(job["volume_dir"])):
+            # The last variant of the volume was collected
+            remove_tree(job["volume_dir"])
         ret = ds_arr[1]
         ret = np.flip(np.rot90(ret),0)
 
-        edges_file = os.path.join(outdir, f'{image_name}_edges.csv')
-        nodes_file = os.path.join(outdir, f'{image_name}_nodes.csv')
-
         # Clean with sanity checks
-        df_edges = pd.read_csv(edges_file, sep=";", index_col=0)
-        df_nodes = pd.read_csv(nodes_file, sep=";", index_col=0)
-        df_edges, df_nodes = _sanity_filter(df_edges,df_nodes, z_dim=img_nii.shape[2])
-        df_edges.to_csv(edges_file, sep=";")
-        # flush the files to disk
-        os.sync()
+        with span("csv_filter", image=job["image"]):
+            df_edges = pd.read_csv(edges_file, sep=";", index_col=0)
+            df_nodes = pd.read_csv(nodes_file, sep=";", index_col=0)
+            df_edges, df_nodes = sanity_filter(df_edges,df_nodes, z_dim=job["z_dim"])
+            with atomic_write(edges_file) as file:
+                df_edges.to_csv(file, sep=";")
 
+        # Cache the parsed graph next to the JSON file for the summary
+        graph_arrays = load_graph_arrays(graph_file)
         if graph_image:
-            graph_json = pd.read_json(os.path.join(outdir, f'{image_name}_graph.json'), orient="records")
-            img = generate_image_from_graph_json(
-                graph_json,
-                df_edges,
-                dim=img_nii.shape[0],
-                image_size_mm=image_size_mm,
-                colorize=colorize,
-                color_thresholds=color_thresholds,
-                radius_correction_factor=radius_correction_factor
-            )
-            segmentation_2d_mask = img_nii.get_fdata().max(axis=2).astype(np.uint8)
-            if segmentation_2d_mask.max() > 1:
-                segmentation_2d_mask = segmentation_2d_mask // 255
-            Image.fromarray(img * segmentation_2d_mask[...,np.newaxis]).save(os.path.join(outdir, f'{image_name}_graph.png'))
+            with span("graph_rendering", image=job["image"]):
+                save_graph_image(
+                    graph_arrays,
+                    df_edges,
+                    segmentation_2d_mask=job["segmentation_2d"],
+                    path=os.path.join(outdir, f'{image_name}_graph.png'),
+                    image_size_mm=image_size_mm,
+                    colorize=colorize,
+                    color_thresholds=color_thresholds,
+                    radius_correction_factor=radius_correction_factor
+                )
 
         return ret
     except FileNotFoundError as e:
         error_msg = f"{e}\nThere was likely an error during the graph extraction process. Please check the logs for more information using '--verbose --threads 1'"
         print(f"\033[91m{error_msg}\033[0m")
         raise Exception(error_msg)
+
+def extract_vessel_graph(
+        img_nii: nib.nifti1.Nifti1Image,
+        image_name: str,
+        outdir: str,
+        DOCKER_WORK_DIR: str,
+        tmp_dir: str,
+        bulge_size: float,
+        workspace_file: str,
+        container_name: str,
+        graph_image: bool = True,
+        colorize: Literal["continuous", "thresholds", "random", "white"] = "continuous",
+        color_thresholds: list[float] = None,
+        verbose=False,
+        radius_correction_factor: float = -1.0,
+        image_size_mm: float = 3.0
+    ):
+    """
+    Extracts a vessel graph from a NIFTI image using Voreen's vessel graph extraction tool and stores the results in the specified output directory.
+    Args:
+        img_nii (nib.nifti1.Nifti1Image): The input NIFTI image containing the OCTA data.
+        image_name (str): The name of the image file (without extension).
+        outdir (str): Directory where the output files will be saved.
+        tempdir (str): Temporary directory for intermediate files.
+        bulge_size (float): Minimum size of a bulge in the vessel graph.
+        workspace_file (str): Path to the Voreen workspace file.
+        container_name (str): Name of the Docker container to run the Voreen tool in.
+        graph_image (bool): Whether to generate a graph image from the extracted vessel graph.
+        colorize (Literal["continuous", "thresholds", "random", "white"]): Specifies how to color the edges in the graph image.
+            - "continuous": Color edges based on their radius, using a continuous color map.
+            - "thresholds": Color edges based on the given thresholds.
+            - "random": Assign a random color to each segment.
+            - "white": Use a default color (white).
+        color_thresholds (list[float]): A list of thresholds for coloring edges when `colorize` is set to "thresholds". 
+            This should be provided as a list of floats
+        verbose (bool): Whether to print verbose output.
+        radius_correction_factor (float): Additive correction factor for the radius estimation. Default is -1.0 to correct for Voreen's overestimation by 1 pixel measured on synthetic data.
+        image_size_mm (float): The size of the image in millimeters, used for scaling.
+
+    Returns:
+        np.ndarray: The extracted vessel graph as a NumPy array.
+    Raises:
+        Exception: If the graph file is not found after extraction.
+    """
+    job = prepare_voreen_job(SlabVolume.from_nifti(img_nii), image_name, outdir, DOCKER_WORK_DIR, tmp_dir, container_name, header=img_nii.header)
+    write_voreen_workspace([job], workspace_file, bulge_size)
+    with span("voreentool", image=[job["image"]]):
+        run_voreentool(job, container_name, verbose=verbose)
+    return collect_voreen_job(job, graph_image, colorize, color_thresholds, radius_correction_factor, image_size_mm)
+
+def run_voreen_batch(jobs: list[dict], workspace_file: str, bulge_size: float, container_name: str, verbose: bool = False):
+    """
+    Extracts the graphs of a batch of jobs with a single voreentool run. The outputs still need to be collected with `collect_voreen_job`.
+    Empty jobs of cropped volumes are skipped.
+    """
+    jobs = [job for job in jobs if not job.get("empty")]
+    if not jobs:
+        return
+    write_voreen_workspace(jobs, workspace_file, bulge_size)
+    with span("voreentool", image=[job["image"] for job in jobs]):
+        run_voreentool(jobs[0], container_name, verbose=verbose)
+
+def _extract_batch(jobs: list[dict], workspace_file: str, bulge_size: float, container_name: str, verbose: bool, **kwargs) -> list[np.ndarray]:
+    run_voreen_batch(jobs, workspace_file, bulge_size, container_name, verbose=verbose)
+    results = []
+    for job in jobs:
+        try:
+            results.append(collect_voreen_job(job, **kwargs))
+        except Exception as e:
+            print(f"An error occurred during graph feature extraction of {job['image']}:\n{e}")
+            results.append(None)
+    return results
+
+def extract_vessel_graphs(
+        volumes: Iterable[dict],
+        tmp_dir: str,
+        bulge_size: float,
+        workspace_file: str,
+        container_name: str,
+        batch_size: int = 1,
+        graph_image: bool = True,
+        colorize: Literal["continuous", "thresholds", "random", "white"] = "continuous",
+        color_thresholds: list[float] = None,
+        verbose=False,
+        radius_correction_factor: float = -1.0,
+        image_size_mm: float = 3.0,
+        crop: bool = False
+    ) -> list[np.ndarray]:
+    """
+    Extracts the vessel graphs of multiple volumes with a single voreentool run per batch.
+    The workspace of a batch contains one independent processing chain per volume,
+    so that the startup of voreentool and the deserialization of the workspace are paid once per batch instead of once per volume.
+
+    Args:
+        volumes (Iterable[dict]): Keyword arguments `volume`, `image_name`, `outdir`, `DOCKER_WORK_DIR` and optionally `header` of `prepare_voreen_job` per volume.
+            The volumes are consumed one at a time and saved to the temporary directory, so a generator keeps at most one volume in memory.
+            With an additional `variants` list, the volume is saved once and extracted once per variant, see `job_variants`.
+        batch_size (int): Maximum number of processing chains per voreentool run. Larger batches amortize the startup
+            but increase the peak memory of voreentool, which keeps the intermediate results of all chains.
+            The variants of a volume are always extracted in the same run.
+        crop (bool): Whether to crop the volumes to their non-zero voxels, see `prepare_voreen_job`.
+        For the remaining arguments, see `extract_vessel_graph`.
+
+    Returns:
+        list[np.ndarray]: The result of `extract_vessel_graph` per volume and variant, or None if the extraction failed for it.
+    """
+    assert batch_size >= 1, "The batch size must be at least 1."
+    kwargs = dict(
+        workspace_file=workspace_file, bulge_size=bulge_size, container_name=container_name, verbose=verbose,
+        graph_image=graph_image, colorize=colorize, color_thresholds=color_thresholds,
+        radius_correction_factor=radius_correction_factor, image_size_mm=image_size_mm
+    )
+    results = []
+    jobs = []
+    for volume in volumes:
+        variants = volume.pop("variants", None)
+        job = prepare_voreen_job(tmp_dir=tmp_dir, container_name=container_name, crop=crop, **volume)
+        jobs.extend(job_variants(job, variants) if variants is not None else [job])
+        if len(jobs) >= batch_size:
+            results.extend(_extract_batch(jobs, **kwargs))
+            jobs = []
+    if jobs:
+        results.extend(_extract_batch(jobs, **kwargs))
+    return results
     
 
 if __name__ == "__main__":